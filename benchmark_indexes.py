@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк горячих запросов до и после миграции индексов.
+
+Создает временную SQLite базу, заполняет ее синтетическими данными,
+печатает планы запросов (EXPLAIN QUERY PLAN) и время выполнения,
+Схема создается базовой миграцией (версия 0), затем применяются
+остальные миграции из db_migrations и замеры повторяются.
+
+Запуск: python benchmark_indexes.py [--users 200] [--sessions 10] [--messages 60]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from db_dialect import AdaptingCursor
+from db_migrations import apply_migrations
+
+# (название, запрос) - те же запросы, что выполняет app.py
+HOT_QUERIES = [
+    ('история сообщений', '''SELECT role, content FROM messages WHERE session_id = :session_id ORDER BY timestamp ASC'''),
+    ('счетчик сообщений', '''SELECT COUNT(*) FROM messages WHERE session_id = :session_id'''),
+    ('список сессий', '''SELECT id, title, created_at, updated_at FROM sessions WHERE user_id = :user_id ORDER BY updated_at DESC'''),
+    ('Нейрокарта', '''SELECT id, event_number, event, emotion, idea, is_completed, created_at FROM event_map
+                      WHERE user_id = :user_id ORDER BY event_number ASC, id ASC'''),
+    ('номер события', '''SELECT MAX(event_number) FROM event_map WHERE user_id = :user_id AND event = :event'''),
+    ('статистика GPT', '''SELECT id, message_count, root_beliefs_identified, positive_transformations
+                          FROM gpt_statistics WHERE session_id = :session_id'''),
+    ('журнал', '''SELECT id, session_id, date_time FROM session_journal WHERE user_id = :user_id ORDER BY date_time DESC'''),
+    ('мысли', '''SELECT id, thought_number, title FROM interesting_thoughts WHERE user_id = :user_id ORDER BY thought_number ASC'''),
+    ('До и После', '''SELECT id, belief_before, belief_after FROM before_after_beliefs WHERE user_id = :user_id ORDER BY created_at DESC'''),
+    ('система убеждений', '''SELECT concept_data FROM concept_hierarchies WHERE session_id = :session_id'''),
+]
+
+
+class _Conn:
+    """Соединение с адаптирующим курсором, как у пула"""
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def cursor(self):
+        return AdaptingCursor(self._raw.cursor(), 'sqlite')
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+
+def populate(conn, users, sessions_per_user, messages_per_session):
+    rng = random.Random(42)
+    c = conn.cursor()
+    session_id = 0
+    for user_id in range(1, users + 1):
+        for _ in range(sessions_per_user):
+            session_id += 1
+            c.execute('INSERT INTO sessions (id, user_id, title) VALUES (?, ?, ?)', (session_id, user_id, 'Сессия'))
+            c.executemany('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                          [(session_id, 'user' if i % 2 == 0 else 'assistant', 'сообщение ' * rng.randint(3, 30))
+                           for i in range(messages_per_session)])
+            c.execute('INSERT INTO gpt_statistics (session_id, user_id, message_count) VALUES (?, ?, ?)',
+                      (session_id, user_id, messages_per_session))
+            c.execute('INSERT INTO concept_hierarchies (session_id, concept_data) VALUES (?, ?)', (session_id, '{}'))
+        c.executemany('''INSERT INTO event_map (user_id, event_number, event, emotion, idea)
+                         VALUES (?, ?, ?, ?, ?)''',
+                      [(user_id, n, f'событие {n}', 'тревога', 'я не справлюсь') for n in range(1, 21)])
+        c.executemany('INSERT INTO session_journal (user_id, session_id) VALUES (?, ?)',
+                      [(user_id, session_id)] * 5)
+        c.executemany('INSERT INTO interesting_thoughts (user_id, thought_number, title, thought_text) VALUES (?, ?, ?, ?)',
+                      [(user_id, n, 'мысль', 'текст') for n in range(1, 6)])
+        c.executemany('INSERT INTO before_after_beliefs (user_id, belief_before) VALUES (?, ?)',
+                      [(user_id, 'до')] * 5)
+    conn.commit()
+    return session_id
+
+
+def measure(conn, params, repeats):
+    c = conn.cursor()
+    results = []
+    for title, query in HOT_QUERIES:
+        c.execute('EXPLAIN QUERY PLAN ' + query, params)
+        plan = '; '.join(row[3] for row in c.fetchall())
+        started = time.perf_counter()
+        for _ in range(repeats):
+            c.execute(query, params)
+            c.fetchall()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / repeats
+        results.append((title, plan, elapsed_ms))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк индексов горячих запросов')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10, help='сессий на пользователя')
+    parser.add_argument('--messages', type=int, default=60, help='сообщений на сессию')
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        conn = _Conn(raw)
+        apply_migrations(conn, target=0)
+        last_session = populate(raw, args.users, args.sessions, args.messages)
+        params = {'session_id': last_session // 2, 'user_id': args.users // 2, 'event': 'событие 7'}
+        print(f"Данные: {args.users} пользователей, {last_session} сессий, "
+              f"{last_session * args.messages} сообщений\n")
+
+        before = measure(raw, params, args.repeats)
+        apply_migrations(conn)
+        raw.execute('ANALYZE')
+        after = measure(raw, params, args.repeats)
+        raw.close()
+
+    for (title, plan_before, ms_before), (_, plan_after, ms_after) in zip(before, after):
+        speedup = ms_before / ms_after if ms_after else float('inf')
+        print(f"== {title}: {ms_before:.3f} мс -> {ms_after:.3f} мс (x{speedup:.1f})")
+        print(f"   до:    {plan_before}")
+        print(f"   после: {plan_after}")
+
+
+if __name__ == '__main__':
+    main()
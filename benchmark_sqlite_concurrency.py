@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк параллельной записи в SQLite: профиль default против wal.
+
+Для каждого профиля (db_pool.sqlite_pragmas) создается временная база со
+схемой из db_migrations. Писатели параллельно выполняют те же транзакции,
+что и ход диалога: сообщение пользователя (handle_message) и ответ со
+статистикой (process_message_turn), каждая - через unit_of_work пула.
+Одновременно читатели загружают историю и список сессий. Печатаются
+перцентили задержки, пропускная способность и число ошибок блокировки.
+
+Запуск: python benchmark_sqlite_concurrency.py [--writers 16] [--readers 8] [--turns 50]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db_pool
+from db_migrations import apply_migrations
+from db_pool import ConnectionPool, _sqlite_connector, sqlite_pragmas, unit_of_work
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def user_turn(session_id, user_id, text):
+    """Запись сообщения пользователя - как в handle_message"""
+    with unit_of_work() as uow:
+        c = uow.cursor
+        c.execute('''UPDATE sessions
+                     SET updated_at = CURRENT_TIMESTAMP,
+                         title = CASE WHEN EXISTS (SELECT 1 FROM messages WHERE session_id = ?)
+                                      THEN title ELSE ? END
+                     WHERE id = ? AND user_id = ?''', (session_id, text[:50], session_id, user_id))
+        c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                  (session_id, 'user', text))
+
+
+def assistant_turn(session_id, user_id, text, message_count):
+    """Ответ и статистика - как в process_message_turn"""
+    with unit_of_work() as uow:
+        c = uow.cursor
+        c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                  (session_id, 'assistant', text))
+        c.execute('UPDATE gpt_statistics SET message_count = ?, updated_at = CURRENT_TIMESTAMP WHERE session_id = ?',
+                  (message_count, session_id))
+
+
+def writer(session_id, user_id, turns, results):
+    for turn in range(turns):
+        for step in (lambda: user_turn(session_id, user_id, f'сообщение {turn} ' * 10),
+                     lambda: assistant_turn(session_id, user_id, f'ответ {turn} ' * 40, turn * 2 + 2)):
+            started = time.perf_counter()
+            try:
+                step()
+                outcome = 'write'
+            except sqlite3.OperationalError:
+                outcome = 'locked'
+            with results['lock']:
+                if outcome == 'write':
+                    results['write'].append(time.perf_counter() - started)
+                else:
+                    results['locked'] += 1
+
+
+def reader(pool, sessions, stop, results):
+    i = 0
+    while not stop.is_set():
+        session_id, user_id = sessions[i % len(sessions)]
+        i += 1
+        started = time.perf_counter()
+        conn = pool.acquire()
+        try:
+            c = conn.cursor()
+            c.execute('''SELECT id, role, content FROM messages WHERE session_id = ?
+                         ORDER BY id DESC LIMIT 40''', (session_id,))
+            c.fetchall()
+            c.execute('SELECT id, title, updated_at FROM sessions WHERE user_id = ? ORDER BY updated_at DESC',
+                      (user_id,))
+            c.fetchall()
+            outcome = 'read'
+        except sqlite3.OperationalError:
+            outcome = 'locked'
+        finally:
+            conn.close()
+        with results['lock']:
+            if outcome == 'read':
+                results['read'].append(time.perf_counter() - started)
+            else:
+                results['locked'] += 1
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        # Писатели берут соединения из общего пула через unit_of_work()
+        pool = ConnectionPool(_sqlite_connector(path, sqlite_pragmas(profile)), dialect='sqlite',
+                              max_size=args.writers + args.readers + 1)
+        db_pool._pool = pool
+        with pool.connection() as conn:
+            apply_migrations(conn)
+            c = conn.cursor()
+            sessions = []
+            for n in range(args.writers):
+                c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (f'bench_{n}', 'x'))
+                user_id = c.lastrowid
+                c.execute('INSERT INTO sessions (user_id, title) VALUES (?, ?)', (user_id, 'Новая сессия'))
+                sessions.append((c.lastrowid, user_id))
+                c.execute('INSERT INTO gpt_statistics (session_id, user_id, message_count) VALUES (?, ?, 0)',
+                          (c.lastrowid, user_id))
+
+        results = {'lock': threading.Lock(), 'write': [], 'read': [], 'locked': 0}
+        stop = threading.Event()
+        readers = [threading.Thread(target=reader, args=(pool, sessions, stop, results))
+                   for _ in range(args.readers)]
+        writers = [threading.Thread(target=writer, args=(session_id, user_id, args.turns, results))
+                   for session_id, user_id in sessions]
+        started = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in readers:
+            thread.join()
+        pool.close_all()
+        db_pool._pool = None
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Параллельная запись в SQLite по профилям')
+    parser.add_argument('--writers', type=int, default=16, help='параллельных сессий-писателей')
+    parser.add_argument('--readers', type=int, default=8, help='параллельных читателей')
+    parser.add_argument('--turns', type=int, default=50, help='ходов на писателя (две транзакции на ход)')
+    parser.add_argument('--profiles', default='default,wal')
+    args = parser.parse_args()
+
+    for profile in args.profiles.split(','):
+        results, elapsed = run(profile, args)
+        writes, reads = results['write'], results['read']
+        print(f"== {profile}: {', '.join(f'{n}={v}' for n, v in sqlite_pragmas(profile)) or 'настройки библиотеки'}")
+        print(f"   запись: {len(writes)} транзакций за {elapsed:.2f} с ({len(writes) / elapsed:.0f}/с), "
+              f"p50={percentile(writes, 50) * 1000:.1f} мс, p95={percentile(writes, 95) * 1000:.1f} мс, "
+              f"max={max(writes, default=0) * 1000:.1f} мс")
+        print(f"   чтение: {len(reads)} ({len(reads) / elapsed:.0f}/с), "
+              f"p50={percentile(reads, 50) * 1000:.1f} мс, p95={percentile(reads, 95) * 1000:.1f} мс")
+        print(f"   ошибок блокировки: {results['locked']}")
+
+
+if __name__ == '__main__':
+    main()
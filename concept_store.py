@@ -0,0 +1,123 @@
+"""Покомпонентное хранение систем убеждений в таблице concept_fields.
+
+Раньше весь concept_data сессии сериализовался в одну JSON-строку
+concept_hierarchies и перезаписывался на каждом ходе. Теперь одна строка -
+одно поле одной идеи (session_id, concept_name, field) со значением в JSON,
+и при сохранении пишутся только изменившиеся поля и удаляются исчезнувшие.
+Объем записи пропорционален правке, а не размеру дерева.
+
+Чтение собирает concept_data из строк в исходном порядке идей и полей.
+Сессии, сохраненные до перехода, читаются из concept_hierarchies; при
+первом сохранении их данные переносятся в concept_fields.
+
+Каждое сохранение ставит сессии новую версию (sessions.concept_version).
+Дельта считается от копии в памяти, только если ее версия совпадает с
+версией в БД; иначе сессию сохранял другой воркер, и дельта считается от
+строк concept_fields, прочитанных в той же транзакции.
+"""
+import json
+import uuid
+
+from session_store import MemorySessionStore
+
+
+def flatten(concept_data: dict) -> dict:
+    """{(идея, поле): (позиция идеи, позиция поля, значение в JSON)}"""
+    fields = {}
+    for concept_position, (concept_name, concept) in enumerate(concept_data.items()):
+        for field_position, (field, value) in enumerate(concept.items()):
+            fields[(concept_name, field)] = (concept_position, field_position,
+                                             json.dumps(value, ensure_ascii=False, sort_keys=True))
+    return fields
+
+
+def materialize(fields: dict) -> dict:
+    concept_data = {}
+    for (concept_name, field), (_, _, value) in sorted(fields.items(), key=lambda item: item[1][:2]):
+        concept_data.setdefault(concept_name, {})[field] = json.loads(value)
+    return concept_data
+
+
+class ConceptStore:
+    """Чтение и инкрементальная запись concept_data сессий"""
+
+    def __init__(self, cache=None):
+        # (последнее сохраненное состояние сессии в развернутом виде, его версия) - для дельты без чтения БД
+        self.cache = cache or MemorySessionStore()
+
+    def _version(self, c, session_id):
+        c.execute('SELECT concept_version FROM sessions WHERE id = ?', (session_id,))
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def _load_fields(self, c, session_id) -> dict:
+        c.execute('''SELECT concept_name, field, concept_position, field_position, value_json
+                     FROM concept_fields WHERE session_id = ?''', (session_id,))
+        return {(row[0], row[1]): (row[2], row[3], row[4]) for row in c.fetchall()}
+
+    def load(self, c, session_id):
+        """concept_data сессии или None, если он еще не сохранялся"""
+        # Версия читается до строк: при параллельной записи копия окажется устаревшей, а не новее версии
+        version = self._version(c, session_id)
+        fields = self._load_fields(c, session_id)
+        if fields:
+            if version is not None:
+                self.cache.set(session_id, (fields, version))
+            return materialize(fields)
+        c.execute('SELECT concept_data FROM concept_hierarchies WHERE session_id = ?', (session_id,))
+        row = c.fetchone()
+        if row and row[0]:
+            return json.loads(row[0])
+        return None
+
+    def save(self, c, session_id, concept_data: dict) -> dict:
+        """Записывает отличия от последнего сохранения; фиксирует транзакцию вызывающий код.
+
+        Возвращает {'updated': N, 'deleted': M, 'concepts': {идея: позиция или None}},
+        где concepts - идеи с изменившимися полями или позицией (None - идея
+        удалена) с последнего сохранения этого процесса, для инкрементального
+        обновления графа идей; None, если после него сессию сохранял другой
+        воркер (граф нужно синхронизировать целиком). При откате транзакции
+        нужно вызвать invalidate(session_id).
+        """
+        cached = self.cache.get(session_id)
+        version = self._version(c, session_id)
+        if cached is not None and version is not None and cached[1] == version:
+            previous = cached[0]
+        else:
+            previous = self._load_fields(c, session_id)
+            if not previous:
+                # Первое сохранение: данные из concept_hierarchies переезжают в concept_fields
+                c.execute('DELETE FROM concept_hierarchies WHERE session_id = ?', (session_id,))
+
+        current = flatten(concept_data)
+        updated = [(session_id, name, field) + value for (name, field), value in current.items()
+                   if previous.get((name, field)) != value]
+        deleted = [(session_id, name, field) for (name, field) in previous if (name, field) not in current]
+        try:
+            if updated:
+                c.executemany('''INSERT OR REPLACE INTO concept_fields
+                                 (session_id, concept_name, field, concept_position, field_position,
+                                  value_json, updated_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)''', updated)
+            if deleted:
+                c.executemany('DELETE FROM concept_fields WHERE session_id = ? AND concept_name = ? AND field = ?',
+                              deleted)
+            new_version = uuid.uuid4().hex
+            c.execute('UPDATE sessions SET concept_version = ? WHERE id = ?', (new_version, session_id))
+        except Exception:
+            self.invalidate(session_id)
+            raise
+        self.cache.set(session_id, (current, new_version))
+        concepts = None
+        if cached is not None and previous is cached[0]:
+            concepts = {name: None for _, name, _ in deleted if name not in concept_data}
+            concepts.update((name, position) for _, name, _, position, _, _ in updated)
+        return {'updated': len(updated), 'deleted': len(deleted), 'concepts': concepts}
+
+    def invalidate(self, session_id):
+        self.cache.delete(session_id)
+
+
+# Общее хранилище процесса
+concept_store = ConceptStore()
@@ -0,0 +1,210 @@
+"""Бэкенды LLM для PsychologistAI.
+
+Бэкенд - любой объект с интерфейсом клиента OpenAI
+(client.chat.completions.create(model=..., messages=..., ...)). Выбирается
+переменной LLM_BACKEND:
+- openai     - API OpenAI (нужен ключ AI_API_KEY/OPENAI_API_KEY);
+- compatible - любой OpenAI-совместимый сервер по LLM_BASE_URL
+               (vLLM, Ollama, mock_llm_server.py и т.д.);
+- fake       - локальная детерминированная заглушка без сети и затрат:
+               одинаковый запрос дает одинаковый ответ, задержки берутся из
+               настраиваемых распределений (время до первого токена и
+               скорость генерации) - для нагрузочного тестирования.
+
+Все бэкенды работают через llm_gateway (дедлайны, повторы, автомат защиты).
+"""
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from history_window import count_tokens
+from llm_gateway import LLMGateway, create_gateway
+
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'openai')
+LLM_BASE_URL = os.environ.get('LLM_BASE_URL', '')
+
+# Параметры заглушки: медиана и разброс (sigma логнормального распределения)
+# времени до первого токена, средняя скорость генерации и ее разброс
+LLM_FAKE_TTFT_MS = float(os.environ.get('LLM_FAKE_TTFT_MS', '400'))
+LLM_FAKE_TTFT_SIGMA = float(os.environ.get('LLM_FAKE_TTFT_SIGMA', '0.5'))
+LLM_FAKE_TOKENS_PER_SEC = float(os.environ.get('LLM_FAKE_TOKENS_PER_SEC', '60'))
+LLM_FAKE_TOKENS_JITTER = float(os.environ.get('LLM_FAKE_TOKENS_JITTER', '0.2'))
+# Доля вызовов, завершающихся ошибкой 503 (проверка повторов и автомата защиты)
+LLM_FAKE_ERROR_RATE = float(os.environ.get('LLM_FAKE_ERROR_RATE', '0'))
+LLM_FAKE_SEED = int(os.environ.get('LLM_FAKE_SEED', '42'))
+
+# Минимальная длина префикса, который провайдер кэширует (токены)
+PREFIX_CACHE_MIN_TOKENS = 1024
+
+_FAKE_WORDS = ('понимаю', 'расскажите', 'подробнее', 'что', 'вы', 'чувствуете', 'когда', 'эта', 'мысль',
+               'появляется', 'какая', 'идея', 'стоит', 'за', 'этой', 'эмоцией', 'ситуация', 'важно',
+               'давайте', 'разберем', 'это', 'вызывает', 'у', 'вас', 'тревогу')
+
+
+class APIStatusError(Exception):
+    """Ошибка заглушки с HTTP-статусом (как openai.APIStatusError)"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = None
+
+
+class APITimeoutError(Exception):
+    """Таймаут вызова заглушки (как openai.APITimeoutError)"""
+
+
+class FakeLLM:
+    """Детерминированная генерация ответов и задержек без обращения к сети"""
+
+    def __init__(self, ttft_ms=LLM_FAKE_TTFT_MS, ttft_sigma=LLM_FAKE_TTFT_SIGMA,
+                 tokens_per_sec=LLM_FAKE_TOKENS_PER_SEC, tokens_jitter=LLM_FAKE_TOKENS_JITTER,
+                 error_rate=LLM_FAKE_ERROR_RATE, seed=LLM_FAKE_SEED):
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.tokens_per_sec = tokens_per_sec
+        self.tokens_jitter = tokens_jitter
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        # Задержки и ошибки - из отдельного генератора с фиксированным seed:
+        # распределение воспроизводимо от запуска к запуску
+        self._timing = random.Random(seed)
+        self._seen_prefixes = set()
+
+    def complete(self, model, messages, max_tokens=256, response_format=None) -> dict:
+        """План ответа: текст по токенам, usage и задержки"""
+        payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True)
+        rng = random.Random(hashlib.sha256(payload.encode('utf-8')).hexdigest())
+        text = self._text(rng, messages, max_tokens or 256, response_format)
+        tokens = [piece + ' ' for piece in text.split(' ')]
+        tokens[-1] = tokens[-1][:-1]
+
+        with self._lock:
+            ttft = self.ttft_ms / 1000 * math.exp(self._timing.gauss(0, self.ttft_sigma))
+            rate = max(1.0, self._timing.gauss(self.tokens_per_sec, self.tokens_per_sec * self.tokens_jitter))
+            failed = self._timing.random() < self.error_rate
+            # Кэш префикса как у провайдера: повторный первый системный промпт
+            prefix = messages[0]['content'] if messages else ''
+            prefix_tokens = count_tokens(prefix)
+            cached = prefix in self._seen_prefixes and prefix_tokens >= PREFIX_CACHE_MIN_TOKENS
+            self._seen_prefixes.add(prefix)
+
+        prompt_tokens = sum(count_tokens(m.get('content') or '') + 4 for m in messages)
+        return {
+            'text': text,
+            'tokens': tokens,
+            'ttft': ttft,
+            'token_delay': 1.0 / rate,
+            'failed': failed,
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': len(tokens),
+                'total_tokens': prompt_tokens + len(tokens),
+                'prompt_tokens_details': {'cached_tokens': prefix_tokens if cached else 0},
+            },
+        }
+
+    @staticmethod
+    def _text(rng, messages, max_tokens, response_format):
+        if response_format and response_format.get('type') == 'json_schema':
+            schema = response_format['json_schema']['schema']
+            return json.dumps(_fake_json(rng, schema), ensure_ascii=False)
+        system = messages[0].get('content', '') if messages else ''
+        if 'JSON' in system:
+            return '{}'
+        words = [rng.choice(_FAKE_WORDS) for _ in range(min(max_tokens, rng.randint(8, 60)))]
+        if 'через запятую' in system:
+            return ', '.join(words[:rng.randint(1, 3)])
+        return ' '.join(words).capitalize() + '?'
+
+
+def _fake_json(rng, schema):
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: _fake_json(rng, sub) for name, sub in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [_fake_json(rng, schema.get('items', {})) for _ in range(rng.randint(0, 2))]
+    return ' '.join(rng.choice(_FAKE_WORDS) for _ in range(rng.randint(3, 12)))
+
+
+def _sleep(seconds, deadline_at):
+    if deadline_at is not None and time.monotonic() + seconds > deadline_at:
+        time.sleep(max(0.0, deadline_at - time.monotonic()))
+        raise APITimeoutError('Request timed out.')
+    time.sleep(seconds)
+
+
+class FakeLLMClient:
+    """Клиент с интерфейсом OpenAI поверх FakeLLM (обычный и потоковый режим)"""
+
+    def __init__(self, llm=None):
+        self.llm = llm or FakeLLM()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, max_tokens=256, stream=False, timeout=None, response_format=None,
+               stream_options=None, **kwargs):
+        plan = self.llm.complete(model, messages, max_tokens, response_format)
+        deadline_at = time.monotonic() + timeout if timeout else None
+        _sleep(plan['ttft'], deadline_at)
+        if plan['failed']:
+            raise APIStatusError('Service Unavailable (fake)', 503)
+        if stream:
+            include_usage = bool(stream_options and stream_options.get('include_usage'))
+            return self._stream(plan, include_usage)
+        _sleep(plan['token_delay'] * len(plan['tokens']), deadline_at)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, finish_reason='stop',
+                                     message=SimpleNamespace(role='assistant', content=plan['text']))],
+            usage=_usage(plan['usage'])
+        )
+
+    @staticmethod
+    def _stream(plan, include_usage):
+        for token in plan['tokens']:
+            time.sleep(plan['token_delay'])
+            yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=token))],
+                                  usage=None)
+        if include_usage:
+            yield SimpleNamespace(choices=[], usage=_usage(plan['usage']))
+
+
+def _usage(usage):
+    return SimpleNamespace(
+        prompt_tokens=usage['prompt_tokens'],
+        completion_tokens=usage['completion_tokens'],
+        total_tokens=usage['total_tokens'],
+        prompt_tokens_details=SimpleNamespace(**usage['prompt_tokens_details'])
+    )
+
+
+def create_llm_client(kind=LLM_BACKEND, api_key=''):
+    """Клиент LLM за шлюзом llm_gateway; None - если для бэкенда нет ключа"""
+    if kind == 'openai':
+        return create_gateway(api_key) if api_key else None
+    if kind == 'compatible':
+        if not LLM_BASE_URL:
+            raise ValueError("Для LLM_BACKEND=compatible нужен LLM_BASE_URL")
+        # Локальным серверам ключ обычно не нужен, но SDK требует непустой
+        return create_gateway(api_key or 'local', base_url=LLM_BASE_URL)
+    if kind == 'fake':
+        return LLMGateway(FakeLLMClient())
+    raise ValueError(f"Неизвестный LLM_BACKEND: {kind}")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_llm_client(api_key='', kind=LLM_BACKEND):
+    """Общий клиент процесса для бэкенда и ключа: один HTTP-пул и один автомат защиты"""
+    with _clients_lock:
+        key = (kind, api_key)
+        if key not in _clients:
+            _clients[key] = create_llm_client(kind, api_key)
+        return _clients[key]
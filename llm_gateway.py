@@ -0,0 +1,266 @@
+"""Шлюз к OpenAI: общий HTTP-пул, дедлайны, повторы с джиттером, автомат защиты.
+
+Шлюз повторяет интерфейс клиента (gateway.chat.completions.create(...)),
+поэтому места вызова не меняются. Отличия от голого клиента:
+- один httpx-клиент с keep-alive на процесс вместо нового соединения;
+- дедлайн на весь вызов вместе с повторами (LLM_DEADLINE или timeout=...);
+- повторы на 429/5xx/обрыв соединения с экспоненциальной задержкой и
+  полным джиттером (учитывается Retry-After);
+- автомат защиты (circuit breaker): после LLM_BREAKER_THRESHOLD ошибок
+  подряд вызовы сразу отклоняются на LLM_BREAKER_COOLDOWN секунд, а шлюз
+  становится ложным (bool(gateway) is False) - код с проверкой
+  `if self.openai_client:` уходит на эвристики без ожидания таймаутов.
+  После паузы пропускается один пробный вызов. Обрыв потокового ответа
+  (stream=True) посреди чтения тоже считается ошибкой API.
+"""
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+# Дедлайн одного вызова вместе с повторами и таймаут одной попытки (секунды)
+LLM_DEADLINE = float(os.environ.get('LLM_DEADLINE', '45'))
+LLM_ATTEMPT_TIMEOUT = float(os.environ.get('LLM_ATTEMPT_TIMEOUT', '30'))
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', '5'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '3'))
+# База и потолок экспоненциальной задержки между повторами (секунды)
+LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', '0.5'))
+LLM_BACKOFF_CAP = float(os.environ.get('LLM_BACKOFF_CAP', '8'))
+LLM_BREAKER_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+# Пул HTTP-соединений к API
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', '20'))
+LLM_MAX_KEEPALIVE = int(os.environ.get('LLM_MAX_KEEPALIVE', '10'))
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpenError(Exception):
+    """Автомат защиты разомкнут: вызов к API не выполнялся"""
+
+
+class DeadlineExceededError(Exception):
+    """Дедлайн вызова истек до успешной попытки"""
+
+
+class CircuitBreaker:
+    """Автомат защиты: closed -> open после серии ошибок -> half_open (одна проба)"""
+
+    def __init__(self, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def available(self) -> bool:
+        """Можно ли сейчас обращаться к API (без захвата пробы)"""
+        with self._lock:
+            state = self._state()
+            return state == 'closed' or (state == 'half_open' and not self._probe_in_flight)
+
+    def acquire(self) -> bool:
+        """Разрешение на вызов; в half_open пропускается только одна проба"""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or self._failures >= self.threshold:
+                if self._opened_at is None or self._probe_in_flight:
+                    print(f"[LLMGateway] Автомат защиты разомкнут на {self.cooldown:.0f} с "
+                          f"(ошибок подряд: {self._failures})")
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+def _is_retryable(error) -> bool:
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    # Обрыв соединения и таймаут (APIConnectionError, APITimeoutError)
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class _GuardedStream:
+    """Потоковый ответ: исход сообщается автомату защиты, когда поток дочитан или оборвался"""
+
+    def __init__(self, stream, gateway):
+        self._stream = stream
+        self._gateway = gateway
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        except GeneratorExit:
+            # Читатель остановился сам - API отвечал
+            self._gateway.breaker.record_success()
+            raise
+        except Exception as e:
+            self._gateway._on_stream_error(e)
+            raise
+        self._gateway.breaker.record_success()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        close = getattr(self._stream, 'close', None)
+        if close:
+            close()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class LLMGateway:
+    """Шлюз поверх OpenAI-клиента: дедлайны, повторы с задержкой, счетчики и автомат"""
+
+    def __init__(self, client, breaker=None, deadline=LLM_DEADLINE, attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+                 max_retries=LLM_MAX_RETRIES):
+        self.client = client
+        self.breaker = breaker or CircuitBreaker()
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max(0, max_retries)
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0, 'stream_failures': 0}
+        # Интерфейс клиента OpenAI: gateway.chat.completions.create(...)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def __bool__(self):
+        return self.breaker.available()
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _start(self, kwargs):
+        """Проверяет автомат и возвращает момент дедлайна вызова"""
+        self._count('calls')
+        if not self.breaker.acquire():
+            self._count('rejected')
+            raise CircuitOpenError('LLM API временно недоступен (автомат защиты разомкнут)')
+        deadline = kwargs.pop('timeout', None) or self.deadline
+        return time.monotonic() + deadline
+
+    def _attempt_timeout(self, deadline_at):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededError('Дедлайн вызова LLM истек')
+        return min(self.attempt_timeout, remaining)
+
+    def _on_error(self, error, attempt, deadline_at):
+        """Задержка перед следующей попыткой или None, если повторять нельзя"""
+        retryable = _is_retryable(error) or isinstance(error, DeadlineExceededError)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            # Ошибка запроса (400/401/...) - API доступен, автомат не трогаем
+            self.breaker.record_success()
+        if not retryable or attempt >= self.max_retries or isinstance(error, DeadlineExceededError):
+            self._count('failures')
+            return None
+        delay = _retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * (2 ** attempt)))
+        if time.monotonic() + delay >= deadline_at or not self.breaker.acquire():
+            self._count('failures')
+            return None
+        self._count('retries')
+        print(f"[LLMGateway] Повтор {attempt + 1}/{self.max_retries} через {delay:.2f} с: {error}")
+        return delay
+
+    def _on_stream_error(self, error):
+        """Обрыв потока после открытия: повторить нельзя (часть текста уже отдана).
+
+        Запрос уже принят API, поэтому любая ошибка чтения - сбой API или сети.
+        """
+        self._count('stream_failures')
+        self.breaker.record_failure()
+        print(f"[LLMGateway] Обрыв потокового ответа: {error}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, breaker=self.breaker.state)
+
+    def create(self, **kwargs):
+        """chat.completions.create с дедлайном, повторами и автоматом защиты.
+
+        Для stream=True повторяется только открытие потока; обрыв при чтении
+        сообщается автомату защиты.
+        """
+        deadline_at = self._start(kwargs)
+        attempt = 0
+        while True:
+            try:
+                timeout = self._attempt_timeout(deadline_at)
+                response = self.client.chat.completions.create(timeout=timeout, **kwargs)
+                if kwargs.get('stream'):
+                    # Успех засчитывается, когда поток дочитан: обрыв посреди чтения - ошибка
+                    return _GuardedStream(response, self)
+                self.breaker.record_success()
+                return response
+            except Exception as e:
+                delay = self._on_error(e, attempt, deadline_at)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+
+def _limits():
+    import httpx
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE)
+
+
+def _timeout():
+    import httpx
+    return httpx.Timeout(LLM_ATTEMPT_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+def create_gateway(api_key: str, **client_kwargs) -> LLMGateway:
+    """OpenAI-клиент с общим keep-alive пулом, обернутый в LLMGateway"""
+    import httpx
+    from openai import OpenAI
+    http_client = httpx.Client(limits=_limits(), timeout=_timeout())
+    # Повторы делает шлюз: встроенные повторы SDK отключены
+    client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0, **client_kwargs)
+    return LLMGateway(client)
+
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест обработчиков Socket.IO message и map_message без сети и затрат.
+
+По умолчанию использует LLM_BACKEND=fake (детерминированная заглушка с
+задержками из LLM_FAKE_*) и временную SQLite базу. Виртуальные пользователи
+работают параллельно через тестовые клиенты Flask-SocketIO: каждый создает
+сессию и проводит несколько ходов диалога (message) или проходит сценарий
+Нейрокарты (map_message). Печатаются перцентили задержки ответа, время до
+первого фрагмента, пропускная способность и счетчики шлюза LLM.
+
+Запуск: python load_test.py [--users 20] [--turns 5] [--map-users 10]
+Против mock_llm_server.py: LLM_BACKEND=compatible LLM_BASE_URL=http://127.0.0.1:8089/v1 python load_test.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('LLM_BACKEND', 'fake')
+
+CHAT_SCRIPT = [
+    'Мне тревожно и грустно последнее время',
+    'Тревога и грусть',
+    'Завтра важная встреча с начальником на работе',
+    'Я думаю, что не справлюсь и меня уволят, потому что я недостаточно хорош',
+    'Потому что в детстве мне говорили, что я все делаю не так',
+    'Наверное, родители',
+    'Чтобы я слушался',
+    'Мне становится тяжело дышать и не хочется ничего делать',
+]
+
+MAP_SCRIPT = [
+    'старт',
+    'одна',
+    'тревога',
+    'завтра важная встреча с начальником',
+    'я думаю, что обязательно не справлюсь с задачей и меня уволят с работы',
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def wait_for(sio, names, timeout, session_id=None):
+    """Ждет событие из names; возвращает (событие, время первого response_chunk)"""
+    deadline = time.monotonic() + timeout
+    first_chunk = None
+    while time.monotonic() < deadline:
+        for event in sio.get_received():
+            args = event['args'][0] if event['args'] else {}
+            if session_id is not None and isinstance(args, dict) and args.get('session_id') not in (None, session_id):
+                continue
+            if event['name'] == 'response_chunk' and first_chunk is None:
+                first_chunk = time.monotonic()
+            if event['name'] in names:
+                return event, first_chunk
+        time.sleep(0.005)
+    return None, first_chunk
+
+
+def login(app, user_id, username):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+        sess['username'] = username
+    return client
+
+
+def chat_user(app, socketio, user_id, turns, timeout, results):
+    client = login(app, user_id, f'load_user_{user_id}')
+    session_id = client.post('/api/sessions').get_json()['id']
+    sio = socketio.test_client(app, flask_test_client=client)
+    for turn in range(turns):
+        message = CHAT_SCRIPT[turn % len(CHAT_SCRIPT)]
+        started = time.monotonic()
+        sio.emit('message', {'session_id': session_id, 'message': message, 'stream': True})
+        event, first_chunk = wait_for(sio, ('response', 'error'), timeout, session_id)
+        finished = time.monotonic()
+        with results['lock']:
+            if event is None:
+                results['chat_timeouts'] += 1
+            elif event['name'] == 'error':
+                results['chat_errors'] += 1
+            else:
+                results['chat_latency'].append(finished - started)
+                if first_chunk is not None:
+                    results['chat_ttfb'].append(first_chunk - started)
+    sio.disconnect()
+
+
+def map_user(app, socketio, user_id, timeout, results):
+    client = login(app, user_id, f'load_user_{user_id}')
+    sio = socketio.test_client(app, flask_test_client=client)
+    for message in MAP_SCRIPT:
+        started = time.monotonic()
+        sio.emit('map_message', {'message': message})
+        event, _ = wait_for(sio, ('map_response', 'map_error'), timeout)
+        finished = time.monotonic()
+        with results['lock']:
+            if event is None:
+                results['map_timeouts'] += 1
+            elif event['name'] == 'map_error':
+                results['map_errors'] += 1
+            else:
+                results['map_latency'].append(finished - started)
+    sio.disconnect()
+
+
+def report(name, values):
+    if not values:
+        print(f"{name:<28} нет данных")
+        return
+    print(f"{name:<28} n={len(values):<5} p50={percentile(values, 50) * 1000:8.1f} мс  "
+          f"p95={percentile(values, 95) * 1000:8.1f} мс  p99={percentile(values, 99) * 1000:8.1f} мс  "
+          f"max={max(values) * 1000:8.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест message/map_message')
+    parser.add_argument('--users', type=int, default=20, help='параллельных пользователей чата')
+    parser.add_argument('--turns', type=int, default=5, help='ходов диалога на пользователя')
+    parser.add_argument('--map-users', type=int, default=10, help='параллельных пользователей Нейрокарты')
+    parser.add_argument('--timeout', type=float, default=120, help='ожидание одного ответа (секунды)')
+    parser.add_argument('--db', help='путь к SQLite базе (по умолчанию - временная)')
+    args = parser.parse_args()
+
+    # База выбирается до импорта app: init_db() выполняется при импорте
+    import db_pool
+    if not os.environ.get('DATABASE_URL'):
+        db_pool.DB_PATH = args.db or os.path.join(tempfile.mkdtemp(prefix='load_test_'), 'load_test.db')
+        print(f"База: {db_pool.DB_PATH}")
+    from app import app, socketio
+    from db_pool import db_connection
+    from psychologist_ai import LLM_BACKEND
+    from llm_cache import llm_cache
+    app.config['TESTING'] = True
+
+    total_users = args.users + args.map_users
+    user_ids = []
+    with db_connection() as conn:
+        c = conn.cursor()
+        run_tag = int(time.time())
+        for i in range(total_users):
+            c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                      (f'load_{run_tag}_{i}', 'x'))
+            user_ids.append(c.lastrowid)
+
+    results = {'lock': threading.Lock(), 'chat_latency': [], 'chat_ttfb': [], 'map_latency': [],
+               'chat_errors': 0, 'chat_timeouts': 0, 'map_errors': 0, 'map_timeouts': 0}
+    threads = [threading.Thread(target=chat_user, args=(app, socketio, uid, args.turns, args.timeout, results))
+               for uid in user_ids[:args.users]]
+    threads += [threading.Thread(target=map_user, args=(app, socketio, uid, args.timeout, results))
+                for uid in user_ids[args.users:]]
+
+    print(f"Бэкенд LLM: {LLM_BACKEND}; пользователей чата: {args.users} x {args.turns} ходов, "
+          f"Нейрокарты: {args.map_users}")
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    print()
+    report('message: ответ целиком', results['chat_latency'])
+    report('message: первый фрагмент', results['chat_ttfb'])
+    report('map_message: ответ', results['map_latency'])
+    completed = len(results['chat_latency']) + len(results['map_latency'])
+    print(f"\nВремя: {elapsed:.1f} с, ответов: {completed} ({completed / elapsed:.1f}/с)")
+    print(f"Ошибки: message {results['chat_errors']} (таймаутов {results['chat_timeouts']}), "
+          f"map_message {results['map_errors']} (таймаутов {results['map_timeouts']})")
+
+    from app import psychologist_ai
+    if psychologist_ai.openai_client is not None:
+        print(f"Шлюз LLM: {psychologist_ai.openai_client.stats()}")
+    print(f"Кэш префикса по этапам: {psychologist_ai.get_prompt_cache_stats()}")
+    if llm_cache is not None:
+        print(f"Кэш экстракторов: {llm_cache.stats()}")
+    from persistence_queue import queue_stats
+    print(f"Очереди записи: {queue_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
-"""MLM система для реферальной программы"""
-import sqlite3
+"""MLM система для реферальной программы.
+
+Таблица referrals - таблица замыкания: строка (referrer_id, referred_id, level)
+есть для каждого вышестоящего реферера пользователя до REFERRAL_MAX_LEVEL,
+level 1 - прямой реферер. Вся цепочка вверх читается одним запросом по
+referred_id, а новая цепочка при регистрации строится одним INSERT ... SELECT
+из цепочки реферера (level + 1).
+
+Проверка и восстановление таблицы замыкания по связям первого уровня:
+python mlm_system.py --check | --rebuild
+"""
 import secrets
 import uuid
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
+from db_dialect import IntegrityError
+from db_pool import db_connection, get_db
 
 # Проценты по уровням
 REFERRAL_PERCENTAGES = {
@@ -16,94 +27,184 @@ REFERRAL_PERCENTAGES = {
     8: 0.01,  # 1%
 }
 
-def get_db():
-    """Получает соединение с базой данных"""
-    import os
-    db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psychologist.db')
-    return sqlite3.connect(db_path)
+REFERRAL_MAX_LEVEL = max(REFERRAL_PERCENTAGES)
+
+# Проценты в базисных пунктах (0.01%): комиссии считаются в целых копейках
+REFERRAL_BASIS_POINTS = {level: int(Decimal(str(p)) * 10000) for level, p in REFERRAL_PERCENTAGES.items()}
+
+def to_minor(amount) -> int:
+    """Сумма в копейках (округление до копейки по правилам арифметики)"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_minor(minor) -> Decimal:
+    return Decimal(int(minor)).scaleb(-2)
 
 def generate_referral_code():
     """Генерирует уникальный реферальный код"""
     return secrets.token_urlsafe(8).upper()[:10]
 
-def create_referral_structure(user_id, referrer_code=None):
-    """Создает реферальную структуру для нового пользователя"""
-    conn = get_db()
-    c = conn.cursor()
+def create_referral_structure(user_id, referrer_code=None, c=None):
+    """Создает реферальную структуру для нового пользователя.
+
+    Прямой реферер (уровень 1) и его цепочка (уровень + 1, не глубже
+    REFERRAL_MAX_LEVEL) вставляются одним запросом. С курсором c запись идет
+    в транзакции вызывающего (фиксирует он); возвращает число созданных связей.
+    """
+    if not referrer_code:
+        return 0
+    if c is None:
+        with db_connection() as conn:
+            return create_referral_structure(user_id, referrer_code, conn.cursor())
     
-    if referrer_code:
-        # Находим реферера
-        c.execute('SELECT id FROM users WHERE referral_code = ?', (referrer_code,))
-        referrer = c.fetchone()
-        
-        if referrer:
-            referrer_id = referrer[0]
-            # Создаем связи для всех уровней (до 8 уровня)
-            current_parent = referrer_id
-            for level in range(1, 9):  # Уровни 1-8
-                if current_parent:
-                    c.execute('''INSERT OR IGNORE INTO referrals 
-                                 (referrer_id, referred_id, level) 
-                                 VALUES (?, ?, ?)''', 
-                             (current_parent, user_id, level))
-                    
-                    # Находим родителя текущего родителя для следующего уровня
-                    if level < 8:
-                        c.execute('''SELECT referrer_id FROM referrals 
-                                     WHERE referred_id = ? AND level = 1 
-                                     LIMIT 1''', (current_parent,))
-                        parent = c.fetchone()
-                        current_parent = parent[0] if parent else None
-                    else:
-                        break
+    c.execute('''INSERT OR IGNORE INTO referrals (referrer_id, referred_id, level)
+                 SELECT u.id, ?, 1 FROM users u
+                 WHERE u.referral_code = ? AND u.id <> ?
+                 UNION ALL
+                 SELECT r.referrer_id, ?, r.level + 1 FROM referrals r
+                 JOIN users u ON r.referred_id = u.id
+                 WHERE u.referral_code = ? AND r.level < ? AND r.referrer_id <> ?''',
+             (user_id, referrer_code, user_id, user_id, referrer_code, REFERRAL_MAX_LEVEL, user_id))
+    return max(c.rowcount, 0)
+
+# Ожидаемая таблица замыкания, построенная по связям первого уровня
+_EXPECTED_CLOSURE = '''WITH RECURSIVE expected (referrer_id, referred_id, level) AS (
+                          SELECT referrer_id, referred_id, 1 FROM referrals WHERE level = 1
+                          UNION ALL
+                          SELECT p.referrer_id, e.referred_id, e.level + 1
+                          FROM expected e
+                          JOIN referrals p ON p.referred_id = e.referrer_id AND p.level = 1
+                          WHERE e.level < ?
+                      )'''
+
+def check_referral_closure(c=None):
+    """Сверяет таблицу замыкания со связями первого уровня.
+
+    Возвращает {'missing': [...], 'extra': [...], 'multiple_referrers': [...]}:
+    недостающие и лишние строки (referrer_id, referred_id, level) и пользователи
+    с несколькими прямыми реферерами.
+    """
+    if c is None:
+        with db_connection() as conn:
+            return check_referral_closure(conn.cursor())
     
-    conn.commit()
-    conn.close()
+    c.execute(_EXPECTED_CLOSURE + '''
+                 SELECT DISTINCT referrer_id, referred_id, level FROM expected e
+                 WHERE NOT EXISTS (SELECT 1 FROM referrals r
+                                   WHERE r.referrer_id = e.referrer_id AND r.referred_id = e.referred_id
+                                     AND r.level = e.level)
+                 ORDER BY referred_id, level''', (REFERRAL_MAX_LEVEL,))
+    missing = [tuple(row) for row in c.fetchall()]
+    c.execute(_EXPECTED_CLOSURE + '''
+                 SELECT referrer_id, referred_id, level FROM referrals r
+                 WHERE r.level > 1 AND NOT EXISTS (SELECT 1 FROM expected e
+                                                   WHERE e.referrer_id = r.referrer_id
+                                                     AND e.referred_id = r.referred_id
+                                                     AND e.level = r.level)
+                 ORDER BY referred_id, level''', (REFERRAL_MAX_LEVEL,))
+    extra = [tuple(row) for row in c.fetchall()]
+    c.execute('''SELECT referred_id FROM referrals WHERE level = 1
+                 GROUP BY referred_id HAVING COUNT(*) > 1 ORDER BY referred_id''')
+    multiple = [row[0] for row in c.fetchall()]
+    return {'missing': missing, 'extra': extra, 'multiple_referrers': multiple}
 
-def process_payment(user_id, amount):
-    """Обрабатывает платеж и распределяет комиссии по реферальной структуре"""
-    conn = get_db()
-    c = conn.cursor()
+def rebuild_referral_closure(c=None):
+    """Приводит таблицу замыкания к связям первого уровня: удаляет лишние строки
+    и добавляет недостающие (даты существующих связей сохраняются)"""
+    if c is None:
+        with db_connection() as conn:
+            return rebuild_referral_closure(conn.cursor())
+    
+    report = check_referral_closure(c)
+    if report['extra']:
+        c.executemany('''DELETE FROM referrals
+                         WHERE referrer_id = ? AND referred_id = ? AND level = ?''', report['extra'])
+    if report['missing']:
+        # При нескольких прямых реферерах часть связей не встанет: UNIQUE(referrer_id, referred_id)
+        c.executemany('''INSERT OR IGNORE INTO referrals (referrer_id, referred_id, level)
+                         VALUES (?, ?, ?)''', report['missing'])
+    return report
+
+def process_payment(user_id, amount, payment_id=None, c=None):
+    """Обрабатывает платеж и распределяет комиссии по реферальной структуре.
+
+    Комиссии считаются в копейках (с округлением вниз) и записываются
+    пакетно: транзакции одним executemany, балансы одним upsert. payment_id -
+    ключ идемпотентности в пределах пользователя: повтор того же платежа не
+    начисляет комиссии повторно и возвращает уже созданные. Без payment_id
+    платеж считается новым. С курсором c запись идет в транзакции вызывающего.
+    """
+    payment_id = payment_id or uuid.uuid4().hex
+    if c is None:
+        try:
+            with db_connection() as conn:
+                return process_payment(user_id, amount, payment_id, conn.cursor())
+        except IntegrityError:
+            # Параллельный повтор того же платежа успел записать комиссии раньше
+            with db_connection() as conn:
+                existing = get_payment_transactions(user_id, payment_id, conn.cursor())
+            if existing:
+                return existing
+            raise
     
-    # Находим всех рефереров на разных уровнях
+    existing = get_payment_transactions(user_id, payment_id, c)
+    if existing:
+        return existing
+    
+    # Все рефереры пользователя по уровням - одна выборка из таблицы замыкания
     c.execute('''SELECT referrer_id, level FROM referrals 
-                 WHERE referred_id = ? 
-                 ORDER BY level ASC''', (user_id,))
-    referrers = c.fetchall()
+                 WHERE referred_id = ? AND level <= ?
+                 ORDER BY level ASC''', (user_id, REFERRAL_MAX_LEVEL))
+    amount_minor = to_minor(amount)
+    commissions = []
+    for referrer_id, level in c.fetchall():
+        if level in REFERRAL_BASIS_POINTS:
+            commission_minor = amount_minor * REFERRAL_BASIS_POINTS[level] // 10000
+            if commission_minor > 0:
+                commissions.append((referrer_id, level, commission_minor))
+    if not commissions:
+        return []
     
-    transactions = []
+    # Транзакции: уникальный idempotency_key не даст записать платеж дважды
+    c.executemany('''INSERT INTO transactions 
+                     (user_id, amount, amount_minor, transaction_type, referral_level, from_user_id,
+                      description, idempotency_key) 
+                     VALUES (?, ?, ?, 'referral_commission', ?, ?, ?, ?)''',
+                  [(referrer_id, float(from_minor(minor)), minor, level, user_id,
+                    f'Комиссия {REFERRAL_BASIS_POINTS[level] / 100}% с уровня {level}',
+                    _idempotency_key(user_id, payment_id, level))
+                   for referrer_id, level, minor in commissions])
     
-    for referrer_id, level in referrers:
-        if level in REFERRAL_PERCENTAGES:
-            commission = Decimal(str(amount)) * Decimal(str(REFERRAL_PERCENTAGES[level]))
-            
-            # Обновляем баланс реферера
-            c.execute('''UPDATE balances 
-                         SET amount = amount + ?, updated_at = CURRENT_TIMESTAMP 
-                         WHERE user_id = ?''', (float(commission), referrer_id))
-            
-            # Если баланса нет, создаем
-            if c.rowcount == 0:
-                c.execute('INSERT INTO balances (user_id, amount) VALUES (?, ?)', 
-                         (referrer_id, float(commission)))
-            
-            # Создаем транзакцию
-            c.execute('''INSERT INTO transactions 
-                         (user_id, amount, transaction_type, referral_level, from_user_id, description) 
-                         VALUES (?, ?, 'referral_commission', ?, ?, ?)''',
-                     (referrer_id, float(commission), level, user_id, 
-                      f'Комиссия {REFERRAL_PERCENTAGES[level]*100}% с уровня {level}'))
-            
-            transactions.append({
-                'referrer_id': referrer_id,
-                'level': level,
-                'amount': float(commission),
-                'percentage': REFERRAL_PERCENTAGES[level] * 100
-            })
+    # Балансы: прибавка или создание строки одним upsert
+    c.executemany('''INSERT INTO balances (user_id, amount, amount_minor) VALUES (?, ?, ?)
+                     ON CONFLICT (user_id) DO UPDATE
+                     SET amount_minor = balances.amount_minor + excluded.amount_minor,
+                         amount = (balances.amount_minor + excluded.amount_minor) / 100.0,
+                         updated_at = CURRENT_TIMESTAMP''',
+                  [(referrer_id, float(from_minor(minor)), minor) for referrer_id, _, minor in commissions])
     
-    conn.commit()
-    conn.close()
-    return transactions
+    return [_commission(referrer_id, level, minor) for referrer_id, level, minor in commissions]
+
+def _idempotency_key(user_id, payment_id, level):
+    return f'payment:{user_id}:{payment_id}:{level}'
+
+def _commission(referrer_id, level, minor):
+    return {
+        'referrer_id': referrer_id,
+        'level': level,
+        'amount': float(from_minor(minor)),
+        'percentage': REFERRAL_BASIS_POINTS[level] / 100
+    }
+
+def get_payment_transactions(user_id, payment_id, c=None):
+    """Комиссии, уже записанные по платежу payment_id пользователя user_id"""
+    if c is None:
+        with db_connection() as conn:
+            return get_payment_transactions(user_id, payment_id, conn.cursor())
+    keys = [_idempotency_key(user_id, payment_id, level) for level in REFERRAL_PERCENTAGES]
+    c.execute(f'''SELECT user_id, referral_level, amount_minor FROM transactions
+                  WHERE idempotency_key IN ({', '.join('?' * len(keys))})
+                  ORDER BY referral_level''', keys)
+    return [_commission(*row) for row in c.fetchall()]
 
 def get_referral_tree(user_id):
     """Получает дерево рефералов пользователя"""
@@ -135,16 +236,17 @@ def get_user_balance(user_id):
     """Получает баланс пользователя"""
     conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT amount FROM balances WHERE user_id = ?', (user_id,))
+    c.execute('SELECT amount_minor FROM balances WHERE user_id = ?', (user_id,))
     row = c.fetchone()
     conn.close()
-    return float(row[0]) if row else 0.0
+    return float(from_minor(row[0])) if row else 0.0
 
 def get_user_transactions(user_id, limit=50):
     """Получает транзакции пользователя"""
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT id, amount, transaction_type, referral_level, from_user_id, description, created_at
+    c.execute('''SELECT id, COALESCE(amount_minor, CAST(ROUND(amount * 100) AS INTEGER)),
+                        transaction_type, referral_level, from_user_id, description, created_at
                  FROM transactions
                  WHERE user_id = ?
                  ORDER BY created_at DESC
@@ -154,7 +256,7 @@ def get_user_transactions(user_id, limit=50):
     for row in c.fetchall():
         transactions.append({
             'id': row[0],
-            'amount': float(row[1]),
+            'amount': float(from_minor(row[1])),
             'type': row[2],
             'level': row[3],
             'from_user_id': row[4],
@@ -166,6 +268,15 @@ def get_user_transactions(user_id, limit=50):
     return transactions
 
 
-
-
-
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] in ('--check', '--rebuild'):
+        result = check_referral_closure() if sys.argv[1] == '--check' else rebuild_referral_closure()
+        print(f"Недостающих связей: {len(result['missing'])}, лишних: {len(result['extra'])}, "
+              f"пользователей с несколькими прямыми реферерами: {len(result['multiple_referrers'])}")
+        for user_id in result['multiple_referrers']:
+            print(f"  несколько прямых рефереров у пользователя {user_id}")
+        if sys.argv[1] == '--rebuild':
+            print("Таблица замыкания восстановлена")
+    else:
+        print("Использование: python mlm_system.py --check | --rebuild")
@@ -0,0 +1,101 @@
+"""Локальный OpenAI-совместимый сервер на заглушке FakeLLM (без сети и затрат).
+
+Отвечает на POST /v1/chat/completions (обычный ответ и SSE-поток).
+Приложение подключается к нему как к любому совместимому серверу:
+
+    python mock_llm_server.py --port 8089
+    LLM_BACKEND=compatible LLM_BASE_URL=http://127.0.0.1:8089/v1 python app.py
+
+Задержки и доля ошибок настраиваются переменными LLM_FAKE_* (см. llm_backends.py).
+"""
+import argparse
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_backends import FakeLLM
+
+fake_llm = FakeLLM()
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        plan = fake_llm.complete(body.get('model', 'fake'), body.get('messages', []),
+                                 body.get('max_tokens') or 256, body.get('response_format'))
+        time.sleep(plan['ttft'])
+        if plan['failed']:
+            self._send_json(503, {'error': {'message': 'Service Unavailable (fake)', 'type': 'server_error'}})
+            return
+
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        model = body.get('model', 'fake')
+        if body.get('stream'):
+            self._stream(plan, completion_id, model, bool((body.get('stream_options') or {}).get('include_usage')))
+            return
+        time.sleep(plan['token_delay'] * len(plan['tokens']))
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': plan['text']}}],
+            'usage': plan['usage'],
+        })
+
+    def _stream(self, plan, completion_id, model, include_usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        base = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model}
+        for token in plan['tokens']:
+            time.sleep(plan['token_delay'])
+            self._event(dict(base, choices=[{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]))
+        self._event(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+        if include_usage:
+            self._event(dict(base, choices=[], usage=plan['usage']))
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _event(self, data):
+        self.wfile.write(f'data: {json.dumps(data, ensure_ascii=False)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def _send_json(self, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный OpenAI-совместимый сервер-заглушка')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), ChatCompletionsHandler)
+    print(f"[MockLLM] Слушаю http://{args.host}:{args.port}/v1/chat/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
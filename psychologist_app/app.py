@@ -1,14 +1,21 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g, has_app_context
 from flask_socketio import SocketIO, emit
 from werkzeug.security import generate_password_hash, check_password_hash
-import sqlite3
 import json
 import os
 import uuid
 import secrets
 from datetime import datetime
 from psychologist_ai import PsychologistAI
-from urllib.parse import urlparse
+import db_pool
+from db_pool import unit_of_work
+from db_dialect import IntegrityError
+from db_migrations import apply_migrations
+from history_cache import history_cache, turn_history
+from concept_store import concept_store
+from concept_graph import concept_graphs
+from concept_document import concept_hashes, document_etag
+from turn_queue import turn_queue
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 import requests
@@ -31,8 +38,11 @@ import io
 import base64
 from mlm_system import (
     generate_referral_code, create_referral_structure, 
-    process_payment, get_referral_tree, get_user_balance, get_user_transactions
+    get_referral_tree, get_user_balance, get_user_transactions
 )
+from payment_ledger import PaymentConflictError, ledger_worker, payment_status, record_payment
+from metrics import METRICS_TOKEN, collect_metrics, metrics_reporter, register_metrics
+from persistence_queue import queue_stats
 
 # Получаем абсолютные пути к директориям
 base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -47,428 +57,55 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 socketio = SocketIO(app, cors_allowed_origins="*")
 
-# Инициализация базы данных
-def init_db():
-    # Проверяем, есть ли DATABASE_URL (PostgreSQL на Railway)
-    database_url = os.environ.get('DATABASE_URL')
-    
-    if database_url:
-        # Используем PostgreSQL
-        import psycopg2
-        from psycopg2.extras import RealDictCursor
-        
-        # Парсим DATABASE_URL
-        result = urlparse(database_url)
-        conn = psycopg2.connect(
-            database=result.path[1:],  # Убираем первый /
-            user=result.username,
-            password=result.password,
-            host=result.hostname,
-            port=result.port
-        )
-        c = conn.cursor()
-    else:
-        # Используем SQLite для локальной разработки
-        db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psychologist.db')
-        conn = sqlite3.connect(db_path)
-        c = conn.cursor()
-    
-    # Таблица пользователей
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE NOT NULL,
-                  password_hash TEXT NOT NULL,
-                  referral_code TEXT UNIQUE,
-                  referred_by INTEGER,
-                  user_id TEXT UNIQUE,
-                  language TEXT DEFAULT 'ru',
-                  google_id TEXT UNIQUE,
-                  email TEXT,
-                  full_name TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (referred_by) REFERENCES users (id))''')
-    
-    # Таблица рефералов (MLM структура)
-    c.execute('''CREATE TABLE IF NOT EXISTS referrals
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  referrer_id INTEGER NOT NULL,
-                  referred_id INTEGER NOT NULL,
-                  level INTEGER NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (referrer_id) REFERENCES users (id),
-                  FOREIGN KEY (referred_id) REFERENCES users (id),
-                  UNIQUE(referrer_id, referred_id))''')
-    
-    # Таблица балансов
-    c.execute('''CREATE TABLE IF NOT EXISTS balances
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  amount DECIMAL(10, 2) DEFAULT 0.00,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
-    # Таблица транзакций
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  amount DECIMAL(10, 2) NOT NULL,
-                  transaction_type TEXT NOT NULL,
-                  referral_level INTEGER,
-                  from_user_id INTEGER,
-                  description TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (from_user_id) REFERENCES users (id))''')
-    
-    # Таблица реквизитов
-    c.execute('''CREATE TABLE IF NOT EXISTS payment_details
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL UNIQUE,
-                  full_name TEXT,
-                  phone TEXT,
-                  birth_date DATE,
-                  inn TEXT,
-                  payment_form TEXT,
-                  details_json TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
-    # Таблица сессий
-    c.execute('''CREATE TABLE IF NOT EXISTS sessions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  title TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
-    # Таблица сообщений
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  session_id INTEGER NOT NULL,
-                  role TEXT NOT NULL,
-                  content TEXT NOT NULL,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Таблица систем убеждений
-    c.execute('''CREATE TABLE IF NOT EXISTS concept_hierarchies
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  session_id INTEGER NOT NULL,
-                  concept_data TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Таблица для Нейрокарты
-    # Изменена структура: одна запись = одна комбинация событие-эмоция-идея
-    c.execute('''CREATE TABLE IF NOT EXISTS event_map
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  event_number INTEGER NOT NULL,
-                  event TEXT NOT NULL,
-                  emotion TEXT NOT NULL,
-                  idea TEXT NOT NULL,
-                  is_completed INTEGER DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
-    # Таблица "До и После" для отслеживания убеждений
-    c.execute('''CREATE TABLE IF NOT EXISTS before_after_beliefs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  session_id INTEGER,
-                  belief_before TEXT NOT NULL,
-                  belief_after TEXT,
-                  is_task INTEGER DEFAULT 0,
-                  circle_number INTEGER,
-                  circle_name TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Таблица для обратной связи (баги, скриншоты, видео)
-    c.execute('''CREATE TABLE IF NOT EXISTS feedback
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  session_id INTEGER,
-                  description TEXT NOT NULL,
-                  file_path TEXT,
-                  file_type TEXT,
-                  feedback_type TEXT DEFAULT 'full',
-                  status TEXT DEFAULT 'new',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Таблица для файлов обратной связи (для краткой формы с множественными файлами)
-    c.execute('''CREATE TABLE IF NOT EXISTS feedback_files
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  feedback_id INTEGER NOT NULL,
-                  file_path TEXT NOT NULL,
-                  file_type TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (feedback_id) REFERENCES feedback (id))''')
-    
-    # Таблица для статистики обучения GPT
-    c.execute('''CREATE TABLE IF NOT EXISTS gpt_statistics
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  session_id INTEGER NOT NULL,
-                  user_id INTEGER NOT NULL,
-                  message_count INTEGER DEFAULT 0,
-                  avg_response_time REAL,
-                  user_satisfaction_score REAL,
-                  difficulty_encountered INTEGER DEFAULT 0,
-                  root_beliefs_identified INTEGER DEFAULT 0,
-                  positive_transformations INTEGER DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (session_id) REFERENCES sessions (id),
-                  FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
-    # Таблица для корневых установок
-    c.execute('''CREATE TABLE IF NOT EXISTS root_beliefs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  session_id INTEGER,
-                  circle_number INTEGER NOT NULL,
-                  circle_name TEXT NOT NULL,
-                  negative_belief TEXT NOT NULL,
-                  positive_belief TEXT,
-                  is_task INTEGER DEFAULT 0,
-                  status TEXT DEFAULT 'identified',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Таблица журнала сессий
-    c.execute('''CREATE TABLE IF NOT EXISTS session_journal
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  session_id INTEGER,
-                  date_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  feeling_after TEXT,
-                  emotion_after TEXT,
-                  how_session_went TEXT,
-                  interesting_thoughts TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Таблица интересных мыслей
-    c.execute('''CREATE TABLE IF NOT EXISTS interesting_thoughts
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER NOT NULL,
-                  session_id INTEGER,
-                  thought_number INTEGER NOT NULL,
-                  title TEXT NOT NULL,
-                  thought_text TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users (id),
-                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
-    
-    # Создаем индексы для производительности (после создания всех таблиц)
-    try:
-        c.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_referrals_level ON referrals(level)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)')
-    except sqlite3.OperationalError:
-        # Игнорируем ошибки если таблицы еще не созданы (для совместимости со старыми БД)
-        pass
-    
-    conn.commit()
-    conn.close()
-
-# Инициализация базы данных
-init_db()
-
 def get_db():
-    """Получает соединение с базой данных"""
-    database_url = os.environ.get('DATABASE_URL')
-    
-    if database_url:
-        # Используем PostgreSQL
-        import psycopg2
-        result = urlparse(database_url)
-        conn = psycopg2.connect(
-            database=result.path[1:],
-            user=result.username,
-            password=result.password,
-            host=result.hostname,
-            port=result.port
-        )
-        return conn
-    else:
-        # Используем SQLite для локальной разработки
-        db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psychologist.db')
-        return sqlite3.connect(db_path)
+    """Получает соединение из пула (PostgreSQL при DATABASE_URL, иначе SQLite).
+    
+    close() возвращает соединение в пул; забытые соединения возвращаются
+    автоматически в конце запроса или Socket.IO события.
+    """
+    conn = db_pool.get_db()
+    if has_app_context():
+        g.setdefault('_db_connections', []).append(conn)
+    return conn
+
+@app.teardown_appcontext
+def release_db_connections(exc):
+    """Возвращает в пул соединения, которые обработчик не закрыл сам"""
+    for conn in g.pop('_db_connections', []):
+        conn.close()
 
-def migrate_database():
-    """Миграция базы данных: добавляет недостающие колонки и генерирует коды"""
+# Инициализация базы данных
+def init_db():
+    """Приводит схему к актуальной версии (см. db_migrations.MIGRATIONS)"""
     conn = get_db()
-    c = conn.cursor()
-    
     try:
-        # Проверяем, есть ли колонка referral_code
-        c.execute("PRAGMA table_info(users)")
-        columns = [col[1] for col in c.fetchall()]
-        
-        # Добавляем колонки если их нет
-        if 'referral_code' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN referral_code TEXT')
-            print("[Migration] Добавлена колонка referral_code")
-        
-        if 'user_id' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN user_id TEXT')
-            print("[Migration] Добавлена колонка user_id")
-        
-        if 'referred_by' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN referred_by INTEGER')
-            print("[Migration] Добавлена колонка referred_by")
-        
-        if 'language' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN language TEXT DEFAULT "ru"')
-            print("[Migration] Добавлена колонка language")
-        
-        if 'google_id' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN google_id TEXT')
-            print("[Migration] Добавлена колонка google_id")
-        
-        if 'email' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN email TEXT')
-            print("[Migration] Добавлена колонка email")
-        
-        if 'full_name' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN full_name TEXT')
-            print("[Migration] Добавлена колонка full_name")
-        
-        if 'two_factor_secret' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN two_factor_secret TEXT')
-            print("[Migration] Добавлена колонка two_factor_secret")
-        
-        if 'two_factor_enabled' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN two_factor_enabled INTEGER DEFAULT 0')
-            print("[Migration] Добавлена колонка two_factor_enabled")
-        
-        # Миграция таблицы event_map
-        try:
-            c.execute("PRAGMA table_info(event_map)")
-            event_map_columns = [col[1] for col in c.fetchall()]
-            
-            if 'emotion' not in event_map_columns:
-                c.execute('ALTER TABLE event_map ADD COLUMN emotion TEXT')
-                print("[Migration] Добавлена колонка emotion в event_map")
-            
-            if 'idea' not in event_map_columns:
-                c.execute('ALTER TABLE event_map ADD COLUMN idea TEXT')
-                print("[Migration] Добавлена колонка idea в event_map")
-            
-            if 'is_completed' not in event_map_columns:
-                c.execute('ALTER TABLE event_map ADD COLUMN is_completed INTEGER DEFAULT 0')
-                print("[Migration] Добавлена колонка is_completed в event_map")
-        except sqlite3.OperationalError:
-            # Таблица еще не создана, будет создана при init_db
-            pass
-        
-        # Миграция таблицы feedback - добавляем новые поля для структурированной обратной связи
-        try:
-            c.execute("PRAGMA table_info(feedback)")
-            feedback_columns = [col[1] for col in c.fetchall()]
-            
-            if 'about_self' not in feedback_columns:
-                c.execute('ALTER TABLE feedback ADD COLUMN about_self TEXT')
-                print("[Migration] Добавлена колонка about_self в feedback")
-            
-            if 'expectations' not in feedback_columns:
-                c.execute('ALTER TABLE feedback ADD COLUMN expectations TEXT')
-                print("[Migration] Добавлена колонка expectations в feedback")
-            
-            if 'expectations_met' not in feedback_columns:
-                c.execute('ALTER TABLE feedback ADD COLUMN expectations_met TEXT')
-                print("[Migration] Добавлена колонка expectations_met в feedback")
-            
-            if 'how_it_went' not in feedback_columns:
-                c.execute('ALTER TABLE feedback ADD COLUMN how_it_went TEXT')
-                print("[Migration] Добавлена колонка how_it_went в feedback")
-            
-            if 'feedback_type' not in feedback_columns:
-                c.execute('ALTER TABLE feedback ADD COLUMN feedback_type TEXT DEFAULT "full"')
-                print("[Migration] Добавлена колонка feedback_type в feedback")
-        except sqlite3.OperationalError:
-            # Таблица еще не создана, будет создана при init_db
-            pass
-        
-        # Создаем таблицу для файлов обратной связи
-        try:
-            c.execute('''CREATE TABLE IF NOT EXISTS feedback_files
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          feedback_id INTEGER NOT NULL,
-                          file_path TEXT NOT NULL,
-                          file_type TEXT,
-                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                          FOREIGN KEY (feedback_id) REFERENCES feedback (id))''')
-            print("[Migration] Создана таблица feedback_files")
-        except sqlite3.OperationalError as e:
-            print(f"[Migration] Ошибка создания таблицы feedback_files: {e}")
-        
-        conn.commit()
-        
-        # Генерируем коды для пользователей, у которых их нет
-        c.execute('SELECT id FROM users WHERE referral_code IS NULL OR user_id IS NULL')
-        users_without_codes = c.fetchall()
-        
-        for (user_id,) in users_without_codes:
-            # Генерируем уникальные коды
-            new_referral_code = generate_referral_code()
-            new_user_id_str = str(uuid.uuid4())[:8].upper()
-            
-            # Проверяем уникальность
-            while True:
-                c.execute('SELECT id FROM users WHERE (referral_code = ? OR user_id = ?) AND id != ?', 
-                         (new_referral_code, new_user_id_str, user_id))
-                if not c.fetchone():
-                    break
-                new_referral_code = generate_referral_code()
-                new_user_id_str = str(uuid.uuid4())[:8].upper()
-            
-            # Обновляем пользователя
-            c.execute('''UPDATE users 
-                         SET referral_code = COALESCE(referral_code, ?),
-                             user_id = COALESCE(user_id, ?)
-                         WHERE id = ?''', 
-                     (new_referral_code, new_user_id_str, user_id))
-            
-            # Создаем баланс если его нет
-            c.execute('SELECT id FROM balances WHERE user_id = ?', (user_id,))
-            if not c.fetchone():
-                c.execute('INSERT INTO balances (user_id, amount) VALUES (?, 0.00)', (user_id,))
-        
-        conn.commit()
-        
-        if users_without_codes:
-            print(f"[Migration] Сгенерированы коды для {len(users_without_codes)} пользователей")
-        
-    except Exception as e:
-        print(f"[Migration] Ошибка миграции: {e}")
-        import traceback
-        traceback.print_exc()
-        conn.rollback()
+        apply_migrations(conn)
     finally:
         conn.close()
 
-# Запускаем миграцию после определения get_db
-migrate_database()
+# Инициализация базы данных
+init_db()
+# Начисление комиссий по журналу платежей (в том числе оставшихся с прошлого запуска)
+ledger_worker.start()
 
 # Инициализация AI психолога
 psychologist_ai = PsychologistAI()
 
+# Метрики процесса: в лог раз в METRICS_LOG_INTERVAL секунд и по /api/metrics
+register_metrics('db_pool', lambda: db_pool.get_pool().stats())
+register_metrics('prompt_cache', psychologist_ai.get_prompt_cache_stats)
+# Глубина и возраст старейшей записи очередей снимков (concept_files)
+register_metrics('persistence_queues', queue_stats)
+metrics_reporter.start()
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Метрики процесса для мониторинга (заголовок X-Metrics-Token со значением METRICS_TOKEN)"""
+    token = request.headers.get('X-Metrics-Token', '')
+    if not METRICS_TOKEN or not secrets.compare_digest(token, METRICS_TOKEN):
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(collect_metrics())
+
 @app.route('/')
 def index():
     """Главная страница"""
@@ -602,16 +239,10 @@ def google_auth():
             return jsonify({'success': False, 'error': 'Не удалось получить данные пользователя Google'}), 400
         
         conn = get_db()
-        database_url = os.environ.get('DATABASE_URL')
-        is_postgres = bool(database_url)
-        
-        # Определяем правильный placeholder для SQL
-        placeholder = '%s' if is_postgres else '?'
         c = conn.cursor()
         
         # Проверяем, есть ли пользователь с таким Google ID
-        query = f'SELECT id, username FROM users WHERE google_id = {placeholder}'
-        c.execute(query, (google_id,))
+        c.execute('SELECT id, username FROM users WHERE google_id = ?', (google_id,))
         user = c.fetchone()
         
         if user:
@@ -627,7 +258,7 @@ def google_auth():
             original_username = username
             
             # Проверяем уникальность username
-            query = f'SELECT id FROM users WHERE username = {placeholder}'
+            query = 'SELECT id FROM users WHERE username = ?'
             c.execute(query, (username,))
             if c.fetchone():
                 counter = 1
@@ -643,32 +274,24 @@ def google_auth():
             
             # Проверяем уникальность кодов
             while True:
-                query = f'SELECT id FROM users WHERE referral_code = {placeholder} OR user_id = {placeholder}'
-                c.execute(query, (new_referral_code, user_id_str))
+                c.execute('SELECT id FROM users WHERE referral_code = ? OR user_id = ?',
+                          (new_referral_code, user_id_str))
                 if not c.fetchone():
                     break
                 new_referral_code = generate_referral_code()
                 user_id_str = str(uuid.uuid4())[:8].upper()
             
             # Создаем пользователя без пароля (только Google)
-            if is_postgres:
-                # PostgreSQL: используем RETURNING для получения ID
-                insert_query = '''INSERT INTO users (username, password_hash, referral_code, user_id, google_id, email, full_name) 
-                                 VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id'''
-                c.execute(insert_query, (username, '', new_referral_code, user_id_str, google_id, email, name))
-                new_user_id = c.fetchone()[0]
-            else:
-                # SQLite: используем lastrowid
-                insert_query = '''INSERT INTO users (username, password_hash, referral_code, user_id, google_id, email, full_name) 
-                                 VALUES (?, ?, ?, ?, ?, ?, ?)'''
-                c.execute(insert_query, (username, '', new_referral_code, user_id_str, google_id, email, name))
-                new_user_id = c.lastrowid
+            # lastrowid работает и на PostgreSQL (курсор добавляет RETURNING id)
+            c.execute('''INSERT INTO users (username, password_hash, referral_code, user_id, google_id, email, full_name) 
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                      (username, '', new_referral_code, user_id_str, google_id, email, name))
+            new_user_id = c.lastrowid
             
             conn.commit()
             
             # Создаем начальный баланс
-            balance_query = f'INSERT INTO balances (user_id, amount) VALUES ({placeholder}, 0.00)'
-            c.execute(balance_query, (new_user_id,))
+            c.execute('INSERT INTO balances (user_id, amount) VALUES (?, 0.00)', (new_user_id,))
             conn.commit()
             conn.close()
             
@@ -699,11 +322,6 @@ def register():
         return jsonify({'success': False, 'error': 'Имя пользователя и пароль обязательны'})
     
     conn = get_db()
-    database_url = os.environ.get('DATABASE_URL')
-    is_postgres = bool(database_url)
-    
-    # Определяем правильный placeholder для SQL
-    placeholder = '%s' if is_postgres else '?'
     
     try:
         c = conn.cursor()
@@ -714,32 +332,26 @@ def register():
         
         # Проверяем уникальность
         while True:
-            query = f'SELECT id FROM users WHERE referral_code = {placeholder} OR user_id = {placeholder}'
-            c.execute(query, (new_referral_code, user_id_str))
+            c.execute('SELECT id FROM users WHERE referral_code = ? OR user_id = ?',
+                      (new_referral_code, user_id_str))
             if not c.fetchone():
                 break
             new_referral_code = generate_referral_code()
             user_id_str = str(uuid.uuid4())[:8].upper()
         
         password_hash = generate_password_hash(password)
-        insert_query = f'''INSERT INTO users (username, password_hash, referral_code, user_id) 
-                    VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})'''
-        c.execute(insert_query, (username, password_hash, new_referral_code, user_id_str))
+        c.execute('''INSERT INTO users (username, password_hash, referral_code, user_id) 
+                     VALUES (?, ?, ?, ?)''', (username, password_hash, new_referral_code, user_id_str))
+        new_user_id = c.lastrowid
         conn.commit()
         
-        if is_postgres:
-            c.execute('SELECT LASTVAL()')
-            new_user_id = c.fetchone()[0]
-        else:
-            new_user_id = c.lastrowid
-        
         # Создаем начальный баланс
-        balance_query = f'INSERT INTO balances (user_id, amount) VALUES ({placeholder}, 0.00)'
-        c.execute(balance_query, (new_user_id,))
+        c.execute('INSERT INTO balances (user_id, amount) VALUES (?, 0.00)', (new_user_id,))
         
-        # Создаем реферальную структуру если есть реферер
+        # Создаем реферальную структуру если есть реферер (в той же транзакции:
+        # второе соединение ждало бы блокировку записи, взятую этим)
         if referrer_code_input:
-            create_referral_structure(new_user_id, referrer_code_input)
+            create_referral_structure(new_user_id, referrer_code_input, c)
         
         conn.commit()
         conn.close()
@@ -774,7 +386,7 @@ def register():
         if 'unique' in error_msg.lower() or 'duplicate' in error_msg.lower():
             return jsonify({'success': False, 'error': 'Пользователь с таким именем уже существует'}), 400
         return jsonify({'success': False, 'error': f'Ошибка регистрации: {error_msg}'}), 500
-    except sqlite3.IntegrityError:
+    except IntegrityError:
         conn.close()
         return jsonify({'success': False, 'error': 'Пользователь с таким именем уже существует'})
     except Exception as e:
@@ -837,9 +449,16 @@ def delete_or_update_session(session_id):
         # Удаляем все связанные данные
         c.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
         c.execute('DELETE FROM concept_hierarchies WHERE session_id = ?', (session_id,))
+        c.execute('DELETE FROM concept_fields WHERE session_id = ?', (session_id,))
+        c.execute('DELETE FROM session_states WHERE session_id = ?', (session_id,))
+        c.execute('DELETE FROM session_summaries WHERE session_id = ?', (session_id,))
         c.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
         conn.commit()
         conn.close()
+        history_cache.invalidate(session_id)
+        concept_store.invalidate(session_id)
+        concept_graphs.invalidate(session_id)
+        psychologist_ai.delete_session_state(session_id)
         return jsonify({'success': True})
     
     elif request.method == 'PUT':
@@ -939,44 +558,75 @@ def handle_message(data):
     
     user_message = user_message.strip()
     
-    # Сохраняем сообщение пользователя
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM sessions WHERE id = ?', (session_id,))
-    session_user = c.fetchone()
-    
-    if not session_user or session_user[0] != user_id:
-        conn.close()
+    # Сохраняем сообщение пользователя одной транзакцией. UPDATE сессии заодно
+    # проверяет владельца (0 строк - чужая сессия) и ставит заголовок, если
+    # сообщений еще нет (это будет первое) - без отдельных SELECT и COUNT(*)
+    title = user_message[:50] + '...' if len(user_message) > 50 else user_message
+    with unit_of_work() as uow:
+        c = uow.cursor
+        c.execute('''UPDATE sessions
+                     SET updated_at = CURRENT_TIMESTAMP,
+                         title = CASE WHEN EXISTS (SELECT 1 FROM messages WHERE session_id = ?)
+                                      THEN title ELSE ? END
+                     WHERE id = ? AND user_id = ?''', (session_id, title, session_id, user_id))
+        owned = c.rowcount > 0
+        if owned:
+            c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                     (session_id, 'user', user_message))
+            message_id = c.lastrowid
+            uow.after_commit(history_cache.append, session_id, message_id, 'user', user_message)
+    
+    if not owned:
         emit('error', {'message': 'Доступ запрещен'})
         return
     
-    c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
-             (session_id, 'user', user_message))
-    conn.commit()
-    
-    # Обновляем время сессии
-    c.execute('UPDATE sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
-    
-    # Обновляем заголовок сессии если это первое сообщение
-    c.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,))
-    msg_count = c.fetchone()[0]
-    if msg_count == 1:
-        title = user_message[:50] + '...' if len(user_message) > 50 else user_message
-        c.execute('UPDATE sessions SET title = ? WHERE id = ?', (title, session_id))
-        conn.commit()
-    
-    conn.close()
+    # Ответ AI готовится в фоне, чтобы медленный GPT не блокировал других
+    # пользователей; сообщения одной сессии обрабатываются строго по порядку
+    position = turn_queue.submit(session_id, run_message_turn,
+                                 flask_request.sid, user_id, session_id, user_message,
+                                 bool(data.get('stream')), message_id)
+    return {'status': 'accepted', 'session_id': session_id, 'queue_position': position}
+
+def run_message_turn(sid, user_id, session_id, user_message, stream=False, message_id=None):
+    """Фоновая задача: контекст приложения нужен для get_db() и возврата соединений.
     
+    Клиент ждет response или error: ошибка на любом шаге хода (сохранение,
+    отправка ответа) тоже сообщается ему, а затем попадает в лог очереди.
+    """
+    with app.app_context():
+        try:
+            process_message_turn(sid, user_id, session_id, user_message, stream, message_id)
+        except Exception as e:
+            socketio.emit('error', {'message': f'Ошибка при обработке сообщения: {str(e)}'}, to=sid)
+            raise
+
+def ordered_concepts(session_id, state):
+    """Идеи состояния в порядке дерева: корневая, затем ее под-идеи"""
+    concept_hierarchy = state.get('concept_hierarchy') or {}
+    if not concept_hierarchy:
+        return []
+    return concept_graphs.get(session_id, concept_hierarchy).ordered()
+
+def process_message_turn(sid, user_id, session_id, user_message, stream=False, message_id=None):
+    """Генерирует ответ AI на сообщение message_id и отправляет его клиенту sid.
+    
+    При stream=True фрагменты ответа GPT отправляются событиями response_chunk,
+    а итоговое событие response несет полный текст и данные системы убеждений.
+    """
     # Получаем ответ от AI психолога
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    # Хвост истории из кэша (в GPT уходят только последние сообщения)
+    history = history_cache.get(c, session_id)
+    history_count = history_cache.message_count(session_id) or len(history)
+    if message_id is not None:
+        # Сообщения, отправленные после этого, ждут своего хода в очереди
+        cached = len(history)
+        history = turn_history(history, message_id)
+        history_count -= cached - len(history)
     
     # Получаем username для сохранения файлов
-    c.execute('SELECT username FROM users WHERE id = ?', (session.get('user_id'),))
+    c.execute('SELECT username FROM users WHERE id = ?', (user_id,))
     user_row = c.fetchone()
     username = user_row[0] if user_row else "user"
     
@@ -984,80 +634,104 @@ def handle_message(data):
     
     # Генерируем ответ
     try:
-        ai_response = psychologist_ai.process_message(user_message, history, session_id, username)
+        on_delta = None
+        if stream:
+            def on_delta(delta):
+                socketio.emit('response_chunk', {'session_id': session_id, 'delta': delta}, to=sid)
+        ai_response = psychologist_ai.process_message(user_message, history, session_id, username,
+                                                      on_delta=on_delta)
         print(f"[DEBUG] AI ответ получен. Ключи в ответе: {list(ai_response.keys())}")
     except Exception as e:
-        conn.close()
-        emit('error', {'message': f'Ошибка при обработке сообщения: {str(e)}'})
+        socketio.emit('error', {'message': f'Ошибка при обработке сообщения: {str(e)}'}, to=sid)
         return
     
-    # Сохраняем ответ AI
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
-             (session_id, 'assistant', ai_response['text']))
-    conn.commit()
-    
     # Сохраняем систему убеждений если она обновлена
     new_title = None
+    concept_data = ai_response.get('concept_data')
     
     # Если AI вернул новое название идеи, используем его для обновления названия сессии
     if 'new_concept_name' in ai_response:
         concept_name = ai_response['new_concept_name']
         new_title = concept_name[:50] + '...' if len(concept_name) > 50 else concept_name
     
-    if 'concept_data' in ai_response:
-        concept_data = ai_response['concept_data']
+    if concept_data is not None:
         # Логируем для отладки
         print(f"[DEBUG] Сохранение concept_data для сессии {session_id}: {len(concept_data)} концепций")
         # Детальная информация о концепциях
         for name, data in list(concept_data.items())[:3]:
             print(f"[DEBUG]   - {name}: состав={len(data.get('composition', []))}, основатель={bool(data.get('founder'))}, цель={bool(data.get('purpose'))}")
         
-        # Данные уже сохранены в файл в process_message, но сохраняем еще раз для надежности
+        # Снимок в файл: если process_message уже сохранил его в этом ходе,
+        # сохранения склеятся в одну запись (ConceptSnapshotStore)
         filepath = psychologist_ai.save_concept_data_to_file(session_id, concept_data, username)
         if filepath:
-            print(f"[DEBUG] ✅ Данные дополнительно сохранены в файл: {filepath}")
-        
-        # Также сохраняем в БД (для совместимости)
-        concept_json = json.dumps(concept_data, ensure_ascii=False)
-        c.execute('''INSERT OR REPLACE INTO concept_hierarchies 
-                     (session_id, concept_data) 
-                     VALUES (?, ?)''',
-                 (session_id, concept_json))
-        conn.commit()
-        print(f"[DEBUG] ✅ concept_data успешно сохранен в БД")
-        
-        # Если название еще не определено, определяем его из системы убеждений
-        if not new_title and concept_data:
-            # Находим корневую идею (не являющуюся частью другой)
-            all_sub_concepts = set()
-            for data in concept_data.values():
-                all_sub_concepts.update(data.get('sub_concepts', []))
+            print(f"[DEBUG] ✅ Снимок системы убеждений поставлен в запись: {filepath}")
+    
+    # Все записи хода - одна транзакция на одном соединении; кэш истории и
+    # событие о новом названии - только после фиксации
+    with unit_of_work() as uow:
+        c = uow.cursor
+        c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                 (session_id, 'assistant', ai_response['text']))
+        uow.after_commit(history_cache.append, session_id, c.lastrowid, 'assistant', ai_response['text'])
+        
+        if concept_data is not None:
+            # Только изменившиеся поля идей (concept_fields)
+            uow.on_rollback(concept_store.invalidate, session_id)
+            changes = concept_store.save(c, session_id, concept_data)
+            print(f"[DEBUG] ✅ concept_data сохраняется в БД: изменено полей {changes['updated']}, удалено {changes['deleted']}")
+            # Граф идей обновляется только по изменившимся идеям (целиком, если сессию сохранял другой воркер)
+            uow.on_rollback(concept_graphs.invalidate, session_id)
+            graph = concept_graphs.get(session_id, concept_data, changed=changes['concepts'])
             
-            root_concepts = [name for name in concept_data.keys() if name not in all_sub_concepts]
-            if root_concepts:
-                # Берем первую корневую идею
-                first_concept = root_concepts[0]
-                # Обрезаем если слишком длинная
-                new_title = first_concept[:50] + '...' if len(first_concept) > 50 else first_concept
-            elif concept_data:
-                # Если нет корневых, берем первую идею
-                first_concept = list(concept_data.keys())[0]
-                new_title = first_concept[:50] + '...' if len(first_concept) > 50 else first_concept
-    
-    # Обновляем название сессии если есть новая идея
-    # Проверяем текущее название сессии, чтобы не обновлять если уже правильное
-    if new_title:
-        c.execute('SELECT title FROM sessions WHERE id = ?', (session_id,))
-        current_title = c.fetchone()
-        if not current_title or current_title[0] != new_title:
-            c.execute('UPDATE sessions SET title = ? WHERE id = ?', (new_title, session_id))
-            conn.commit()
-            # Отправляем обновление названия клиенту
-            emit('session_title_updated', {'session_id': session_id, 'title': new_title})
-    
-    conn.close()
+            # Если название еще не определено, определяем его из системы убеждений
+            if not new_title and concept_data:
+                # Находим корневую идею (не являющуюся частью другой)
+                root_concepts = graph.roots()
+                if root_concepts:
+                    # Берем первую корневую идею
+                    first_concept = root_concepts[0]
+                    # Обрезаем если слишком длинная
+                    new_title = first_concept[:50] + '...' if len(first_concept) > 50 else first_concept
+                else:
+                    # Если нет корневых, берем первую идею
+                    first_concept = list(concept_data.keys())[0]
+                    new_title = first_concept[:50] + '...' if len(first_concept) > 50 else first_concept
+        
+        # Обновляем название сессии, только если оно другое
+        if new_title:
+            c.execute('UPDATE sessions SET title = ? WHERE id = ? AND (title IS NULL OR title <> ?)',
+                     (new_title, session_id, new_title))
+            if c.rowcount > 0:
+                uow.after_commit(socketio.emit, 'session_title_updated',
+                                 {'session_id': session_id, 'title': new_title}, to=sid)
+        
+        # Сохраняем корневые установки и До/После если сессия завершена
+        if ai_response.get('session_complete') and ai_response.get('root_beliefs'):
+            root_beliefs = ai_response['root_beliefs']
+            c.executemany('''INSERT INTO root_beliefs 
+                             (user_id, session_id, circle_number, circle_name, negative_belief, positive_belief, is_task, status)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                          [(user_id, session_id,
+                            root_belief.get('circle_number'),
+                            root_belief.get('circle_name', ''),
+                            root_belief.get('negative_belief', ''),
+                            root_belief.get('positive_belief', ''),
+                            1 if root_belief.get('is_root') else 0,
+                            'identified') for root_belief in root_beliefs])
+            c.executemany('''INSERT INTO before_after_beliefs 
+                             (user_id, session_id, belief_before, belief_after, is_task, circle_number, circle_name)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          [(user_id, session_id,
+                            root_belief.get('negative_belief', ''),
+                            root_belief.get('positive_belief', '') if not root_belief.get('is_root') else None,
+                            1,  # Задача
+                            root_belief.get('circle_number'),
+                            root_belief.get('circle_name', '')) for root_belief in root_beliefs])
+        
+        # Обновляем статистику GPT
+        update_gpt_statistics(session_id, user_id, history_count, ai_response.get('session_complete', False),
+                              uow=uow)
     
     # Определяем, нужно ли показывать кнопки навигации
     show_navigation = False
@@ -1067,7 +741,7 @@ def handle_message(data):
     # Получаем состояние сессии для определения доступных концепций
     state = psychologist_ai.get_session_state(session_id, history)
     if state.get('concept_hierarchy'):
-        available_concepts = list(state['concept_hierarchy'].keys())
+        available_concepts = ordered_concepts(session_id, state)
         current_field = state.get('current_field')
         
         # Показываем кнопки навигации если:
@@ -1076,42 +750,7 @@ def handle_message(data):
         if len(available_concepts) > 1 or current_field:
             show_navigation = True
     
-    # Сохраняем корневые установки и До/После если сессия завершена
-    if ai_response.get('session_complete') and ai_response.get('root_beliefs'):
-        conn = get_db()
-        c = conn.cursor()
-        
-        for root_belief in ai_response['root_beliefs']:
-            # Сохраняем в root_beliefs
-            c.execute('''INSERT INTO root_beliefs 
-                         (user_id, session_id, circle_number, circle_name, negative_belief, positive_belief, is_task, status)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                     (user_id, session_id, 
-                      root_belief.get('circle_number'),
-                      root_belief.get('circle_name', ''),
-                      root_belief.get('negative_belief', ''),
-                      root_belief.get('positive_belief', ''),
-                      1 if root_belief.get('is_root') else 0,
-                      'identified'))
-            
-            # Сохраняем в before_after_beliefs
-            c.execute('''INSERT INTO before_after_beliefs 
-                         (user_id, session_id, belief_before, belief_after, is_task, circle_number, circle_name)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                     (user_id, session_id,
-                      root_belief.get('negative_belief', ''),
-                      root_belief.get('positive_belief', '') if not root_belief.get('is_root') else None,
-                      1,  # Задача
-                      root_belief.get('circle_number'),
-                      root_belief.get('circle_name', '')))
-        
-        conn.commit()
-        conn.close()
-    
-    # Обновляем статистику GPT
-    update_gpt_statistics(session_id, user_id, len(history), ai_response.get('session_complete', False))
-    
-    emit('response', {
+    socketio.emit('response', {
         'message': ai_response['text'],
         'concept_data': ai_response.get('concept_data'),
         'show_navigation': show_navigation,
@@ -1120,7 +759,7 @@ def handle_message(data):
         'plan': ai_response.get('plan'),
         'session_complete': ai_response.get('session_complete', False),
         'root_beliefs': ai_response.get('root_beliefs', [])
-    })
+    }, to=sid)
 
 @app.route('/api/sessions/<int:session_id>/document')
 def get_document(session_id):
@@ -1149,22 +788,30 @@ def get_document(session_id):
         username = session_info[1] if session_info[1] else 'Пользователь'
         
         # Получаем данные концепций
-        c.execute('SELECT concept_data FROM concept_hierarchies WHERE session_id = ?', (session_id,))
-        concept_row = c.fetchone()
+        try:
+            concept_data = concept_store.load(c, session_id)
+        except json.JSONDecodeError as e:
+            conn.close()
+            return jsonify({'error': f'Ошибка парсинга данных: {str(e)}'}), 500
         
-        if concept_row and concept_row[0]:
-            try:
-                concept_data = json.loads(concept_row[0])
-                if concept_data:
-                    document = psychologist_ai.generate_document(concept_data, username)
-                    conn.close()
-                    return jsonify({'document': document})
+        if concept_data is not None:
+            conn.close()
+            if concept_data:
+                # Неизменившийся документ не генерируем: клиенту хватает 304
+                hashes = concept_hashes(concept_data)
+                etag = document_etag(concept_data, username, hashes)
+                if request.if_none_match.contains_weak(etag):
+                    response = app.response_class(status=304)
                 else:
-                    conn.close()
-                    return jsonify({'document': '', 'message': 'Нет данных концепций'})
-            except json.JSONDecodeError as e:
-                conn.close()
-                return jsonify({'error': f'Ошибка парсинга данных: {str(e)}'}), 500
+                    document = psychologist_ai.generate_document(
+                        concept_data, username, graph=concept_graphs.get(session_id, concept_data),
+                        hashes=hashes)
+                    response = jsonify({'document': document})
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+            else:
+                return jsonify({'document': '', 'message': 'Нет данных концепций'})
         else:
             conn.close()
             return jsonify({'document': '', 'message': 'Документ пока пуст. Продолжите диалог, чтобы сгенерировать карту концепций.'})
@@ -1632,14 +1279,34 @@ def test_payment():
     if 'user_id' not in session:
         return jsonify({'error': 'Не авторизован'}), 401
     
-    amount = float(request.json.get('amount', 100))
-    transactions = process_payment(session['user_id'], amount)
+    amount = request.json.get('amount', 100)
+    # Повтор запроса с тем же ключом не начисляет комиссии повторно
+    payment_id = request.headers.get('Idempotency-Key') or request.json.get('payment_id')
+    # Платеж только записывается в журнал; комиссии начисляет фоновый обработчик
+    try:
+        payment_id = record_payment(session['user_id'], amount, payment_id)
+    except PaymentConflictError as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     return jsonify({
         'success': True,
-        'transactions': transactions,
-        'message': f'Платеж обработан, комиссии распределены'
-    })
+        'payment_id': payment_id,
+        'status': 'queued',
+        'message': f'Платеж принят, комиссии будут распределены'
+    }), 202
+
+@app.route('/api/payments/<payment_id>')
+def get_payment(payment_id):
+    """Состояние платежа из журнала и начисленные по нему комиссии"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Не авторизован'}), 401
+    
+    status = payment_status(session['user_id'], payment_id)
+    if not status:
+        return jsonify({'error': 'Платеж не найден'}), 404
+    return jsonify(status)
 
 # API для Нейрокарты
 @app.route('/api/map/entries', methods=['GET'])
@@ -2004,8 +1671,7 @@ def handle_map_message(data):
             # Сокращаем идею через GPT до краткого описания (до 50-60 символов)
             idea_text = idea_text_raw
             try:
-                from psychologist_ai import PsychologistAI
-                ai = PsychologistAI()
+                ai = psychologist_ai
                 if ai.openai_client and len(idea_text_raw) > 40:  # Сокращаем только если длиннее 40 символов
                     shortened = ai._shorten_idea(idea_text_raw)
                     if shortened:
@@ -2444,16 +2110,13 @@ def add_session_to_map(session_id):
     messages = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
     
     # Получаем данные концепций
-    c.execute('SELECT concept_data FROM concept_hierarchies WHERE session_id = ?', (session_id,))
-    concept_row = c.fetchone()
-    concept_data = json.loads(concept_row[0]) if concept_row and concept_row[0] else {}
+    concept_data = concept_store.load(c, session_id) or {}
     
     conn.close()
     
     # Используем GPT для преобразования сессии в таблицу Нейрокарты
     try:
-        from psychologist_ai import PsychologistAI
-        ai = PsychologistAI()
+        ai = psychologist_ai
         
         # Формируем промпт для GPT
         conversation_text = '\n'.join([f"{msg['role']}: {msg['content']}" for msg in messages])
@@ -2580,10 +2243,7 @@ def handle_go_to_belief(data):
     # Получаем историю для определения состояния
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    history = history_cache.get(c, session_id)
     conn.close()
     
     # Получаем состояние и переключаемся на выбранную концепцию
@@ -2593,19 +2253,23 @@ def handle_go_to_belief(data):
         state['current_concept'] = concept_name
         state['current_field'] = 'composition'
         state['stage'] = 'concept_hierarchy'
+        psychologist_ai.save_session_state(session_id, state)
         
         # Отправляем сообщение о переходе
         emit('response', {
             'message': f'Хорошо, давайте разберем идею "{concept_name}". Из чего состоит эта идея? Почему вы так думаете?',
             'show_navigation': True,
-            'available_concepts': list(state.get('concept_hierarchy', {}).keys()),
+            'available_concepts': ordered_concepts(session_id, state),
             'current_field': 'composition'
         })
     else:
         # Если концепция не выбрана, отправляем список доступных
-        available_concepts = list(state.get('concept_hierarchy', {}).keys())
+        available_concepts = ordered_concepts(session_id, state)
         if available_concepts:
-            concepts_list = '\n'.join([f"{i+1}. {concept}" for i, concept in enumerate(available_concepts)])
+            # Под-идеи - с отступом под родительской идеей
+            graph = concept_graphs.get(session_id, state['concept_hierarchy'])
+            concepts_list = '\n'.join([f"{'    ' * (graph.depth(concept) or 0)}{i+1}. {concept}"
+                                       for i, concept in enumerate(available_concepts)])
             emit('response', {
                 'message': f'Выберите убеждение, которое хотите разобрать:\n\n{concepts_list}\n\nНапишите номер или название убеждения.',
                 'show_navigation': True,
@@ -2634,10 +2298,7 @@ def handle_edit_concept(data):
     # Получаем историю для определения состояния
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    history = history_cache.get(c, session_id)
     conn.close()
     
     # Получаем состояние
@@ -2652,6 +2313,7 @@ def handle_edit_concept(data):
     state['current_field'] = field_name
     state['stage'] = 'concept_hierarchy'
     state['editing_mode'] = True
+    psychologist_ai.save_session_state(session_id, state)
     
     # Формируем вопрос в зависимости от поля
     field_questions = {
@@ -2669,7 +2331,7 @@ def handle_edit_concept(data):
     emit('response', {
         'message': question,
         'show_navigation': True,
-        'available_concepts': list(state.get('concept_hierarchy', {}).keys()),
+        'available_concepts': ordered_concepts(session_id, state),
         'current_field': field_name,
         'editing_mode': True
     })
@@ -2690,10 +2352,7 @@ def handle_skip_step(data):
     # Получаем историю для определения состояния
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    history = history_cache.get(c, session_id)
     conn.close()
     
     # Получаем состояние и пропускаем текущий этап
@@ -2713,6 +2372,7 @@ def handle_skip_step(data):
         if current_index < len(field_order) - 1:
             next_field = field_order[current_index + 1]
             state['current_field'] = next_field
+            psychologist_ai.save_session_state(session_id, state)
             
             # Генерируем вопрос для следующего этапа
             if next_field == 'composition_check':
@@ -2733,7 +2393,7 @@ def handle_skip_step(data):
             emit('response', {
                 'message': question,
                 'show_navigation': True,
-                'available_concepts': list(state.get('concept_hierarchy', {}).keys()),
+                'available_concepts': ordered_concepts(session_id, state),
                 'current_field': next_field
             })
         else:
@@ -2762,10 +2422,7 @@ def handle_rename_concept(data):
     # Получаем состояние
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    history = history_cache.get(c, session_id)
     conn.close()
     
     state = psychologist_ai.get_session_state(session_id, history)
@@ -2788,12 +2445,13 @@ def handle_rename_concept(data):
         
         if state.get('current_concept') == old_name:
             state['current_concept'] = new_name
+        psychologist_ai.save_session_state(session_id, state)
         
         emit('response', {
             'message': f'Название убеждения изменено с "{old_name}" на "{new_name}"',
             'concept_data': concept_hierarchy,
             'show_navigation': True,
-            'available_concepts': list(concept_hierarchy.keys())
+            'available_concepts': ordered_concepts(session_id, state)
         })
     else:
         emit('error', {'message': 'Убеждение не найдено'})
@@ -2815,10 +2473,7 @@ def handle_strikethrough_concept(data):
     # Получаем состояние
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    history = history_cache.get(c, session_id)
     conn.close()
     
     state = psychologist_ai.get_session_state(session_id, history)
@@ -2826,11 +2481,12 @@ def handle_strikethrough_concept(data):
     
     if concept_name in concept_hierarchy:
         concept_hierarchy[concept_name]['strikethrough'] = True
+        psychologist_ai.save_session_state(session_id, state)
         emit('response', {
             'message': f'Идея "{concept_name}" зачеркнута',
             'concept_data': concept_hierarchy,
             'show_navigation': True,
-            'available_concepts': list(concept_hierarchy.keys())
+            'available_concepts': ordered_concepts(session_id, state)
         })
     else:
         emit('error', {'message': 'Идея не найдена'})
@@ -2854,10 +2510,7 @@ def handle_extract_concept(data):
     # Получаем состояние
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT role, content FROM messages 
-                 WHERE session_id = ? 
-                 ORDER BY timestamp ASC''', (session_id,))
-    history = [{'role': row[0], 'content': row[1]} for row in c.fetchall()]
+    history = history_cache.get(c, session_id)
     conn.close()
     
     state = psychologist_ai.get_session_state(session_id, history)
@@ -2877,55 +2530,62 @@ def handle_extract_concept(data):
             'extracted_from': source_concept,
             'extracted_parts': extracted_parts
         }
+        psychologist_ai.save_session_state(session_id, state)
         
         emit('response', {
             'message': f'Новая идея "{new_concept_name}" создана из частей идеи "{source_concept}". Теперь можно начать её разбор.',
             'concept_data': concept_hierarchy,
             'show_navigation': True,
-            'available_concepts': list(concept_hierarchy.keys())
+            'available_concepts': ordered_concepts(session_id, state)
         })
     else:
         emit('error', {'message': 'Идея с таким названием уже существует'})
 
-def update_gpt_statistics(session_id: int, user_id: int, message_count: int, session_complete: bool):
-    """Обновляет статистику обучения GPT"""
+def update_gpt_statistics(session_id: int, user_id: int, message_count: int, session_complete: bool,
+                          uow=None):
+    """Обновляет статистику обучения GPT.
+    
+    С uow - в транзакции хода, в точке сохранения: ошибка статистики не откатывает ход.
+    """
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Проверяем, есть ли уже запись статистики для этой сессии
-        c.execute('SELECT id, message_count, root_beliefs_identified, positive_transformations FROM gpt_statistics WHERE session_id = ?', (session_id,))
-        stat_row = c.fetchone()
-        
-        if stat_row:
-            # Обновляем существующую запись
-            stat_id, old_msg_count, old_root_beliefs, old_transformations = stat_row
-            new_msg_count = max(old_msg_count, message_count)
-            
-            # Если сессия завершена, увеличиваем счетчики
-            if session_complete:
-                new_root_beliefs = old_root_beliefs + 1
-                new_transformations = old_transformations + 1
-            else:
-                new_root_beliefs = old_root_beliefs
-                new_transformations = old_transformations
-            
-            c.execute('''UPDATE gpt_statistics 
-                         SET message_count = ?, root_beliefs_identified = ?, positive_transformations = ?, updated_at = CURRENT_TIMESTAMP
-                         WHERE id = ?''',
-                     (new_msg_count, new_root_beliefs, new_transformations, stat_id))
+        if uow is None:
+            with unit_of_work() as own:
+                _write_gpt_statistics(own.cursor, session_id, user_id, message_count, session_complete)
         else:
-            # Создаем новую запись
-            c.execute('''INSERT INTO gpt_statistics 
-                         (session_id, user_id, message_count, root_beliefs_identified, positive_transformations)
-                         VALUES (?, ?, ?, ?, ?)''',
-                     (session_id, user_id, message_count, 1 if session_complete else 0, 1 if session_complete else 0))
-        
-        conn.commit()
-        conn.close()
+            with uow.savepoint('gpt_statistics'):
+                _write_gpt_statistics(uow.cursor, session_id, user_id, message_count, session_complete)
     except Exception as e:
         print(f"[Statistics] Ошибка обновления статистики: {e}")
 
+def _write_gpt_statistics(c, session_id, user_id, message_count, session_complete):
+    # Проверяем, есть ли уже запись статистики для этой сессии
+    c.execute('SELECT id, message_count, root_beliefs_identified, positive_transformations FROM gpt_statistics WHERE session_id = ?', (session_id,))
+    stat_row = c.fetchone()
+    
+    if stat_row:
+        # Обновляем существующую запись
+        stat_id, old_msg_count, old_root_beliefs, old_transformations = stat_row
+        new_msg_count = max(old_msg_count, message_count)
+    
+        # Если сессия завершена, увеличиваем счетчики
+        if session_complete:
+            new_root_beliefs = old_root_beliefs + 1
+            new_transformations = old_transformations + 1
+        else:
+            new_root_beliefs = old_root_beliefs
+            new_transformations = old_transformations
+    
+        c.execute('''UPDATE gpt_statistics 
+                     SET message_count = ?, root_beliefs_identified = ?, positive_transformations = ?, updated_at = CURRENT_TIMESTAMP
+                     WHERE id = ?''',
+                 (new_msg_count, new_root_beliefs, new_transformations, stat_id))
+    else:
+        # Создаем новую запись
+        c.execute('''INSERT INTO gpt_statistics 
+                     (session_id, user_id, message_count, root_beliefs_identified, positive_transformations)
+                     VALUES (?, ?, ?, ?, ?)''',
+                 (session_id, user_id, message_count, 1 if session_complete else 0, 1 if session_complete else 0))
+
 if __name__ == '__main__':
     socketio.run(app, debug=True, port=5003, host='0.0.0.0')
 
@@ -0,0 +1,121 @@
+"""Markdown-документ системы убеждений: таблица на идею, кэш фрагментов, ETag.
+
+Раньше документ целиком собирался конкатенацией строк при каждом открытии
+панели документа и при каждом снимке. Теперь таблица идеи - фрагмент,
+закэшированный по хэшу содержимого идеи (MemorySessionStore как LRU):
+неизменившиеся идеи не перерисовываются, документ собирается join'ом.
+
+document_etag() считается по содержимому без рендеринга; /api/sessions/<id>/document
+отдает его как слабый ETag (строка "Создано" в документе - время генерации)
+и отвечает 304 на совпадающий If-None-Match.
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+from concept_graph import ConceptGraph
+from session_store import MemorySessionStore
+
+DOCUMENT_FRAGMENT_CACHE_SIZE = int(os.environ.get('DOCUMENT_FRAGMENT_CACHE_SIZE', '5000'))
+
+# Меняется вместе с разметкой таблиц: старые фрагменты и ETag становятся недействительными
+DOCUMENT_FORMAT = 1
+
+
+def escape_markdown_table(text) -> str:
+    """Экранирует специальные символы для таблиц Markdown"""
+    if not text:
+        return ""
+    # Заменяем переносы строк на <br> для таблиц
+    return str(text).replace('|', '\\|').replace('\n', '<br>')
+
+
+def concept_hash(data: dict) -> str:
+    # Без sort_keys: другой порядок полей дает лишь промах кэша, а не другой документ
+    payload = json.dumps(data, ensure_ascii=False)
+    return hashlib.sha1(f'{DOCUMENT_FORMAT}:{payload}'.encode('utf-8')).hexdigest()
+
+
+def concept_hashes(concept_hierarchy: dict) -> dict:
+    """{идея: хэш содержимого} - считается один раз на запрос для ETag и фрагментов"""
+    return {name: concept_hash(data) for name, data in concept_hierarchy.items()}
+
+
+def document_etag(concept_hierarchy: dict, username: str, hashes: dict = None) -> str:
+    """Хэш документа: имя пользователя, порядок идей и содержимое каждой"""
+    hashes = hashes or concept_hashes(concept_hierarchy)
+    digest = hashlib.sha1(f'{DOCUMENT_FORMAT}:{username}'.encode('utf-8'))
+    for name in concept_hierarchy:
+        digest.update(b'\0' + str(name).encode('utf-8') + b'\0' + hashes[name].encode('ascii'))
+    return digest.hexdigest()
+
+
+def render_concept_table(data: dict) -> str:
+    """Таблица одной идеи"""
+    def listed(items, fmt):
+        return "<br>".join(fmt(i, item) for i, item in enumerate(items)) if items else "—"
+
+    consequences = data['consequences']
+    rows = [
+        ("Наименование идеи", data['name']),
+        ("Состав идеи", listed(data['composition'], lambda i, part: f"{i+1}. {part}")),
+        ("Основатель идеи", data['founder'] or "—"),
+        ("Цель появления идеи", data['purpose'] or "—"),
+        ("Эмоциональные последствия", listed(consequences['emotional'], lambda i, cons: f"• {cons}")),
+        ("Физические последствия", listed(consequences['physical'], lambda i, cons: f"• {cons}")),
+        ("Выводы", data['conclusions'] or "—"),
+        ("Комментарии", listed(data['comments'], lambda i, comment: f"• {comment}")),
+    ]
+    parts = ["| Поле | Значение |\n", "|------|----------|\n"]
+    parts.extend(f"| **{title}** | {escape_markdown_table(value)} |\n" for title, value in rows)
+    parts.append("\n")
+    return "".join(parts)
+
+
+class ConceptDocumentRenderer:
+    """Сборка документа из закэшированных таблиц идей"""
+
+    def __init__(self, cache=None):
+        # Хэш содержимого идеи -> таблица
+        self.cache = cache or MemorySessionStore(max_size=DOCUMENT_FRAGMENT_CACHE_SIZE, ttl=0)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def fragment(self, data: dict, key: str = None) -> str:
+        key = key or concept_hash(data)
+        table = self.cache.get(key)
+        with self._lock:
+            self._stats['hits' if table is not None else 'misses'] += 1
+        if table is None:
+            table = render_concept_table(data)
+            self.cache.set(key, table)
+        return table
+
+    def render(self, concept_hierarchy: dict, username: str, graph: ConceptGraph = None,
+               hashes: dict = None) -> str:
+        """Корневые идеи и их под-идеи (после таблицы родителя); идеи, замкнутые
+        в цикл без корня, - следом. hashes - результат concept_hashes(), если уже посчитан"""
+        parts = [f"# Карта концепций: {username}\n\n",
+                 f"*Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}*\n\n",
+                 "---\n\n"]
+        graph = graph or ConceptGraph.from_hierarchy(concept_hierarchy)
+        rendered = set()
+        for root in graph.roots() + [name for name in graph.ordered() if graph.depth(name) is None]:
+            if root in rendered:
+                continue
+            for concept_name, _ in graph.walk(root):
+                rendered.add(concept_name)
+                parts.append(self.fragment(concept_hierarchy[concept_name],
+                                           hashes.get(concept_name) if hashes else None))
+            parts.append("\n---\n\n")
+        return "".join(parts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, size=len(self.cache))
+
+
+# Общий рендерер процесса
+concept_documents = ConceptDocumentRenderer()
@@ -0,0 +1,216 @@
+"""Граф идей системы убеждений: индекс родителей, корни, глубина, циклы.
+
+concept_hierarchy хранит у каждой идеи список sub_concepts (дочерние идеи).
+Раньше корни (идеи, не входящие ни в чей состав) пересчитывались сбором
+всех sub_concepts в множество при каждом ходе и при генерации документа,
+а рекурсивный обход не был защищен от циклов.
+
+ConceptGraph держит индекс родителей, множество корней и позицию каждой
+идеи в concept_hierarchy и обновляет их по изменившимся спискам
+sub_concepts: индексы меняются только для добавленных и удаленных связей.
+Если известно, какие идеи изменились (дельта ConceptStore.save), sync
+обходит только их; без дельты сравниваются все идеи. Обходы защищены от
+циклов; связь, замыкающая цикл, фиксируется в cycle_edges.
+
+concept_graphs - графы по сессиям (LRU), синхронизируемые с состоянием.
+"""
+import threading
+
+from session_store import MemorySessionStore
+
+
+class ConceptGraph:
+    """Индекс связей идея -> дочерние идеи с обратным индексом родителей"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Идея -> кортеж дочерних идей (как в sub_concepts) и позиция в concept_hierarchy
+        self._children = {}
+        self._position = {}
+        self._parents = {}
+        self._roots = set()
+        self._depth = None
+        self.cycle_edges = set()
+
+    @classmethod
+    def from_hierarchy(cls, concept_hierarchy: dict) -> 'ConceptGraph':
+        graph = cls()
+        graph.sync(concept_hierarchy)
+        return graph
+
+    def sync(self, concept_hierarchy: dict, changed: dict = None) -> int:
+        """Приводит граф к concept_hierarchy; возвращает число измененных связей и узлов.
+
+        changed - {идея: позиция в concept_hierarchy или None, если идея удалена}
+        для идей, изменившихся с прошлой синхронизации (включая сдвинутые);
+        остальные идеи не просматриваются. Без changed сравниваются все.
+        """
+        with self._lock:
+            changes = 0
+            if changed is None:
+                for name in [name for name in self._children if name not in concept_hierarchy]:
+                    changes += self._remove_node(name)
+                for position, (name, data) in enumerate(concept_hierarchy.items()):
+                    changes += self._sync_node(name, data, position)
+            else:
+                for name, position in changed.items():
+                    if position is None or name not in concept_hierarchy:
+                        changes += self._remove_node(name) if name in self._children else 0
+                    else:
+                        changes += self._sync_node(name, concept_hierarchy[name], position)
+            if changes:
+                self._depth = None
+            return changes
+
+    def _sync_node(self, name, data, position):
+        changes = 0
+        if name not in self._children:
+            self._children[name] = ()
+            if not self._parents.get(name):
+                self._roots.add(name)
+            changes += 1
+        if self._position.get(name) != position:
+            self._position[name] = position
+            changes += 1
+        children = tuple(data.get('sub_concepts') or ()) if isinstance(data, dict) else ()
+        if children != self._children[name]:
+            changes += self._set_children(name, children)
+        return changes
+
+    def _set_children(self, name, children):
+        old, new = set(self._children[name]), set(children)
+        self._children[name] = children
+        for child in old - new:
+            self._unlink(name, child)
+        for child in new - old:
+            self._link(name, child)
+        return len(old ^ new) or 1
+
+    def _link(self, parent, child):
+        self._parents.setdefault(child, set()).add(parent)
+        self._roots.discard(child)
+        if parent == child or self._reaches(child, parent):
+            self.cycle_edges.add((parent, child))
+            print(f"[ConceptGraph] Цикл в системе убеждений: \"{parent}\" -> \"{child}\"")
+
+    def _unlink(self, parent, child):
+        parents = self._parents.get(child)
+        if parents is not None:
+            parents.discard(parent)
+            if not parents:
+                del self._parents[child]
+                if child in self._children:
+                    self._roots.add(child)
+        self.cycle_edges.discard((parent, child))
+
+    def _remove_node(self, name):
+        changes = 1
+        self._position.pop(name, None)
+        for child in set(self._children.pop(name)):
+            self._unlink(name, child)
+            changes += 1
+        self._roots.discard(name)
+        return changes
+
+    def _reaches(self, start, target) -> bool:
+        stack, seen = [start], set()
+        while stack:
+            node = stack.pop()
+            if node == target:
+                return True
+            if node in seen:
+                continue
+            seen.add(node)
+            stack.extend(self._children.get(node, ()))
+        return False
+
+    def _ordered(self, names):
+        return sorted(names, key=self._position.__getitem__)
+
+    def roots(self) -> list:
+        """Идеи, не входящие в состав других, в порядке concept_hierarchy"""
+        with self._lock:
+            return self._ordered(self._roots)
+
+    def parents(self, name) -> set:
+        with self._lock:
+            return set(self._parents.get(name, ()))
+
+    def children(self, name) -> tuple:
+        with self._lock:
+            return self._children.get(name, ())
+
+    def has_cycles(self) -> bool:
+        with self._lock:
+            # Цикл мог разорваться удалением другой связи - перепроверяем
+            self.cycle_edges = {(parent, child) for parent, child in self.cycle_edges
+                                if parent == child or self._reaches(child, parent)}
+            return bool(self.cycle_edges)
+
+    def depth(self, name):
+        """Расстояние от ближайшего корня; None - идея недостижима от корней (только цикл)"""
+        with self._lock:
+            if self._depth is None:
+                self._depth = {}
+                level = self.roots()
+                current = 0
+                while level:
+                    next_level = []
+                    for node in level:
+                        if node not in self._depth:
+                            self._depth[node] = current
+                            next_level.extend(c for c in self._children.get(node, ()) if c in self._children)
+                    level = next_level
+                    current += 1
+            return self._depth.get(name)
+
+    def walk(self, root, level=0) -> list:
+        """Обход в глубину от root: [(идея, уровень)]. Идея, уже стоящая на пути, пропускается"""
+        with self._lock:
+            result = []
+            stack = [(root, level, frozenset())]
+            while stack:
+                name, depth, path = stack.pop()
+                if name not in self._children or name in path:
+                    continue
+                result.append((name, depth))
+                path = path | {name}
+                for child in reversed(self._children[name]):
+                    stack.append((child, depth + 1, path))
+            return result
+
+    def ordered(self) -> list:
+        """Все идеи по дереву (корни и их состав), затем недостижимые от корней"""
+        with self._lock:
+            result, seen = [], set()
+            for root in self.roots():
+                for name, _ in self.walk(root):
+                    if name not in seen:
+                        seen.add(name)
+                        result.append(name)
+            result.extend(self._ordered(name for name in self._children if name not in seen))
+            return result
+
+
+class ConceptGraphCache:
+    """Графы идей по сессиям; get() синхронизирует граф с текущим состоянием"""
+
+    def __init__(self, cache=None):
+        self.cache = cache or MemorySessionStore()
+
+    def get(self, session_id, concept_hierarchy: dict, changed: dict = None) -> ConceptGraph:
+        """changed - дельта идей (см. ConceptGraph.sync); новый граф строится целиком"""
+        graph = self.cache.get(session_id)
+        if graph is None:
+            graph = ConceptGraph()
+            self.cache.set(session_id, graph)
+            changed = None
+        graph.sync(concept_hierarchy, changed)
+        return graph
+
+    def invalidate(self, session_id):
+        self.cache.delete(session_id)
+
+
+# Графы идей процесса
+concept_graphs = ConceptGraphCache()
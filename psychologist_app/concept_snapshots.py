@@ -0,0 +1,241 @@
+"""Версионированные снимки систем убеждений сессий в concept_files/.
+
+Раньше каждое сохранение писало новую пару файлов с отметкой времени
+(.md и .json), и каталог рос без ограничений. Теперь на сессию два файла:
+- session_<id>.json - базовая версия и цепочка дельт (по идеям: какие
+  изменены/добавлены, какие удалены), из которых восстанавливается любая
+  из последних CONCEPT_SNAPSHOT_RETAIN версий;
+- session_<id>.md   - документ последней версии.
+
+Генерация документа и запись идут в фоновой очереди (persistence_queue),
+ответ пользователю их не ждет. Сохранения сессии, пришедшие в течение
+CONCEPT_SNAPSHOT_DEBOUNCE секунд, склеиваются в одну запись (но не позже
+CONCEPT_SNAPSHOT_MAX_DELAY от первого). Неизменившиеся данные не пишутся.
+Файлы заменяются атомарно (запись во временный файл + os.replace).
+Когда дельт больше CONCEPT_SNAPSHOT_MAX_DELTAS, старые сливаются в базу.
+
+Старые файлы с отметкой времени переносятся в новый формат командой
+python concept_snapshots.py --compact-legacy [каталог]
+"""
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime
+
+from persistence_queue import PersistenceQueue
+from session_store import MemorySessionStore
+
+CONCEPT_SNAPSHOT_DEBOUNCE = float(os.environ.get('CONCEPT_SNAPSHOT_DEBOUNCE', '2'))
+CONCEPT_SNAPSHOT_MAX_DELAY = float(os.environ.get('CONCEPT_SNAPSHOT_MAX_DELAY', '10'))
+CONCEPT_SNAPSHOT_MAX_DELTAS = int(os.environ.get('CONCEPT_SNAPSHOT_MAX_DELTAS', '50'))
+CONCEPT_SNAPSHOT_RETAIN = int(os.environ.get('CONCEPT_SNAPSHOT_RETAIN', '20'))
+
+SNAPSHOT_FORMAT = 1
+
+
+def diff_concepts(old: dict, new: dict) -> dict:
+    """Дельта между версиями: измененные/новые идеи целиком и удаленные имена"""
+    return {
+        'set': {name: data for name, data in new.items() if old.get(name) != data},
+        'del': [name for name in old if name not in new],
+    }
+
+
+def apply_delta(data: dict, delta: dict) -> dict:
+    result = dict(data)
+    for name in delta.get('del', []):
+        result.pop(name, None)
+    result.update(delta.get('set', {}))
+    return result
+
+
+def _atomic_write(path: str, text: str):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ConceptSnapshotStore:
+    """Отложенная запись версионированных снимков concept_data по сессиям"""
+
+    def __init__(self, directory, debounce=CONCEPT_SNAPSHOT_DEBOUNCE, max_delay=CONCEPT_SNAPSHOT_MAX_DELAY,
+                 max_deltas=CONCEPT_SNAPSHOT_MAX_DELTAS, retain=CONCEPT_SNAPSHOT_RETAIN):
+        self.directory = directory
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_deltas = max(1, max_deltas)
+        self.retain = max(0, min(retain, self.max_deltas))
+        os.makedirs(directory, exist_ok=True)
+        self.queue = PersistenceQueue('concept_snapshots', debounce=debounce, max_delay=max_delay)
+        self._lock = threading.Lock()
+        # Запись одной сессии не должна идти параллельно (чтение-изменение-запись)
+        self._write_lock = threading.Lock()
+        # Последняя записанная версия сессии: session_id -> (версия, данные)
+        self._latest = MemorySessionStore(max_size=500, ttl=0)
+        self._stats = {'saves': 0, 'writes': 0, 'unchanged': 0, 'compactions': 0}
+
+    def json_path(self, session_id) -> str:
+        return os.path.join(self.directory, f'session_{session_id}.json')
+
+    def document_path(self, session_id) -> str:
+        return os.path.join(self.directory, f'session_{session_id}.md')
+
+    def save(self, session_id, concept_data: dict, render=None) -> str:
+        """Ставит снимок в очередь записи; возвращает путь к документу сессии.
+
+        render(concept_data) -> Markdown вызывается уже при записи, один раз.
+        """
+        # Копия: обработчики продолжают менять concept_data после сохранения
+        data = json.loads(json.dumps(concept_data, ensure_ascii=False))
+        with self._lock:
+            self._stats['saves'] += 1
+        self.queue.submit(session_id, self._write, session_id, data, render)
+        return self.document_path(session_id)
+
+    def flush(self, timeout=None) -> bool:
+        """Записывает все отложенные снимки немедленно"""
+        return self.queue.flush(timeout)
+
+    def _read(self, session_id):
+        path = self.json_path(session_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _materialize(record, version=None):
+        data = record['base']
+        for delta in record['deltas']:
+            if version is not None and delta['v'] > version:
+                break
+            data = apply_delta(data, delta)
+        return data
+
+    def _write(self, session_id, data, render):
+        with self._write_lock:
+            self._write_locked(session_id, data, render)
+
+    def _write_locked(self, session_id, data, render):
+        try:
+            record = self._read(session_id) or {'format': SNAPSHOT_FORMAT, 'base_version': 0, 'base': {}, 'deltas': []}
+            latest = self._latest.get(session_id)
+            version = record['deltas'][-1]['v'] if record['deltas'] else record['base_version']
+            if latest is None or latest[0] != version:
+                latest = (version, self._materialize(record))
+            if latest[1] == data and version:
+                with self._lock:
+                    self._stats['unchanged'] += 1
+                return
+
+            version += 1
+            delta = diff_concepts(latest[1], data)
+            record['deltas'].append(dict(delta, v=version, ts=datetime.now().isoformat(timespec='seconds')))
+            if len(record['deltas']) > self.max_deltas:
+                self._compact(record)
+            _atomic_write(self.json_path(session_id), json.dumps(record, ensure_ascii=False))
+            self._latest.set(session_id, (version, data))
+            if render is not None:
+                _atomic_write(self.document_path(session_id), render(data))
+            with self._lock:
+                self._stats['writes'] += 1
+            print(f"[ConceptSnapshots] Сессия {session_id}: версия {version} "
+                  f"(изменено {len(delta['set'])}, удалено {len(delta['del'])})")
+        except Exception as e:
+            print(f"[ConceptSnapshots] ❌ Ошибка записи снимка сессии {session_id}: {e}")
+            import traceback
+            traceback.print_exc()
+
+    def _compact(self, record):
+        """Сливает в базу все дельты, кроме последних retain"""
+        fold = len(record['deltas']) - self.retain
+        if fold <= 0:
+            return
+        for delta in record['deltas'][:fold]:
+            record['base'] = apply_delta(record['base'], delta)
+            record['base_version'] = delta['v']
+        record['deltas'] = record['deltas'][fold:]
+        with self._lock:
+            self._stats['compactions'] += 1
+
+    def load(self, session_id, version=None):
+        """concept_data последней (или указанной, если она сохранена) версии; None - нет снимков"""
+        pending = self.queue.pending_args(session_id)
+        if pending is not None and version is None:
+            return pending[1]
+        record = self._read(session_id)
+        if record is None:
+            return None
+        if version is not None and version < record['base_version']:
+            raise ValueError(f"Версия {version} сессии {session_id} уже слита в базу")
+        return self._materialize(record, version)
+
+    def versions(self, session_id) -> list:
+        """Доступные версии: [(версия, время)]; базовая - с пустым временем"""
+        record = self._read(session_id)
+        if record is None:
+            return []
+        result = [(record['base_version'], None)] if record['base_version'] else []
+        return result + [(delta['v'], delta['ts']) for delta in record['deltas']]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, queue=self.queue.stats())
+
+
+LEGACY_PATTERN = re.compile(r'^concept_(?:data|map)_session_(\d+)_(\d{8}_\d{6})\.(json|md)$')
+
+
+def compact_legacy_files(directory, store=None) -> int:
+    """Переносит старые файлы с отметкой времени в снимки и удаляет их.
+
+    JSON-файлы каждой сессии становятся версиями по порядку времени.
+    Возвращает число удаленных файлов.
+    """
+    store = store or ConceptSnapshotStore(directory)
+    by_session = {}
+    for path in glob.glob(os.path.join(directory, 'concept_*_session_*')):
+        match = LEGACY_PATTERN.match(os.path.basename(path))
+        if match:
+            by_session.setdefault(int(match.group(1)), []).append((match.group(2), match.group(3), path))
+
+    removed = 0
+    for session_id, files in sorted(by_session.items()):
+        files.sort()
+        latest_document = None
+        for _, kind, path in files:
+            if kind == 'json':
+                with open(path, 'r', encoding='utf-8') as f:
+                    store._write(session_id, json.load(f), None)
+            else:
+                latest_document = path
+        if latest_document and not os.path.exists(store.document_path(session_id)):
+            os.replace(latest_document, store.document_path(session_id))
+        for _, _, path in files:
+            if os.path.exists(path):
+                os.remove(path)
+                removed += 1
+        print(f"[ConceptSnapshots] Сессия {session_id}: перенесено файлов {len(files)}")
+    return removed
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == '--compact-legacy':
+        target = sys.argv[2] if len(sys.argv) > 2 else os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'concept_files')
+        print(f"Удалено старых файлов: {compact_legacy_files(target)}")
+    else:
+        print("Использование: python concept_snapshots.py --compact-legacy [каталог]")
@@ -0,0 +1,160 @@
+"""Адаптер SQL-диалектов: запросы в стиле SQLite выполняются и на PostgreSQL.
+
+В коде приложения запросы пишутся в стиле SQLite (плейсхолдеры ``?``,
+``INSERT OR REPLACE``, ``INSERT OR IGNORE``, ``cursor.lastrowid``). Курсор
+``AdaptingCursor`` на PostgreSQL переводит их в ``%s``, ``ON CONFLICT`` и
+``RETURNING id``; на SQLite запросы выполняются без изменений.
+"""
+import re
+import sqlite3
+
+try:
+    import psycopg2
+    OperationalError = (sqlite3.OperationalError, psycopg2.OperationalError, psycopg2.ProgrammingError)
+    IntegrityError = (sqlite3.IntegrityError, psycopg2.IntegrityError)
+except ImportError:
+    psycopg2 = None
+    OperationalError = (sqlite3.OperationalError,)
+    IntegrityError = (sqlite3.IntegrityError,)
+
+# Ключи конфликта для INSERT OR REPLACE (PostgreSQL требует их явно)
+UPSERT_KEYS = {
+    'payment_details': ('user_id',),
+    'balances': ('user_id',),
+    'concept_hierarchies': ('session_id',),
+    'session_states': ('session_id',),
+    'session_summaries': ('session_id',),
+    'concept_fields': ('session_id', 'concept_name', 'field'),
+}
+
+# Таблицы без колонки id: для них RETURNING id не добавляется
+TABLES_WITHOUT_ID = {'schema_version', 'concept_fields'}
+
+_INSERT_OR_REPLACE = re.compile(
+    r'^\s*INSERT\s+OR\s+REPLACE\s+INTO\s+(\w+)\s*\(([^)]*)\)\s*VALUES\s*(\(.*\))\s*$',
+    re.IGNORECASE | re.DOTALL)
+_INSERT_OR_IGNORE = re.compile(r'^(\s*)INSERT\s+OR\s+IGNORE\s+INTO\b', re.IGNORECASE)
+_INSERT_VALUES = re.compile(r'^\s*INSERT\s+INTO\s+(\w+)\s*\([^)]*\)\s*VALUES\b', re.IGNORECASE)
+_AUTOINCREMENT = re.compile(r'\bINTEGER\s+PRIMARY\s+KEY\s+AUTOINCREMENT\b', re.IGNORECASE)
+_DOUBLE_QUOTED_DEFAULT = re.compile(r'\bDEFAULT\s+"([^"]*)"', re.IGNORECASE)
+
+
+def _translate_placeholders(sql: str, escape_percent: bool) -> str:
+    """Заменяет ? на %s вне строковых литералов (и экранирует % для psycopg2)"""
+    out = []
+    quote = None
+    for ch in sql:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == '?':
+            out.append('%s')
+            continue
+        if ch == '%' and escape_percent:
+            out.append('%%')
+            continue
+        out.append(ch)
+    return ''.join(out)
+
+
+def _translate_upsert(sql: str) -> str:
+    match = _INSERT_OR_REPLACE.match(sql)
+    if not match:
+        return sql
+    table, columns, values = match.group(1), match.group(2), match.group(3)
+    keys = UPSERT_KEYS.get(table.lower())
+    if not keys:
+        raise ValueError(f"Для INSERT OR REPLACE в {table} не задан ключ конфликта (UPSERT_KEYS)")
+    column_names = [col.strip() for col in columns.split(',') if col.strip()]
+    updates = [f"{col} = EXCLUDED.{col}" for col in column_names if col not in keys]
+    action = f"DO UPDATE SET {', '.join(updates)}" if updates else "DO NOTHING"
+    return (f"INSERT INTO {table} ({', '.join(column_names)}) VALUES {values} "
+            f"ON CONFLICT ({', '.join(keys)}) {action}")
+
+
+def translate(sql: str, dialect: str, has_params: bool = True) -> str:
+    """Переводит SQL в стиле SQLite в указанный диалект"""
+    if dialect != 'postgres':
+        return sql
+    sql = _translate_upsert(sql)
+    if _INSERT_OR_IGNORE.match(sql):
+        sql = _INSERT_OR_IGNORE.sub(r'\1INSERT INTO', sql, count=1).rstrip().rstrip(';')
+        sql += ' ON CONFLICT DO NOTHING'
+    sql = _AUTOINCREMENT.sub('SERIAL PRIMARY KEY', sql)
+    sql = _DOUBLE_QUOTED_DEFAULT.sub(r"DEFAULT '\1'", sql)
+    if '?' in sql or has_params:
+        sql = _translate_placeholders(sql, escape_percent=has_params)
+    return sql
+
+
+def _needs_returning_id(sql: str) -> bool:
+    match = _INSERT_VALUES.match(sql)
+    return bool(match) and match.group(1).lower() not in TABLES_WITHOUT_ID and \
+        'RETURNING' not in sql.upper()
+
+
+class AdaptingCursor:
+    """Курсор, выполняющий SQL в стиле SQLite на любом поддерживаемом диалекте"""
+
+    def __init__(self, cursor, dialect: str):
+        self._cursor = cursor
+        self.dialect = dialect
+        self.lastrowid = None
+
+    def execute(self, sql: str, params=()):
+        if self.dialect == 'postgres':
+            sql = translate(sql, self.dialect, has_params=bool(params))
+            returning = _needs_returning_id(sql)
+            if returning:
+                sql = sql.rstrip().rstrip(';') + ' RETURNING id'
+            self._cursor.execute(sql, tuple(params) if params else None)
+            self.lastrowid = None
+            if returning:
+                row = self._cursor.fetchone()
+                self.lastrowid = row[0] if row else None
+        else:
+            self._cursor.execute(sql, params)
+            self.lastrowid = self._cursor.lastrowid
+        return self
+
+    def executemany(self, sql: str, seq_of_params):
+        sql = translate(sql, self.dialect)
+        self._cursor.executemany(sql, seq_of_params)
+        self.lastrowid = None
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+def table_columns(cursor, table: str) -> list:
+    """Список колонок таблицы (замена PRAGMA table_info); пустой, если таблицы нет"""
+    dialect = getattr(cursor, 'dialect', 'sqlite')
+    if dialect == 'postgres':
+        cursor.execute('''SELECT column_name FROM information_schema.columns
+                          WHERE table_schema = current_schema() AND table_name = ?''', (table,))
+        return [row[0] for row in cursor.fetchall()]
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in cursor.fetchall()]
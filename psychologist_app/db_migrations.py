@@ -0,0 +1,514 @@
+"""Версионированные миграции схемы базы данных.
+
+Каждая миграция выполняется один раз: номер примененной версии
+записывается в таблицу schema_version. При старте воркера, когда все
+миграции уже применены, выполняется только один SELECT версий.
+Несколько воркеров, стартующих одновременно, применяют миграции по
+очереди под блокировкой (pg_advisory_xact_lock / BEGIN IMMEDIATE).
+"""
+import uuid
+
+from db_dialect import table_columns
+
+# Ключ advisory-блокировки миграций в PostgreSQL
+MIGRATION_LOCK_ID = 7305_2024
+
+# Колонки, добавленные в таблицы после их первого выпуска: старые базы
+# получают их в базовой миграции (новые создаются сразу с ними)
+LEGACY_COLUMNS = {
+    'users': [
+        ('referral_code', 'TEXT'),
+        ('user_id', 'TEXT'),
+        ('referred_by', 'INTEGER'),
+        ('language', "TEXT DEFAULT 'ru'"),
+        ('google_id', 'TEXT'),
+        ('email', 'TEXT'),
+        ('full_name', 'TEXT'),
+        ('two_factor_secret', 'TEXT'),
+        ('two_factor_enabled', 'INTEGER DEFAULT 0'),
+    ],
+    'event_map': [
+        ('emotion', 'TEXT'),
+        ('idea', 'TEXT'),
+        ('is_completed', 'INTEGER DEFAULT 0'),
+    ],
+    'feedback': [
+        ('about_self', 'TEXT'),
+        ('expectations', 'TEXT'),
+        ('expectations_met', 'TEXT'),
+        ('how_it_went', 'TEXT'),
+        ('feedback_type', "TEXT DEFAULT 'full'"),
+    ],
+}
+
+
+def _baseline_schema(c):
+    """Все таблицы приложения + колонки, которых нет в базах до версионирования"""
+    # Таблица пользователей
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  username TEXT UNIQUE NOT NULL,
+                  password_hash TEXT NOT NULL,
+                  referral_code TEXT UNIQUE,
+                  referred_by INTEGER,
+                  user_id TEXT UNIQUE,
+                  language TEXT DEFAULT 'ru',
+                  google_id TEXT UNIQUE,
+                  email TEXT,
+                  full_name TEXT,
+                  two_factor_secret TEXT,
+                  two_factor_enabled INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (referred_by) REFERENCES users (id))''')
+    
+    # Таблица рефералов (MLM структура)
+    c.execute('''CREATE TABLE IF NOT EXISTS referrals
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  referrer_id INTEGER NOT NULL,
+                  referred_id INTEGER NOT NULL,
+                  level INTEGER NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (referrer_id) REFERENCES users (id),
+                  FOREIGN KEY (referred_id) REFERENCES users (id),
+                  UNIQUE(referrer_id, referred_id))''')
+    
+    # Таблица балансов
+    c.execute('''CREATE TABLE IF NOT EXISTS balances
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  amount DECIMAL(10, 2) DEFAULT 0.00,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Таблица транзакций
+    c.execute('''CREATE TABLE IF NOT EXISTS transactions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  amount DECIMAL(10, 2) NOT NULL,
+                  transaction_type TEXT NOT NULL,
+                  referral_level INTEGER,
+                  from_user_id INTEGER,
+                  description TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id),
+                  FOREIGN KEY (from_user_id) REFERENCES users (id))''')
+    
+    # Таблица реквизитов
+    c.execute('''CREATE TABLE IF NOT EXISTS payment_details
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL UNIQUE,
+                  full_name TEXT,
+                  phone TEXT,
+                  birth_date DATE,
+                  inn TEXT,
+                  payment_form TEXT,
+                  details_json TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Таблица сессий
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  title TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Таблица сообщений
+    c.execute('''CREATE TABLE IF NOT EXISTS messages
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  session_id INTEGER NOT NULL,
+                  role TEXT NOT NULL,
+                  content TEXT NOT NULL,
+                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+    
+    # Таблица систем убеждений
+    c.execute('''CREATE TABLE IF NOT EXISTS concept_hierarchies
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  session_id INTEGER NOT NULL,
+                  concept_data TEXT NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+    
+    # Таблица для Нейрокарты
+    # Изменена структура: одна запись = одна комбинация событие-эмоция-идея
+    c.execute('''CREATE TABLE IF NOT EXISTS event_map
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  event_number INTEGER NOT NULL,
+                  event TEXT NOT NULL,
+                  emotion TEXT NOT NULL,
+                  idea TEXT NOT NULL,
+                  is_completed INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Таблица "До и После" для отслеживания убеждений
+    c.execute('''CREATE TABLE IF NOT EXISTS before_after_beliefs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  session_id INTEGER,
+                  belief_before TEXT NOT NULL,
+                  belief_after TEXT,
+                  is_task INTEGER DEFAULT 0,
+                  circle_number INTEGER,
+                  circle_name TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id),
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+    
+    # Таблица для обратной связи (баги, скриншоты, видео)
+    c.execute('''CREATE TABLE IF NOT EXISTS feedback
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  session_id INTEGER,
+                  description TEXT NOT NULL,
+                  file_path TEXT,
+                  file_type TEXT,
+                  feedback_type TEXT DEFAULT 'full',
+                  about_self TEXT,
+                  expectations TEXT,
+                  expectations_met TEXT,
+                  how_it_went TEXT,
+                  status TEXT DEFAULT 'new',
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id),
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+    
+    # Таблица для файлов обратной связи (для краткой формы с множественными файлами)
+    c.execute('''CREATE TABLE IF NOT EXISTS feedback_files
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  feedback_id INTEGER NOT NULL,
+                  file_path TEXT NOT NULL,
+                  file_type TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (feedback_id) REFERENCES feedback (id))''')
+    
+    # Таблица для статистики обучения GPT
+    c.execute('''CREATE TABLE IF NOT EXISTS gpt_statistics
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  session_id INTEGER NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  message_count INTEGER DEFAULT 0,
+                  avg_response_time REAL,
+                  user_satisfaction_score REAL,
+                  difficulty_encountered INTEGER DEFAULT 0,
+                  root_beliefs_identified INTEGER DEFAULT 0,
+                  positive_transformations INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (session_id) REFERENCES sessions (id),
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Таблица для корневых установок
+    c.execute('''CREATE TABLE IF NOT EXISTS root_beliefs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  session_id INTEGER,
+                  circle_number INTEGER NOT NULL,
+                  circle_name TEXT NOT NULL,
+                  negative_belief TEXT NOT NULL,
+                  positive_belief TEXT,
+                  is_task INTEGER DEFAULT 0,
+                  status TEXT DEFAULT 'identified',
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id),
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+    
+    # Таблица журнала сессий
+    c.execute('''CREATE TABLE IF NOT EXISTS session_journal
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  session_id INTEGER,
+                  date_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  feeling_after TEXT,
+                  emotion_after TEXT,
+                  how_session_went TEXT,
+                  interesting_thoughts TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id),
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+    
+    # Таблица интересных мыслей
+    c.execute('''CREATE TABLE IF NOT EXISTS interesting_thoughts
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  session_id INTEGER,
+                  thought_number INTEGER NOT NULL,
+                  title TEXT NOT NULL,
+                  thought_text TEXT NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id),
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+
+    # Базы, созданные до версионирования, могут не иметь поздних колонок
+    for table, columns in LEGACY_COLUMNS.items():
+        existing = table_columns(c, table)
+        for column, definition in columns:
+            if column not in existing:
+                c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                print(f"[Migration] Добавлена колонка {column} в {table}")
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_referrals_level ON referrals(level)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)')
+
+
+# Индексы под самые частые запросы (история сообщений, список сессий,
+# Нейрокарта, статистика, журнал, мысли, До/После)
+HOT_PATH_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_messages_session_ts ON messages(session_id, timestamp, id)',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_user_updated ON sessions(user_id, updated_at)',
+    'CREATE INDEX IF NOT EXISTS idx_event_map_user_number ON event_map(user_id, event_number, id)',
+    'CREATE INDEX IF NOT EXISTS idx_event_map_user_event ON event_map(user_id, event, event_number)',
+    'CREATE INDEX IF NOT EXISTS idx_gpt_statistics_session ON gpt_statistics(session_id)',
+    'CREATE INDEX IF NOT EXISTS idx_session_journal_user_date ON session_journal(user_id, date_time)',
+    'CREATE INDEX IF NOT EXISTS idx_interesting_thoughts_user_number ON interesting_thoughts(user_id, thought_number)',
+    'CREATE INDEX IF NOT EXISTS idx_before_after_user_created ON before_after_beliefs(user_id, created_at)',
+]
+
+
+def _hot_path_indexes(c):
+    """Индексы для горячих запросов"""
+    for statement in HOT_PATH_INDEXES:
+        c.execute(statement)
+
+
+def _archive_duplicates(c, table, condition) -> int:
+    """Переносит строки table, подходящие под condition, в {table}_duplicates; возвращает их число.
+
+    Дубликаты не удаляются бесследно: архив можно сверить и вернуть вручную.
+    """
+    c.execute(f'CREATE TABLE IF NOT EXISTS {table}_duplicates AS SELECT * FROM {table} WHERE 1 = 0')
+    c.execute(f'INSERT INTO {table}_duplicates SELECT * FROM {table} WHERE {condition}')
+    c.execute(f'DELETE FROM {table} WHERE {condition}')
+    return max(c.rowcount or 0, 0)
+
+
+def _backfill_user_codes(c):
+    """Реферальные коды и user_id для пользователей, созданных до их появления"""
+    from mlm_system import generate_referral_code
+
+    c.execute('SELECT id FROM users WHERE referral_code IS NULL OR user_id IS NULL')
+    users_without_codes = c.fetchall()
+
+    for (user_id,) in users_without_codes:
+        new_referral_code = generate_referral_code()
+        new_user_id_str = str(uuid.uuid4())[:8].upper()
+
+        # Проверяем уникальность
+        while True:
+            c.execute('SELECT id FROM users WHERE (referral_code = ? OR user_id = ?) AND id != ?',
+                      (new_referral_code, new_user_id_str, user_id))
+            if not c.fetchone():
+                break
+            new_referral_code = generate_referral_code()
+            new_user_id_str = str(uuid.uuid4())[:8].upper()
+
+        c.execute('''UPDATE users
+                     SET referral_code = COALESCE(referral_code, ?),
+                         user_id = COALESCE(user_id, ?)
+                     WHERE id = ?''',
+                  (new_referral_code, new_user_id_str, user_id))
+
+        # Создаем баланс если его нет
+        c.execute('SELECT id FROM balances WHERE user_id = ?', (user_id,))
+        if not c.fetchone():
+            c.execute('INSERT INTO balances (user_id, amount) VALUES (?, 0.00)', (user_id,))
+
+    if users_without_codes:
+        print(f"[Migration] Сгенерированы коды для {len(users_without_codes)} пользователей")
+
+
+def _messages_session_id_index(c):
+    """Индекс для хвоста истории: ORDER BY id DESC LIMIT n и догрузки по id"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id, id)')
+
+
+def _session_states(c):
+    """Состояние PsychologistAI по сессиям (этап, эмоции, система убеждений)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS session_states
+                 (session_id INTEGER PRIMARY KEY,
+                  state_json TEXT NOT NULL,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+
+
+def _session_summaries(c):
+    """Накопительное резюме старых реплик сессии (вышедших из окна истории)"""
+    c.execute('''CREATE TABLE IF NOT EXISTS session_summaries
+                 (session_id INTEGER PRIMARY KEY,
+                  summary TEXT NOT NULL,
+                  summarized_until INTEGER NOT NULL DEFAULT 0,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+
+
+def _concept_fields(c):
+    """Система убеждений по полям: строка на (сессия, идея, поле) вместо JSON целиком"""
+    c.execute('''CREATE TABLE IF NOT EXISTS concept_fields
+                 (session_id INTEGER NOT NULL,
+                  concept_name TEXT NOT NULL,
+                  field TEXT NOT NULL,
+                  concept_position INTEGER NOT NULL DEFAULT 0,
+                  field_position INTEGER NOT NULL DEFAULT 0,
+                  value_json TEXT NOT NULL,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (session_id, concept_name, field),
+                  FOREIGN KEY (session_id) REFERENCES sessions (id))''')
+
+
+def _money_minor_units(c):
+    """Суммы в копейках (целые), одна строка баланса на пользователя, ключи идемпотентности.
+
+    Дубликаты балансов (из гонки UPDATE/INSERT) суммируются в копейках в
+    строку с наименьшим id, остальные переносятся в balances_duplicates.
+    """
+    c.execute('ALTER TABLE balances ADD COLUMN amount_minor INTEGER NOT NULL DEFAULT 0')
+    c.execute('UPDATE balances SET amount_minor = CAST(ROUND(COALESCE(amount, 0) * 100) AS INTEGER)')
+    kept = 'id IN (SELECT MIN(id) FROM balances GROUP BY user_id HAVING COUNT(*) > 1)'
+    c.execute(f'''UPDATE balances
+                  SET amount_minor = (SELECT SUM(other.amount_minor) FROM balances other
+                                      WHERE other.user_id = balances.user_id),
+                      updated_at = CURRENT_TIMESTAMP
+                  WHERE {kept}''')
+    c.execute(f'UPDATE balances SET amount = amount_minor / 100.0 WHERE {kept}')
+    merged = _archive_duplicates(c, 'balances', 'id NOT IN (SELECT MIN(id) FROM balances GROUP BY user_id)')
+    if merged:
+        print(f"[Migration] Дубликаты балансов просуммированы и перенесены в balances_duplicates: {merged}")
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_balances_user_unique ON balances(user_id)')
+    c.execute('ALTER TABLE transactions ADD COLUMN amount_minor INTEGER')
+    c.execute('ALTER TABLE transactions ADD COLUMN idempotency_key TEXT')
+    c.execute('UPDATE transactions SET amount_minor = CAST(ROUND(amount * 100) AS INTEGER)')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_idempotency
+                 ON transactions(idempotency_key)''')
+
+
+def _payment_ledger(c):
+    """Журнал платежей: запись на платеж (ключ - пользователь и payment_id), комиссии начисляет фоновый обработчик"""
+    c.execute('''CREATE TABLE IF NOT EXISTS payment_ledger
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  payment_id TEXT NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  amount_minor INTEGER NOT NULL,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  applied_at TIMESTAMP,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  last_error TEXT,
+                  UNIQUE (user_id, payment_id),
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_payment_ledger_pending ON payment_ledger(applied_at, id)')
+
+
+def _dedupe_concept_hierarchies(c):
+    """Одна система убеждений на сессию: уникальный session_id.
+
+    INSERT OR REPLACE без уникального ключа копил по строке на каждый ход.
+    Остается самая новая строка сессии (по created_at, затем по id),
+    остальные переносятся в concept_hierarchies_duplicates.
+    """
+    removed = _archive_duplicates(c, 'concept_hierarchies', '''id <> (
+        SELECT newest.id FROM concept_hierarchies newest
+        WHERE newest.session_id = concept_hierarchies.session_id
+        ORDER BY newest.created_at IS NULL, newest.created_at DESC, newest.id DESC
+        LIMIT 1)''')
+    if removed:
+        print(f"[Migration] Старые версии систем убеждений перенесены в concept_hierarchies_duplicates: {removed}")
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_concept_hierarchies_session ON concept_hierarchies(session_id)')
+
+
+def _session_state_versions(c):
+    """Версия состояния сессии: воркеры сверяют с ней копию в памяти"""
+    c.execute('ALTER TABLE session_states ADD COLUMN version TEXT')
+
+
+def _concept_versions(c):
+    """Версия concept_fields сессии: воркеры сверяют с ней последнее сохранение в памяти"""
+    c.execute('ALTER TABLE sessions ADD COLUMN concept_version TEXT')
+
+
+# (версия, название, функция миграции) - строго по возрастанию версии.
+# Примененные миграции не меняются: изменения схемы - только новой версией
+MIGRATIONS = [
+    (0, 'baseline_schema', _baseline_schema),
+    (1, 'hot_path_indexes', _hot_path_indexes),
+    (2, 'backfill_user_codes', _backfill_user_codes),
+    (3, 'messages_session_id_index', _messages_session_id_index),
+    (4, 'session_states', _session_states),
+    (5, 'session_summaries', _session_summaries),
+    (6, 'concept_fields', _concept_fields),
+    (7, 'money_minor_units', _money_minor_units),
+    (8, 'payment_ledger', _payment_ledger),
+    (9, 'dedupe_concept_hierarchies', _dedupe_concept_hierarchies),
+    (10, 'session_state_versions', _session_state_versions),
+    (11, 'concept_versions', _concept_versions),
+]
+
+
+def get_applied_versions(c) -> set:
+    c.execute('SELECT version FROM schema_version')
+    return {row[0] for row in c.fetchall()}
+
+
+def _pending(applied: set, target=None) -> list:
+    return [m for m in MIGRATIONS if m[0] not in applied and (target is None or m[0] <= target)]
+
+
+def _lock(c):
+    """Блокировка миграций до конца транзакции (одна на все воркеры)"""
+    if getattr(c, 'dialect', 'sqlite') == 'postgres':
+        c.execute('SELECT pg_advisory_xact_lock(?)', (MIGRATION_LOCK_ID,))
+    else:
+        c.execute('BEGIN IMMEDIATE')
+
+
+def apply_migrations(conn, target=None) -> list:
+    """Применяет недостающие миграции по порядку, каждую в своей транзакции.
+
+    target - последняя версия, которую нужно применить (по умолчанию все).
+    """
+    c = conn.cursor()
+
+    # Быстрый путь: схема актуальна - один SELECT без блокировок
+    try:
+        pending = _pending(get_applied_versions(c), target)
+    except Exception:
+        pending = _pending(set(), target)
+    conn.rollback()
+    if not pending:
+        return []
+
+    newly_applied = []
+    while True:
+        try:
+            _lock(c)
+            c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                         (version INTEGER PRIMARY KEY,
+                          name TEXT NOT NULL,
+                          applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+            # Под блокировкой перечитываем версии: их мог применить другой воркер
+            pending = _pending(get_applied_versions(c), target)
+            if not pending:
+                conn.commit()
+                break
+            version, name, migrate = pending[0]
+            migrate(c)
+            c.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"[Migration] Ошибка миграции: {e}")
+            raise
+        print(f"[Migration] Применена миграция {version}: {name}")
+        newly_applied.append(version)
+    return newly_applied
@@ -0,0 +1,375 @@
+"""Пул соединений с базой данных (SQLite локально, PostgreSQL на Railway)"""
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from db_dialect import AdaptingCursor
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psychologist.db')
+
+# Размер пула и таймауты настраиваются через переменные окружения
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+# Соединение, простоявшее в пуле дольше этого времени, проверяется SELECT 1
+POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTH_CHECK', '30'))
+# Соединение старше этого времени пересоздается (0 - без ограничения)
+POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', '1800'))
+
+# Профиль SQLite: wal - журнал WAL (чтение параллельно с записью) и настройки ниже,
+# default - настройки библиотеки по умолчанию (журнал отката)
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'wal')
+# Ожидание блокировки записи вместо немедленного "database is locked" (мс)
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', '5000'))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# Отрицательное значение - в килобайтах (на соединение)
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', '-20000'))
+SQLITE_TEMP_STORE = os.environ.get('SQLITE_TEMP_STORE', 'MEMORY')
+
+
+class PoolTimeoutError(Exception):
+    """В пуле нет свободных соединений за отведенное время"""
+
+
+class PooledConnection:
+    """Соединение, взятое из пула. close() возвращает его в пул, а не закрывает"""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @property
+    def dialect(self):
+        return self._pool.dialect
+
+    def cursor(self, *args, **kwargs):
+        """Курсор, понимающий SQL в стиле SQLite на любом диалекте"""
+        return AdaptingCursor(self._raw.cursor(*args, **kwargs), self._pool.dialect)
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        """Возвращает соединение в пул (повторный вызов безопасен)"""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+    @property
+    def closed(self):
+        return self._raw is None
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise AttributeError(f"Соединение уже возвращено в пул: {name}")
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._raw is not None:
+                if exc_type is None:
+                    self._raw.commit()
+                else:
+                    self._raw.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # Страховка: соединение, которое забыли закрыть, все равно вернется в пул
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул соединений с проверкой здоровья"""
+
+    def __init__(self, connect, dialect='sqlite', max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL, recycle=POOL_RECYCLE):
+        self._connect = connect
+        self.dialect = dialect
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.recycle = recycle
+        self._cond = threading.Condition()
+        # Свободные соединения: (raw, last_used)
+        self._idle = deque()
+        self._created_at = {}
+        self._size = 0
+        self._stats = {'created': 0, 'discarded': 0, 'checkouts': 0, 'waits': 0, 'timeouts': 0}
+
+    def acquire(self) -> PooledConnection:
+        """Берет соединение из пула, при необходимости создает новое"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            raw = None
+            last_used = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeoutError(
+                            f"Нет свободных соединений в пуле (размер {self.max_size})")
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+                if self._idle:
+                    raw, last_used = self._idle.pop()
+                else:
+                    # Резервируем место до создания соединения, чтобы не превысить лимит
+                    self._size += 1
+
+            if raw is None:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created_at[id(raw)] = time.monotonic()
+                    self._stats['created'] += 1
+            elif not self._is_healthy(raw, last_used):
+                self._discard(raw)
+                continue
+
+            with self._cond:
+                self._stats['checkouts'] += 1
+            return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Возвращает соединение в пул, откатывая незавершенную транзакцию"""
+        try:
+            if getattr(raw, 'closed', 0):
+                raise ConnectionError("соединение закрыто")
+            raw.rollback()
+        except Exception:
+            self._discard(raw)
+            return
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Контекстный менеджер: commit при успехе, rollback при ошибке, возврат в пул"""
+        conn = self.acquire()
+        with conn:
+            yield conn
+
+    def _is_healthy(self, raw, last_used) -> bool:
+        now = time.monotonic()
+        created_at = self._created_at.get(id(raw), now)
+        if self.recycle and now - created_at > self.recycle:
+            return False
+        if now - last_used < self.health_check_interval:
+            return True
+        try:
+            cur = raw.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchone()
+            cur.close()
+            raw.rollback()
+            return True
+        except Exception as e:
+            print(f"[DBPool] Соединение не прошло проверку, пересоздаем: {e}")
+            return False
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(raw), None)
+            self._size -= 1
+            self._stats['discarded'] += 1
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        """Текущее состояние пула (для мониторинга)"""
+        with self._cond:
+            idle = len(self._idle)
+            return dict(self._stats, dialect=self.dialect, max_size=self.max_size,
+                        size=self._size, idle=idle, in_use=self._size - idle)
+
+    def close_all(self):
+        """Закрывает все свободные соединения (при остановке процесса)"""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for raw, _ in idle:
+            self._discard(raw)
+
+
+def sqlite_pragmas(profile=None) -> list:
+    """PRAGMA профиля SQLite: [(имя, значение)] в порядке применения"""
+    profile = profile or SQLITE_PROFILE
+    if profile == 'default':
+        return []
+    if profile != 'wal':
+        raise ValueError(f"Неизвестный профиль SQLite: {profile}")
+    return [
+        ('busy_timeout', SQLITE_BUSY_TIMEOUT),
+        ('journal_mode', 'WAL'),
+        ('synchronous', SQLITE_SYNCHRONOUS),
+        ('mmap_size', SQLITE_MMAP_SIZE),
+        ('cache_size', SQLITE_CACHE_SIZE),
+        ('temp_store', SQLITE_TEMP_STORE),
+    ]
+
+
+def _sqlite_connector(db_path, pragmas=None):
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+    reported = []
+
+    def connect():
+        # Соединение переходит между потоками вместе с пулом
+        raw = sqlite3.connect(db_path, check_same_thread=False)
+        # PRAGMA применяются один раз - при создании соединения пула
+        for name, value in pragmas:
+            row = raw.execute(f'PRAGMA {name} = {value}').fetchone()
+            if name == 'journal_mode' and not reported:
+                reported.append(True)
+                print(f"[DBPool] SQLite: journal_mode={row[0] if row else '?'}, "
+                      + ", ".join(f"{n}={v}" for n, v in pragmas if n != 'journal_mode'))
+        return raw
+    return connect
+
+
+def _postgres_connector(database_url):
+    # URL разбираем один раз, а не при каждом соединении
+    result = urlparse(database_url)
+    params = {
+        'database': result.path[1:],  # Убираем первый /
+        'user': result.username,
+        'password': result.password,
+        'host': result.hostname,
+        'port': result.port
+    }
+
+    def connect():
+        import psycopg2
+        return psycopg2.connect(**params)
+    return connect
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Возвращает общий пул процесса (создается при первом обращении)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                database_url = os.environ.get('DATABASE_URL')
+                if database_url:
+                    _pool = ConnectionPool(_postgres_connector(database_url), dialect='postgres')
+                else:
+                    _pool = ConnectionPool(_sqlite_connector(DB_PATH), dialect='sqlite')
+    return _pool
+
+
+def get_db() -> PooledConnection:
+    """Получает соединение из пула; close() возвращает его обратно"""
+    return get_pool().acquire()
+
+
+def db_connection():
+    """Контекстный менеджер для соединения из общего пула"""
+    return get_pool().connection()
+
+
+class UnitOfWork:
+    """Все записи одной операции - одна транзакция на одном соединении.
+
+    Действия, которые можно выполнять только после фиксации (обновление
+    кэшей, события клиенту), регистрируются в after_commit; откат кэшей при
+    ошибке - в on_rollback.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self._after_commit = []
+        self._on_rollback = []
+
+    def after_commit(self, fn, *args, **kwargs):
+        self._after_commit.append((fn, args, kwargs))
+
+    def on_rollback(self, fn, *args, **kwargs):
+        self._on_rollback.append((fn, args, kwargs))
+
+    @contextmanager
+    def savepoint(self, name):
+        """Часть транзакции, ошибка в которой откатывает только ее"""
+        self.cursor.execute(f'SAVEPOINT {name}')
+        try:
+            yield self.cursor
+        except Exception:
+            self.cursor.execute(f'ROLLBACK TO SAVEPOINT {name}')
+            self.cursor.execute(f'RELEASE SAVEPOINT {name}')
+            raise
+        self.cursor.execute(f'RELEASE SAVEPOINT {name}')
+
+    def commit(self):
+        self.conn.commit()
+        self._run(self._after_commit)
+
+    def rollback(self):
+        try:
+            self.conn.rollback()
+        finally:
+            self._run(self._on_rollback)
+
+    def _run(self, callbacks):
+        callbacks_, callbacks[:] = list(callbacks), []
+        for fn, args, kwargs in callbacks_:
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"[DBPool] Ошибка в действии после транзакции: {e}")
+
+
+@contextmanager
+def unit_of_work(conn=None, immediate=False):
+    """Транзакция на соединении из пула (или на переданном): commit при успехе, rollback при ошибке.
+
+    immediate=True - для транзакций, которые сначала читают, а потом пишут:
+    на SQLite блокировка записи берется сразу (BEGIN IMMEDIATE, с ожиданием
+    busy_timeout), иначе повышение чтения до записи в режиме WAL сразу
+    падает с "database is locked", если база изменилась после чтения.
+    """
+    own = conn is None
+    conn = get_db() if own else conn
+    uow = UnitOfWork(conn)
+    try:
+        if immediate and conn.dialect == 'sqlite':
+            uow.cursor.execute('BEGIN IMMEDIATE')
+        yield uow
+        uow.commit()
+    except BaseException:
+        uow.rollback()
+        raise
+    finally:
+        if own:
+            conn.close()
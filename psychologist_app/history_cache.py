@@ -0,0 +1,159 @@
+"""Кэш истории диалога по сессиям.
+
+Для каждой сессии в памяти хранится только хвост истории (последние
+HISTORY_WINDOW сообщений - в GPT уходят последние 15) и общее число
+сообщений. Новые сообщения дописываются в кэш при вставке, холодная
+сессия загружается одним запросом с LIMIT, поэтому стоимость хода не
+растет с длиной сессии. Редко используемые сессии вытесняются (LRU).
+
+Сообщения фиксируются не обязательно в порядке id (сообщение пользователя
+и ответ сохраняют разные потоки, на PostgreSQL меньший id последовательности
+может зафиксироваться позже большего), поэтому сообщение с меньшим id
+встает в хвост на свое место, а догрузка из БД сверяет весь хвост.
+"""
+import os
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+# Сколько последних сообщений сессии держать в памяти
+HISTORY_WINDOW = int(os.environ.get('HISTORY_CACHE_WINDOW', '50'))
+# Сколько сессий держать в кэше одновременно
+HISTORY_CACHE_SESSIONS = int(os.environ.get('HISTORY_CACHE_SESSIONS', '1000'))
+
+
+class SessionHistory:
+    """Хвост истории одной сессии: сообщения с id и общее их число"""
+
+    def __init__(self, window, messages, count):
+        self.messages = deque(messages, maxlen=window)
+        self.count = count
+
+    @property
+    def first_id(self):
+        return self.messages[0]['id'] if self.messages else 0
+
+    def append(self, message):
+        """Ставит сообщение в хвост по порядку id"""
+        ids = [m['id'] for m in self.messages]
+        position = bisect_left(ids, message['id'])
+        if position < len(ids) and ids[position] == message['id']:
+            # Сообщение уже попало в кэш при загрузке из БД
+            return
+        if len(ids) == self.messages.maxlen:
+            if position == 0:
+                # Старше всего хвоста: в окно не попадает (в count оно уже учтено при загрузке)
+                return
+            self.messages.popleft()
+            position -= 1
+        self.messages.insert(position, message)
+        self.count += 1
+
+
+def turn_history(messages, message_id) -> list:
+    """История для хода на сообщение message_id: без сообщений пользователя, отправленных после него.
+
+    Ходы сессии выполняются по очереди, поэтому более поздние ответы
+    ассистента - ответы на предыдущие ходы: они остаются, а сообщение хода
+    ставится последним.
+    """
+    current = [m for m in messages if m['id'] == message_id]
+    earlier = [m for m in messages
+               if m['id'] < message_id or (m['id'] > message_id and m['role'] != 'user')]
+    return earlier + current
+
+
+class HistoryCache:
+    """Потокобезопасный LRU-кэш историй сессий"""
+
+    def __init__(self, max_sessions=HISTORY_CACHE_SESSIONS, window=HISTORY_WINDOW):
+        self.max_sessions = max(1, max_sessions)
+        self.window = max(1, window)
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, c, session_id) -> list:
+        """История сессии (последние window сообщений) в порядке отправки.
+
+        Каждое сообщение - {'id', 'role', 'content'}. Кэш догружает из БД
+        сообщения, добавленные в обход него (например, другим воркером).
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                self._sessions.move_to_end(session_id)
+                first_id = entry.first_id
+        if entry is not None:
+            entry = self._catch_up(c, session_id, first_id)
+        if entry is None:
+            entry = self._load(c, session_id)
+        with self._lock:
+            return list(entry.messages)
+
+    def append(self, session_id, message_id, role, content):
+        """Дописывает только что сохраненное сообщение в кэш сессии"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry.append({'id': message_id, 'role': role, 'content': content})
+
+    def message_count(self, session_id):
+        """Число сообщений в сессии (None, если сессии нет в кэше)"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry.count if entry is not None else None
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, sessions=len(self._sessions),
+                        max_sessions=self.max_sessions, window=self.window)
+
+    def _load(self, c, session_id):
+        c.execute('''SELECT id, role, content FROM messages
+                     WHERE session_id = ?
+                     ORDER BY id DESC LIMIT ?''', (session_id, self.window))
+        rows = c.fetchall()
+        rows.reverse()
+        if len(rows) < self.window:
+            count = len(rows)
+        else:
+            c.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,))
+            count = c.fetchone()[0]
+        entry = SessionHistory(self.window, [{'id': row[0], 'role': row[1], 'content': row[2]} for row in rows], count)
+        with self._lock:
+            self._stats['misses'] += 1
+            self._sessions[session_id] = entry
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self._stats['evictions'] += 1
+        return entry
+
+    def _catch_up(self, c, session_id, first_id):
+        # Весь хвост начиная с первого сообщения кэша: находятся и новые сообщения,
+        # и зафиксированные позже сообщения с меньшим id
+        c.execute('''SELECT id, role, content FROM messages
+                     WHERE session_id = ? AND id >= ?
+                     ORDER BY id ASC LIMIT ?''', (session_id, first_id, 2 * self.window))
+        rows = c.fetchall()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or len(rows) >= 2 * self.window:
+                # Вытеснена или сильно отстала - перечитываем хвост целиком
+                self._sessions.pop(session_id, None)
+                return None
+            self._stats['hits'] += 1
+            known = {m['id'] for m in entry.messages}
+            for row in rows:
+                if row[0] not in known:
+                    entry.append({'id': row[0], 'role': row[1], 'content': row[2]})
+            return entry
+
+
+# Общий кэш процесса
+history_cache = HistoryCache()
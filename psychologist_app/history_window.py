@@ -0,0 +1,182 @@
+"""Окно истории для промпта GPT по бюджету токенов и накопительное резюме сессии.
+
+Вместо фиксированных 15 последних сообщений в промпт попадают последние
+сообщения, которые умещаются в HISTORY_TOKEN_BUDGET токенов. Реплики,
+вышедшие из окна, сворачиваются в резюме сессии (таблица session_summaries):
+к резюме добавляются только новые вышедшие реплики, граница хранится в
+summarized_until (id последнего учтенного сообщения). Вышедшие реплики
+читаются из messages по id (между summarized_until и началом окна), а не
+из хвоста истории в памяти: в длинной сессии они выходят и из него.
+
+Токены считаются через tiktoken, если он установлен, иначе - приблизительно
+по длине текста.
+"""
+import os
+import threading
+
+from db_pool import db_connection
+from session_store import MemorySessionStore
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('o200k_base')
+except Exception:
+    _encoding = None
+
+# Бюджет токенов на историю в промпте
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', '2000'))
+# Предельная длина резюме (max_tokens вызова GPT)
+SUMMARY_MAX_TOKENS = int(os.environ.get('SUMMARY_MAX_TOKENS', '300'))
+# Сколько вышедших из окна реплик копить перед обновлением резюме
+SUMMARY_MIN_BATCH = int(os.environ.get('SUMMARY_MIN_BATCH', '2'))
+# Сколько реплик добавлять к резюме за один вызов GPT (остаток - следующими вызовами)
+SUMMARY_MAX_BATCH = int(os.environ.get('SUMMARY_MAX_BATCH', '50'))
+
+# Служебные токены на каждое сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Без tiktoken: для русского текста в среднем ~3 символа на токен
+    return len(text) // 3 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get('content', '')) + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_window(history: list, budget: int = HISTORY_TOKEN_BUDGET):
+    """Делит историю на (старые, окно): окно - самые новые сообщения в пределах бюджета.
+
+    Последнее сообщение попадает в окно всегда, даже если оно одно больше бюджета.
+    """
+    used = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        tokens = message_tokens(history[i])
+        if used + tokens > budget and start < len(history):
+            break
+        used += tokens
+        start = i
+    return history[:start], history[start:]
+
+
+class SummaryStore:
+    """Резюме сессий в таблице session_summaries с LRU в памяти процесса"""
+
+    def __init__(self, cache=None):
+        self.cache = cache or MemorySessionStore()
+
+    def get(self, session_id):
+        """{'summary', 'summarized_until'} или None"""
+        record = self.cache.get(session_id)
+        if record is None:
+            with db_connection() as conn:
+                c = conn.cursor()
+                c.execute('SELECT summary, summarized_until FROM session_summaries WHERE session_id = ?',
+                          (session_id,))
+                row = c.fetchone()
+            if row is None:
+                return None
+            record = {'summary': row[0], 'summarized_until': row[1]}
+            self.cache.set(session_id, record)
+        return record
+
+    def set(self, session_id, summary, summarized_until):
+        record = {'summary': summary, 'summarized_until': summarized_until}
+        with db_connection() as conn:
+            conn.cursor().execute('''INSERT OR REPLACE INTO session_summaries
+                                     (session_id, summary, summarized_until, updated_at)
+                                     VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
+                                  (session_id, summary, summarized_until))
+        self.cache.set(session_id, record)
+
+    def delete(self, session_id):
+        self.cache.delete(session_id)
+        with db_connection() as conn:
+            conn.cursor().execute('DELETE FROM session_summaries WHERE session_id = ?', (session_id,))
+
+
+class HistoryWindow:
+    """Окно истории по бюджету токенов плюс накопительное резюме вышедших реплик"""
+
+    def __init__(self, budget=HISTORY_TOKEN_BUDGET, store=None, min_batch=SUMMARY_MIN_BATCH,
+                 max_batch=SUMMARY_MAX_BATCH):
+        self.budget = budget
+        self.store = store or SummaryStore()
+        self.min_batch = max(1, min_batch)
+        self.max_batch = max(self.min_batch, max_batch)
+        self._lock = threading.Lock()
+        # Сессии, для которых резюме сейчас обновляется
+        self._updating = set()
+        # Начало окна на момент последней проверки сессии (окно не сдвинулось - проверять нечего)
+        self._window_starts = MemorySessionStore()
+
+    def build(self, session_id, history: list):
+        """Возвращает (резюме, окно, старые сообщения) для промпта"""
+        older, window = fit_window(history, self.budget)
+        try:
+            record = self.store.get(session_id)
+        except Exception as e:
+            print(f"[HistoryWindow] Ошибка загрузки резюме сессии {session_id}: {e}")
+            record = None
+        return (record['summary'] if record else ''), window, older
+
+    def window_moved(self, session_id, window_start_id) -> bool:
+        """True, если начало окна сдвинулось с прошлой проверки (могли выйти новые реплики)"""
+        if not window_start_id or self._window_starts.get(session_id) == window_start_id:
+            return False
+        self._window_starts.set(session_id, window_start_id)
+        return True
+
+    def _aged_out(self, session_id, after_id, before_id) -> list:
+        """Реплики сессии с id в (after_id, before_id) - до max_batch самых ранних"""
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.execute('''SELECT id, role, content FROM messages
+                         WHERE session_id = ? AND id > ? AND id < ?
+                         ORDER BY id LIMIT ?''', (session_id, after_id, before_id, self.max_batch))
+            return [{'id': row[0], 'role': row[1], 'content': row[2]} for row in c.fetchall()]
+
+    def update_summary(self, session_id, window_start_id, summarize) -> bool:
+        """Добавляет к резюме реплики сессии до начала окна (id < window_start_id), еще не вошедшие в него.
+
+        Реплики добавляются пачками по max_batch (по вызову summarize на пачку).
+        summarize(previous_summary, messages) -> новый текст резюме или None.
+        Возвращает True, если резюме обновлено.
+        """
+        with self._lock:
+            if session_id in self._updating:
+                return False
+            self._updating.add(session_id)
+        try:
+            record = self.store.get(session_id) or {'summary': '', 'summarized_until': 0}
+            summary, summarized_until = record['summary'], record['summarized_until']
+            updated = False
+            while True:
+                pending = self._aged_out(session_id, summarized_until, window_start_id)
+                if len(pending) < (self.min_batch if not updated else 1):
+                    return updated
+                new_summary = summarize(summary, pending)
+                if not new_summary:
+                    return updated
+                summary, summarized_until = new_summary, pending[-1]['id']
+                self.store.set(session_id, summary, summarized_until)
+                updated = True
+                print(f"[HistoryWindow] Резюме сессии {session_id} обновлено (+{len(pending)} реплик)")
+                if len(pending) < self.max_batch:
+                    return True
+        except Exception as e:
+            print(f"[HistoryWindow] Ошибка обновления резюме сессии {session_id}: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._updating.discard(session_id)
+
+    def delete(self, session_id):
+        self._window_starts.delete(session_id)
+        self.store.delete(session_id)
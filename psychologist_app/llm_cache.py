@@ -0,0 +1,106 @@
+"""Кэш ответов GPT для детерминированных промптов (экстракторы).
+
+Ключ - хэш от (модель, сообщения, temperature, max_tokens): одинаковый
+промпт с теми же параметрами возвращает сохраненный ответ без обращения
+к API. В памяти - LRU с TTL; при LLM_CACHE_DB ответы дополнительно
+хранятся в отдельном SQLite-файле и переживают перезапуск.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', '2000'))
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', str(24 * 3600)))
+# Путь к SQLite-файлу для хранения на диске (пусто - только память)
+LLM_CACHE_DB = os.environ.get('LLM_CACHE_DB', '')
+
+
+def cache_key(model: str, messages: list, temperature: float, max_tokens: int) -> str:
+    payload = json.dumps([model, messages, temperature, max_tokens], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """LRU-кэш ответов с TTL, счетчиками и необязательным хранением в SQLite"""
+
+    def __init__(self, max_size=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL, db_path=LLM_CACHE_DB):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, expires_at)
+        self._items = OrderedDict()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS llm_cache
+                                (key TEXT PRIMARY KEY,
+                                 value TEXT NOT NULL,
+                                 expires_at REAL NOT NULL)''')
+            self._db.commit()
+
+    def get(self, model, messages, temperature, max_tokens):
+        """Сохраненный ответ или None"""
+        key = cache_key(model, messages, temperature, max_tokens)
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at >= now:
+                    self._items.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+                del self._items[key]
+            if self._db is not None:
+                row = self._db.execute('SELECT value, expires_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+                if row and row[1] >= now:
+                    self._remember(key, row[0], row[1])
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                    return row[0]
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, model, messages, temperature, max_tokens, value):
+        key = cache_key(model, messages, temperature, max_tokens)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+            self._stats['stores'] += 1
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                                 (key, value, expires_at))
+                self._db.commit()
+
+    def _remember(self, key, value, expires_at):
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def purge_expired(self) -> int:
+        """Удаляет просроченные записи с диска; возвращает их число"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute('DELETE FROM llm_cache WHERE expires_at < ?', (time.time(),))
+            self._db.commit()
+            return cursor.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(self._stats, size=len(self._items), max_size=self.max_size,
+                        hit_ratio=round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+                        persistent=self._db is not None)
+
+
+# Общий кэш процесса (None, если кэширование отключено)
+llm_cache = LLMCache() if LLM_CACHE_ENABLED else None
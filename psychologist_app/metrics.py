@@ -0,0 +1,57 @@
+"""Метрики процесса для мониторинга: пул соединений, кэш префикса промпта и т.д.
+
+Источники регистрируются в приложении (register_metrics). Собранные
+метрики раз в METRICS_LOG_INTERVAL секунд пишутся в лог строкой
+[Metrics] {...} (0 - не писать) и отдаются /api/metrics по токену
+METRICS_TOKEN.
+"""
+import json
+import os
+import threading
+import time
+
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', '60'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# [(имя, функция без аргументов -> dict или list)]
+_sources = []
+
+
+def register_metrics(name, collect):
+    _sources.append((name, collect))
+
+
+def collect_metrics() -> dict:
+    """Метрики всех источников; ошибка одного источника не мешает остальным"""
+    metrics = {'pid': os.getpid()}
+    for name, collect in _sources:
+        try:
+            metrics[name] = collect()
+        except Exception as e:
+            metrics[name] = {'error': str(e)}
+    return metrics
+
+
+class MetricsReporter:
+    """Фоновый поток, периодически печатающий метрики процесса"""
+
+    def __init__(self, interval=METRICS_LOG_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            print(f"[Metrics] {json.dumps(collect_metrics(), ensure_ascii=False, default=str)}")
+
+
+metrics_reporter = MetricsReporter()
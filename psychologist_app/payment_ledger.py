@@ -0,0 +1,252 @@
+"""Журнал платежей и фоновое начисление реферальных комиссий.
+
+Раньше process_payment распределял комиссии по всей цепочке (до 8 уровней)
+прямо в обработчике запроса. Теперь запрос только дописывает платеж в
+payment_ledger (одна вставка; payment_id уникален в пределах пользователя,
+повтор того же платежа игнорируется, а тот же payment_id с другой суммой -
+PaymentConflictError) и будит фоновый обработчик.
+
+Записи журнала не удаляются и не меняются, кроме отметки обработки
+(applied_at, attempts, last_error). LedgerWorker берет пачку
+необработанных записей и в одной транзакции начисляет комиссии
+(process_payment с payment_id как ключом идемпотентности) и ставит
+applied_at: комиссии и отметка фиксируются вместе, поэтому платеж
+начисляется ровно один раз - и после падения процесса, и при нескольких
+обработчиках. Ошибка одной записи (точка сохранения) не мешает остальным;
+после LEDGER_MAX_ATTEMPTS попыток запись пропускается до ручного повтора.
+
+python payment_ledger.py --stats | --drain | --replay [--from ID] [--to ID]
+"""
+import os
+import threading
+import time
+import uuid
+
+from db_dialect import IntegrityError
+from db_pool import db_connection, unit_of_work
+from mlm_system import from_minor, get_payment_transactions, process_payment, to_minor
+
+LEDGER_BATCH_SIZE = int(os.environ.get('LEDGER_BATCH_SIZE', '100'))
+# Как часто обработчик проверяет журнал без пробуждения (записи других процессов)
+LEDGER_POLL_INTERVAL = float(os.environ.get('LEDGER_POLL_INTERVAL', '5'))
+LEDGER_MAX_ATTEMPTS = int(os.environ.get('LEDGER_MAX_ATTEMPTS', '5'))
+
+
+class PaymentConflictError(Exception):
+    """payment_id пользователя уже записан с другой суммой"""
+
+
+def _amount_minor(amount) -> int:
+    try:
+        amount_minor = to_minor(amount)
+    except (ArithmeticError, TypeError, ValueError):
+        raise ValueError(f"Некорректная сумма платежа: {amount!r}")
+    if amount_minor <= 0:
+        raise ValueError(f"Сумма платежа должна быть больше нуля: {amount!r}")
+    return amount_minor
+
+
+def record_payment(user_id, amount, payment_id=None, c=None) -> str:
+    """Дописывает платеж в журнал; возвращает payment_id. Повтор того же платежа игнорируется.
+
+    ValueError - сумма не число или не больше нуля; PaymentConflictError -
+    payment_id пользователя уже записан с другой суммой. С курсором c запись
+    идет в транзакции вызывающего: обработчик увидит ее после фиксации
+    (вызывающий может разбудить его ledger_worker.wake()).
+    """
+    amount_minor = _amount_minor(amount)
+    payment_id = str(payment_id or uuid.uuid4().hex)
+    if c is not None:
+        c.execute('''INSERT OR IGNORE INTO payment_ledger (payment_id, user_id, amount_minor)
+                     VALUES (?, ?, ?)''', (payment_id, user_id, amount_minor))
+        if c.rowcount == 0:
+            c.execute('SELECT amount_minor FROM payment_ledger WHERE user_id = ? AND payment_id = ?',
+                      (user_id, payment_id))
+            row = c.fetchone()
+            if row and row[0] != amount_minor:
+                raise PaymentConflictError(
+                    f"Платеж {payment_id} уже принят на сумму {from_minor(row[0])}, а не {from_minor(amount_minor)}")
+        return payment_id
+    with db_connection() as conn:
+        record_payment(user_id, amount, payment_id, conn.cursor())
+    ledger_worker.wake()
+    return payment_id
+
+
+def payment_status(user_id, payment_id, c=None):
+    """{'payment_id', 'user_id', 'amount', 'status', 'attempts', 'error', 'transactions'} или None"""
+    if c is None:
+        with db_connection() as conn:
+            return payment_status(user_id, payment_id, conn.cursor())
+    c.execute('''SELECT amount_minor, applied_at, attempts, last_error
+                 FROM payment_ledger WHERE user_id = ? AND payment_id = ?''', (user_id, str(payment_id)))
+    row = c.fetchone()
+    if not row:
+        return None
+    amount_minor, applied_at, attempts, last_error = row
+    if applied_at:
+        status = 'applied'
+    elif attempts >= LEDGER_MAX_ATTEMPTS:
+        status = 'failed'
+    else:
+        status = 'pending'
+    return {
+        'payment_id': str(payment_id),
+        'user_id': user_id,
+        'amount': float(from_minor(amount_minor)),
+        'status': status,
+        'attempts': attempts,
+        'error': last_error,
+        'transactions': get_payment_transactions(user_id, payment_id, c) if applied_at else [],
+    }
+
+
+def _apply_entry(uow, ledger_id, payment_id, user_id, amount_minor) -> str:
+    """Начисляет комиссии записи в точке сохранения; 'applied' | 'duplicate' | 'failed'"""
+    try:
+        with uow.savepoint('ledger_entry'):
+            if get_payment_transactions(user_id, payment_id, uow.cursor):
+                outcome = 'duplicate'
+            else:
+                process_payment(user_id, from_minor(amount_minor), payment_id, uow.cursor)
+                outcome = 'applied'
+    except IntegrityError:
+        # Комиссии платежа уже записал другой обработчик
+        outcome = 'duplicate'
+    except Exception as e:
+        uow.cursor.execute('''UPDATE payment_ledger SET attempts = attempts + 1, last_error = ?
+                              WHERE id = ?''', (str(e)[:500], ledger_id))
+        print(f"[PaymentLedger] Ошибка начисления по платежу {payment_id}: {e}")
+        return 'failed'
+    uow.cursor.execute('''UPDATE payment_ledger SET applied_at = CURRENT_TIMESTAMP, attempts = attempts + 1,
+                                                   last_error = NULL
+                          WHERE id = ? AND applied_at IS NULL''', (ledger_id,))
+    return outcome
+
+
+def apply_pending(batch_size=LEDGER_BATCH_SIZE) -> dict:
+    """Обрабатывает одну пачку необработанных записей одной транзакцией"""
+    counts = {'applied': 0, 'duplicate': 0, 'failed': 0}
+    with unit_of_work(immediate=True) as uow:
+        uow.cursor.execute('''SELECT id, payment_id, user_id, amount_minor FROM payment_ledger
+                              WHERE applied_at IS NULL AND attempts < ?
+                              ORDER BY id LIMIT ?''', (LEDGER_MAX_ATTEMPTS, batch_size))
+        for ledger_id, payment_id, user_id, amount_minor in uow.cursor.fetchall():
+            counts[_apply_entry(uow, ledger_id, payment_id, user_id, amount_minor)] += 1
+    return counts
+
+
+def replay(from_id=None, to_id=None, batch_size=LEDGER_BATCH_SIZE) -> dict:
+    """Повторно проводит записи журнала (в том числе обработанные и отложенные после ошибок).
+
+    Ключи идемпотентности не дают начислить комиссии дважды: досчитываются
+    только записи, комиссий которых нет (например, после восстановления
+    transactions из резервной копии).
+    """
+    counts = {'applied': 0, 'duplicate': 0, 'failed': 0}
+    last_id = (from_id or 1) - 1
+    while True:
+        with unit_of_work(immediate=True) as uow:
+            uow.cursor.execute('''SELECT id, payment_id, user_id, amount_minor FROM payment_ledger
+                                  WHERE id > ? AND id <= ? ORDER BY id LIMIT ?''',
+                               (last_id, to_id if to_id is not None else 2 ** 62, batch_size))
+            rows = uow.cursor.fetchall()
+            if not rows:
+                return counts
+            for ledger_id, payment_id, user_id, amount_minor in rows:
+                # Отложенные после ошибок записи получают новые попытки
+                uow.cursor.execute('UPDATE payment_ledger SET attempts = 0 WHERE id = ? AND applied_at IS NULL',
+                                   (ledger_id,))
+                counts[_apply_entry(uow, ledger_id, payment_id, user_id, amount_minor)] += 1
+            last_id = rows[-1][0]
+
+
+class LedgerWorker:
+    """Фоновый поток, начисляющий комиссии по журналу пачками"""
+
+    def __init__(self, batch_size=LEDGER_BATCH_SIZE, poll_interval=LEDGER_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {'batches': 0, 'applied': 0, 'duplicate': 0, 'failed': 0, 'errors': 0,
+                       'last_batch_ms': 0.0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='payment-ledger', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            while self._drain_batch() >= self.batch_size:
+                pass
+
+    def _drain_batch(self) -> int:
+        started = time.monotonic()
+        try:
+            counts = apply_pending(self.batch_size)
+        except Exception as e:
+            with self._lock:
+                self._stats['errors'] += 1
+            print(f"[PaymentLedger] Ошибка обработки журнала: {e}")
+            return 0
+        processed = sum(counts.values())
+        if processed:
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['last_batch_ms'] = round((time.monotonic() - started) * 1000, 1)
+                for outcome, count in counts.items():
+                    self._stats[outcome] += count
+        return processed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, running=self._thread is not None)
+
+
+def ledger_stats(c=None) -> dict:
+    """Число записей журнала по состояниям"""
+    if c is None:
+        with db_connection() as conn:
+            return ledger_stats(conn.cursor())
+    c.execute('''SELECT SUM(CASE WHEN applied_at IS NOT NULL THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN applied_at IS NULL AND attempts < ? THEN 1 ELSE 0 END),
+                        SUM(CASE WHEN applied_at IS NULL AND attempts >= ? THEN 1 ELSE 0 END)
+                 FROM payment_ledger''', (LEDGER_MAX_ATTEMPTS, LEDGER_MAX_ATTEMPTS))
+    applied, pending, failed = c.fetchone()
+    return {'applied': applied or 0, 'pending': pending or 0, 'failed': failed or 0}
+
+
+# Обработчик журнала процесса (поток запускается при первом платеже или start())
+ledger_worker = LedgerWorker()
+
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    if args[:1] == ['--stats']:
+        print(ledger_stats())
+    elif args[:1] == ['--drain']:
+        total = {'applied': 0, 'duplicate': 0, 'failed': 0}
+        while True:
+            counts = apply_pending()
+            for outcome, count in counts.items():
+                total[outcome] += count
+            if sum(counts.values()) < LEDGER_BATCH_SIZE:
+                break
+        print(f"Обработано: {total}")
+    elif args[:1] == ['--replay']:
+        from_id = int(args[args.index('--from') + 1]) if '--from' in args else None
+        to_id = int(args[args.index('--to') + 1]) if '--to' in args else None
+        print(f"Повторно проведено: {replay(from_id, to_id)}")
+    else:
+        print("Использование: python payment_ledger.py --stats | --drain | --replay [--from ID] [--to ID]")
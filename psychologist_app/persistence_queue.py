@@ -0,0 +1,126 @@
+"""Фоновая очередь записи (файлы, снимки) вне обработки запроса.
+
+Задачи ставятся по ключу (обычно session_id). Пока задача ключа ждет
+записи, новая задача того же ключа заменяет ее (склейка): пишется только
+последнее состояние. Запись откладывается на debounce секунд после
+последней постановки, но не дольше max_delay от первой. Задачи выполняет
+один фоновый поток; при завершении процесса очередь дописывается (atexit).
+
+Метрики: глубина очереди, возраст самой старой задачи, число склеенных,
+выполненных и упавших задач, максимальная глубина.
+"""
+import atexit
+import threading
+import time
+
+# Глубина, при превышении которой очередь пишет предупреждение в лог
+PERSISTENCE_QUEUE_HIGH_WATER = 100
+
+
+class PersistenceQueue:
+    """Очередь записи с склейкой по ключу и отложенным выполнением"""
+
+    def __init__(self, name, debounce=0.0, max_delay=None, high_water=PERSISTENCE_QUEUE_HIGH_WATER):
+        self.name = name
+        self.debounce = debounce
+        self.max_delay = debounce if max_delay is None else max(debounce, max_delay)
+        self.high_water = high_water
+        self._cond = threading.Condition()
+        # key -> (fn, args, первая постановка, последняя постановка)
+        self._pending = {}
+        # Ключ, задача которого выполняется прямо сейчас
+        self._running = None
+        self._stats = {'submitted': 0, 'coalesced': 0, 'completed': 0, 'failed': 0, 'max_depth': 0}
+        self._warned = False
+        self._worker = threading.Thread(target=self._run, name=f'persist-{name}', daemon=True)
+        self._worker.start()
+        _queues.append(self)
+        atexit.register(self.flush)
+
+    def submit(self, key, fn, *args):
+        """Ставит задачу ключа; ожидающая задача того же ключа заменяется"""
+        now = time.monotonic()
+        with self._cond:
+            self._stats['submitted'] += 1
+            pending = self._pending.get(key)
+            if pending is not None:
+                self._stats['coalesced'] += 1
+            self._pending[key] = (fn, args, pending[2] if pending else now, now)
+            depth = len(self._pending)
+            self._stats['max_depth'] = max(self._stats['max_depth'], depth)
+            if depth >= self.high_water and not self._warned:
+                self._warned = True
+                print(f"[PersistenceQueue] {self.name}: глубина очереди {depth}")
+            elif depth < self.high_water // 2:
+                self._warned = False
+            self._cond.notify_all()
+
+    def pending_args(self, key):
+        """Аргументы ожидающей задачи ключа или None"""
+        with self._cond:
+            pending = self._pending.get(key)
+            return pending[1] if pending else None
+
+    def _due(self, pending):
+        _, _, first, last = pending
+        return min(last + self.debounce, first + self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [(self._due(p), key) for key, p in self._pending.items()]
+                    ready = [key for at, key in due if at <= now]
+                    if ready:
+                        key = min(ready, key=lambda k: self._pending[k][2])
+                        break
+                    self._cond.wait(min(at for at, _ in due) - now if due else None)
+                fn, args, _, _ = self._pending.pop(key)
+                self._running = key
+            self._execute(fn, args)
+            with self._cond:
+                self._running = None
+                self._cond.notify_all()
+
+    def _execute(self, fn, args):
+        try:
+            fn(*args)
+            outcome = 'completed'
+        except Exception as e:
+            outcome = 'failed'
+            print(f"[PersistenceQueue] {self.name}: ошибка записи: {e}")
+            import traceback
+            traceback.print_exc()
+        with self._cond:
+            self._stats[outcome] += 1
+
+    def flush(self, timeout=None) -> bool:
+        """Выполняет все ожидающие задачи немедленно; True - очередь пуста"""
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._cond:
+            # Снимаем задержку: все задачи становятся готовыми
+            self._pending = {key: (fn, args, 0.0, 0.0) for key, (fn, args, _, _) in self._pending.items()}
+            self._cond.notify_all()
+            while self._pending or self._running is not None:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            oldest = min((p[2] for p in self._pending.values()), default=None)
+            return dict(self._stats, name=self.name, depth=len(self._pending),
+                        running=self._running is not None,
+                        oldest_age=round(now - oldest, 3) if oldest is not None else 0.0)
+
+
+_queues = []
+
+
+def queue_stats() -> list:
+    """Метрики всех очередей процесса"""
+    return [queue.stats() for queue in _queues]
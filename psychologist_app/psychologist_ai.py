@@ -1,9 +1,18 @@
 import json
 import re
 import os
-from typing import Dict, List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
 from datetime import datetime
 from dotenv import load_dotenv
+from session_store import create_session_store
+from llm_cache import llm_cache
+from llm_backends import LLM_BACKEND, get_llm_client
+from concept_graph import ConceptGraph
+from concept_document import concept_documents
+from concept_snapshots import ConceptSnapshotStore
+from history_window import HistoryWindow, SUMMARY_MAX_TOKENS, fit_window
 
 # Загружаем переменные окружения из .env файла (из корня проекта)
 env_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env')
@@ -11,75 +20,33 @@ load_dotenv(env_path)
 # Также загружаем локальный .env если есть
 load_dotenv()
 
-class PsychologistAI:
-    def __init__(self):
-        # Загружаем API ключ из переменных окружения или из config
-        self.api_key = os.getenv("AI_API_KEY", os.getenv("OPENAI_API_KEY", ""))
-        self.model = os.getenv("AI_MODEL", os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
-        self.openai_client = None
-        
-        # Инициализируем OpenAI клиент если есть API ключ
-        if self.api_key:
-            try:
-                from openai import OpenAI
-                self.openai_client = OpenAI(api_key=self.api_key)
-                print(f"[PsychologistAI] ✅ OpenAI API подключен (модель: {self.model})")
-            except Exception as e:
-                print(f"[PsychologistAI] ⚠️  Ошибка подключения к OpenAI: {e}")
-                self.openai_client = None
-        
-        self.simple_questions = {
-            'манипуляция': 'Манипуляция - это скрытое психологическое воздействие на человека с целью заставить его действовать в интересах манипулятора, часто против собственных интересов. Это форма контроля, при которой человек не осознает, что на него оказывается влияние.',
-            'перекладывание ответственности': 'Перекладывание ответственности - это попытка человека избежать вины или последствий своих действий, возлагая вину на других людей или обстоятельства. Это защитный механизм, который мешает личностному росту и решению проблем.',
-            'ответственность': 'Ответственность - это способность человека признавать последствия своих действий и решений, принимать на себя обязательства и действовать в соответствии с ними. Это важное качество для личностного развития и здоровых отношений.',
-        }
-        
-        self.state_machine = {}
-        
-        # Создаем директорию для сохранения файлов концепций
-        self.concepts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'concept_files')
-        os.makedirs(self.concepts_dir, exist_ok=True)
-        print(f"[PsychologistAI] 📁 Директория для файлов концепций: {self.concepts_dir}")
-    
-    def save_concept_data_to_file(self, session_id: int, concept_data: Dict, username: str = "user") -> str:
-        """Сохраняет данные концепций напрямую в файл"""
-        try:
-            # Генерируем документ
-            document = self.generate_document(concept_data, username)
-            
-            # Сохраняем в файл
-            filename = f"concept_map_session_{session_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
-            filepath = os.path.join(self.concepts_dir, filename)
-            
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(document)
-            
-            print(f"[PsychologistAI] ✅ Данные сохранены в файл: {filepath}")
-            
-            # Также сохраняем JSON для резервной копии
-            json_filename = f"concept_data_session_{session_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            json_filepath = os.path.join(self.concepts_dir, json_filename)
-            
-            with open(json_filepath, 'w', encoding='utf-8') as f:
-                json.dump(concept_data, f, ensure_ascii=False, indent=2)
-            
-            print(f"[PsychologistAI] ✅ JSON данные сохранены в файл: {json_filepath}")
-            
-            return filepath
-        except Exception as e:
-            print(f"[PsychologistAI] ❌ Ошибка при сохранении в файл: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
-    
-    def generate_gpt_response(self, message: str, state: Dict, history: List[Dict], context: str = "") -> Optional[str]:
-        """Генерирует ответ через GPT на основе контекста и алгоритма"""
-        if not self.openai_client:
-            return None
-        
-        try:
-            # Формируем детальный системный промпт с алгоритмом работы психолога
-            system_prompt = """Ты профессиональный психолог, который помогает людям разобраться в их переживаниях и построить систему убеждений их идей.
+# Поля структурированного ответа: извлеченные из сообщения сущности + ответ пользователю
+TURN_LIST_FIELDS = ('emotions', 'situations', 'ideas', 'concept_parts',
+                    'consequences_emotional', 'consequences_physical')
+
+TURN_SCHEMA = {
+    'type': 'object',
+    'properties': dict(
+        {'reply': {'type': 'string'}},
+        **{field: {'type': 'array', 'items': {'type': 'string'}} for field in TURN_LIST_FIELDS}
+    ),
+    'required': ['reply', *TURN_LIST_FIELDS],
+    'additionalProperties': False
+}
+
+TURN_INSTRUCTIONS = """Ответь ОДНИМ JSON-объектом по схеме. Поля:
+- reply: твой ответ человеку (один вопрос, по алгоритму и текущему этапу)
+- emotions: ЭМОЦИИ из последнего сообщения (радость, грусть, тревога...; НЕ усталость и НЕ физические состояния)
+- situations: СИТУАЦИИ/события из последнего сообщения (не эмоции и не идеи), до 5
+- ideas: ИДЕИ/убеждения из последнего сообщения, кратко по сути (до 50 символов каждая), до 5
+- concept_parts: части идеи, если человек отвечает "почему" или "из чего состоит" идея, до 5
+- consequences_emotional: эмоциональные последствия идеи, если человек о них говорит
+- consequences_physical: физические последствия идеи, если человек о них говорит
+Если чего-то в сообщении нет - верни пустой список."""
+
+# Постоянная часть системного промпта: не зависит от сессии и хода,
+# поэтому должна оставаться неизменной байт в байт (кэш префикса у провайдера)
+SYSTEM_PROMPT = """Ты профессиональный психолог, который помогает людям разобраться в их переживаниях и построить систему убеждений их идей.
 
 Твой алгоритм работы:
 1. Начни с мягкого вопроса о самочувствии - спроси как человек себя чувствует, что происходит в его жизни
@@ -116,17 +83,7 @@ class PsychologistAI:
 ВАЖНО - Правильные формулировки вопросов:
 - После описания СИТУАЦИИ спрашивай: "Какая идея, мысль или убеждение вызывает у вас эту эмоцию в этой ситуации?" или "Какая мысль стоит за этой эмоцией?"
 - НЕ спрашивай "почему вы себя так чувствуете" - это некорректно. Спрашивай о МЫСЛИ/ИДЕЕ, которая вызывает эмоцию.
-- Вопрос должен быть о ИДЕЕ, а не о причине эмоции напрямую."""
-
-            # Формируем контекст разговора
-            messages = [{"role": "system", "content": system_prompt}]
-            
-            # Добавляем информацию о текущем состоянии
-            state_info = f"""Текущий этап работы: {state.get('stage', 'unknown')}
-Собранные эмоции: {', '.join(state.get('emotions', [])) if state.get('emotions') else 'пока не собраны'}
-Собранные ситуации: {', '.join(state.get('situations', [])) if state.get('situations') else 'пока не собраны'}
-Текущая идея для разбора: {state.get('current_concept', 'нет')}
-Текущее поле системы убеждений: {state.get('current_field', 'нет')}
+- Вопрос должен быть о ИДЕЕ, а не о причине эмоции напрямую.
 
 ВАЖНО: 
 - Если этап 'emotions' - собирай эмоции, НЕ путай их с идеями. 
@@ -136,20 +93,234 @@ class PsychologistAI:
   * Если пользователь говорит "нет", "готово", "все", "хватит" или подобное - понимай что он хочет закончить
   * Если пользователь уже добавил несколько комментариев и дает короткие ответы - предлагай закончить
   * НЕ зацикливайся на одном и том же вопросе - если пользователь продолжает добавлять комментарии, это нормально, но если он явно хочет закончить - переходи дальше"""
+
+
+class PromptCacheStats:
+    """Счетчики кэширования префикса промпта на стороне провайдера по этапам"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage: str, prompt_tokens: int, cached_tokens: int):
+        with self._lock:
+            counters = self._stages.setdefault(stage, {'calls': 0, 'prefix_hits': 0,
+                                                       'prompt_tokens': 0, 'cached_tokens': 0})
+            counters['calls'] += 1
+            counters['prompt_tokens'] += prompt_tokens
+            counters['cached_tokens'] += cached_tokens
+            if cached_tokens:
+                counters['prefix_hits'] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = {}
+            for stage, counters in self._stages.items():
+                result[stage] = dict(
+                    counters,
+                    hit_ratio=round(counters['prefix_hits'] / counters['calls'], 3),
+                    cached_token_ratio=round(counters['cached_tokens'] / counters['prompt_tokens'], 3)
+                    if counters['prompt_tokens'] else 0.0
+                )
+            return result
+
+
+prompt_cache_stats = PromptCacheStats()
+
+# Параллельное сокращение идей: число потоков и таймаут одного вызова (секунды)
+SHORTEN_WORKERS = int(os.getenv("SHORTEN_WORKERS", "5"))
+SHORTEN_TIMEOUT = float(os.getenv("SHORTEN_TIMEOUT", "8"))
+_shorten_executor = ThreadPoolExecutor(max_workers=max(1, SHORTEN_WORKERS), thread_name_prefix='shorten')
+# Вызовы, не уложившиеся в срок, продолжают занимать поток: новые сокращения
+# берут свободное место без ожидания, иначе идея просто обрезается
+_shorten_slots = threading.BoundedSemaphore(max(1, SHORTEN_WORKERS))
+# Обновление резюме истории идет в фоне, не задерживая ответ
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='summary')
+
+class PsychologistAI:
+    def __init__(self):
+        # Загружаем API ключ из переменных окружения или из config
+        self.api_key = os.getenv("AI_API_KEY", os.getenv("OPENAI_API_KEY", ""))
+        self.model = os.getenv("AI_MODEL", os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+        self.openai_client = None
+        
+        # Инициализируем клиент LLM (бэкенд LLM_BACKEND: openai, compatible, fake).
+        # Клиент - общий шлюз процесса (llm_gateway): keep-alive, дедлайны, повторы
+        # и автомат защиты; пока автомат разомкнут, openai_client ложен и работают эвристики
+        if self.api_key or LLM_BACKEND != 'openai':
+            try:
+                self.openai_client = get_llm_client(self.api_key)
+                print(f"[PsychologistAI] ✅ LLM подключен (бэкенд: {LLM_BACKEND}, модель: {self.model})")
+            except Exception as e:
+                print(f"[PsychologistAI] ⚠️  Ошибка подключения к OpenAI: {e}")
+                self.openai_client = None
+        
+        self.simple_questions = {
+            'манипуляция': 'Манипуляция - это скрытое психологическое воздействие на человека с целью заставить его действовать в интересах манипулятора, часто против собственных интересов. Это форма контроля, при которой человек не осознает, что на него оказывается влияние.',
+            'перекладывание ответственности': 'Перекладывание ответственности - это попытка человека избежать вины или последствий своих действий, возлагая вину на других людей или обстоятельства. Это защитный механизм, который мешает личностному росту и решению проблем.',
+            'ответственность': 'Ответственность - это способность человека признавать последствия своих действий и решений, принимать на себя обязательства и действовать в соответствии с ними. Это важное качество для личностного развития и здоровых отношений.',
+        }
+        
+        # Один структурированный вызов GPT на ход вместо экстрактора + ответа
+        self.structured_turn = os.getenv("STRUCTURED_TURN", "0") == "1"
+        # Сущности, извлеченные структурированным вызовом для текущего хода (на поток)
+        self._prefetched = threading.local()
+        
+        # Состояния сессий: память процесса + постоянное хранилище (SESSION_STORE)
+        self.state_machine = create_session_store()
+        # Окно истории по бюджету токенов и резюме более ранних реплик
+        self.history_window = HistoryWindow()
+        
+        # Создаем директорию для сохранения файлов концепций
+        self.concepts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'concept_files')
+        os.makedirs(self.concepts_dir, exist_ok=True)
+        print(f"[PsychologistAI] 📁 Директория для файлов концепций: {self.concepts_dir}")
+        # Версионированные снимки по сессиям с отложенной записью
+        self.concept_snapshots = ConceptSnapshotStore(self.concepts_dir)
+    
+    def save_concept_data_to_file(self, session_id: int, concept_data: Dict, username: str = "user") -> str:
+        """Сохраняет данные концепций в снимок сессии (concept_files/session_<id>.json и .md).
+        
+        Запись отложенная: повторные сохранения за ход склеиваются в одну версию,
+        документ генерируется один раз при записи. Возвращает путь к документу.
+        """
+        try:
+            return self.concept_snapshots.save(
+                session_id, concept_data, lambda data: self.generate_document(data, username)
+            )
+        except Exception as e:
+            print(f"[PsychologistAI] ❌ Ошибка при сохранении в файл: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+    
+    def _build_response_messages(self, message: str, state: Dict, history: List[Dict], context: str = "",
+                                 summary: str = "") -> List[Dict]:
+        """Сообщения для GPT: постоянный префикс, резюме, история, состояние хода, текущее сообщение.
+        
+        SYSTEM_PROMPT одинаков байт в байт для всех сессий и ходов и идет первым,
+        чтобы провайдер переиспользовал кэш префикса; все, что меняется от хода
+        к ходу (состояние, дополнительный контекст), стоит в конце.
+        """
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        
+        # Резюме реплик, вышедших из окна истории (меняется редко)
+        if summary:
+            messages.append({"role": "system", "content": f"Краткое содержание более ранней части разговора:\n{summary}"})
+        
+        # История разговора: последние сообщения в пределах бюджета токенов
+        _, window = fit_window(history, self.history_window.budget)
+        for msg in window:
+            role = "user" if msg['role'] == 'user' else "assistant"
+            messages.append({"role": role, "content": msg['content']})
+        
+        # Состояние сессии и дополнительный контекст - одним сообщением после истории
+        state_info = f"""Информация о состоянии сессии:
+Текущий этап работы: {state.get('stage', 'unknown')}
+Собранные эмоции: {', '.join(state.get('emotions', [])) if state.get('emotions') else 'пока не собраны'}
+Собранные ситуации: {', '.join(state.get('situations', [])) if state.get('situations') else 'пока не собраны'}
+Текущая идея для разбора: {state.get('current_concept', 'нет')}
+Текущее поле системы убеждений: {state.get('current_field', 'нет')}"""
+        if context:
+            state_info += f"\n\nДополнительный контекст: {context}"
+        messages.append({"role": "system", "content": state_info})
+        
+        # Текущее сообщение - последним
+        messages.append({"role": "user", "content": message})
+        
+        return messages
+    
+    def _summarize_history(self, previous_summary: str, messages: List[Dict]) -> Optional[str]:
+        """Дополняет резюме разговора репликами, вышедшими из окна истории"""
+        dialogue = "\n".join(
+            f"{'Пользователь' if msg['role'] == 'user' else 'Психолог'}: {msg['content']}" for msg in messages
+        )
+        prompt = f"""Текущее резюме разговора:
+{previous_summary or 'пока нет'}
+
+Новые реплики:
+{dialogue}
+
+Обнови резюме с учетом новых реплик. Сохрани эмоции, ситуации, идеи и выводы пользователя, кратко и без оценок.
+
+Резюме:"""
+        
+        summary = self._chat_completion(
+            messages=[{"role": "system", "content": "Ты помощник для краткого резюме психологической сессии. Возвращай только текст резюме."},
+                     {"role": "user", "content": prompt}],
+            temperature=0.3,
+            max_tokens=SUMMARY_MAX_TOKENS
+        )
+        return summary.strip() or None
+    
+    def _record_prompt_usage(self, stage: str, usage) -> None:
+        """Учитывает, сколько токенов промпта провайдер взял из кэша префикса"""
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+        prompt_cache_stats.record(stage, usage.prompt_tokens or 0, cached_tokens)
+    
+    def get_prompt_cache_stats(self) -> Dict:
+        """Доля ходов с попаданием в кэш префикса и доля кэшированных токенов по этапам"""
+        return prompt_cache_stats.stats()
+    
+    def _chat_completion(self, messages: List[Dict], temperature: float, max_tokens: int,
+                         cache: bool = False, **kwargs) -> str:
+        """Текст ответа GPT; при cache=True одинаковые запросы отдаются из llm_cache"""
+        use_cache = cache and llm_cache is not None
+        if use_cache:
+            cached = llm_cache.get(self.model, messages, temperature, max_tokens)
+            if cached is not None:
+                return cached
+        
+        response = self.openai_client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+        content = response.choices[0].message.content or ''
+        if use_cache and content.strip():
+            llm_cache.set(self.model, messages, temperature, max_tokens, content)
+        return content
+    
+    def generate_gpt_response(self, message: str, state: Dict, history: List[Dict], context: str = "",
+                              on_delta: Optional[Callable[[str], None]] = None, summary: str = "") -> Optional[str]:
+        """Генерирует ответ через GPT на основе контекста и алгоритма.
+        
+        Если передан on_delta, ответ запрашивается потоком и каждый фрагмент
+        текста передается в on_delta по мере получения; возвращается полный текст.
+        """
+        if not self.openai_client:
+            return None
+        
+        try:
+            messages = self._build_response_messages(message, state, history, context, summary)
             
-            messages.append({"role": "system", "content": f"Информация о состоянии сессии:\n{state_info}"})
-            
-            # Добавляем историю разговора (последние 15 сообщений для лучшего контекста)
-            for msg in history[-15:]:
-                role = "user" if msg['role'] == 'user' else "assistant"
-                messages.append({"role": role, "content": msg['content']})
-            
-            # Добавляем текущее сообщение
-            messages.append({"role": "user", "content": message})
-            
-            # Добавляем дополнительный контекст если есть
-            if context:
-                messages.append({"role": "system", "content": f"Дополнительный контекст: {context}"})
+            # Потоковый режим: отдаем фрагменты сразу, время до первого токена минимально
+            if on_delta:
+                stream = self.openai_client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.8,
+                    max_tokens=600,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                parts = []
+                for chunk in stream:
+                    # Последний фрагмент без choices несет usage
+                    if getattr(chunk, 'usage', None):
+                        self._record_prompt_usage(state.get('stage', 'unknown'), chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        on_delta(delta)
+                return ''.join(parts).strip()
             
             # Генерируем ответ
             response = self.openai_client.chat.completions.create(
@@ -158,6 +329,7 @@ class PsychologistAI:
                 temperature=0.8,
                 max_tokens=600
             )
+            self._record_prompt_usage(state.get('stage', 'unknown'), response.usage)
             
             return response.choices[0].message.content.strip()
         except Exception as e:
@@ -166,8 +338,70 @@ class PsychologistAI:
             traceback.print_exc()
             return None
     
-    def process_message(self, message: str, history: List[Dict], session_id: int, username: str = "user") -> Dict:
-        """Обрабатывает сообщение пользователя и возвращает ответ AI"""
+    def analyze_turn(self, message: str, state: Dict, history: List[Dict], summary: str = "") -> Optional[Dict]:
+        """Один вызов GPT: сущности из сообщения и ответ пользователю (JSON по TURN_SCHEMA).
+        
+        Возвращает None, если ответ не получен или не прошел проверку.
+        """
+        if not self.openai_client:
+            return None
+        
+        try:
+            messages = self._build_response_messages(message, state, history, TURN_INSTRUCTIONS, summary)
+            response = self.openai_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.8,
+                max_tokens=900,
+                response_format={
+                    "type": "json_schema",
+                    "json_schema": {"name": "turn", "schema": TURN_SCHEMA, "strict": True}
+                }
+            )
+            self._record_prompt_usage(state.get('stage', 'unknown'), response.usage)
+            return self._validate_turn(response.choices[0].message.content)
+        except Exception as e:
+            print(f"[PsychologistAI] Ошибка структурированного ответа GPT: {e}")
+            return None
+    
+    @staticmethod
+    def _validate_turn(raw: Optional[str]) -> Optional[Dict]:
+        """Проверяет и нормализует структурированный ответ; None - если он непригоден"""
+        try:
+            data = json.loads(raw or '')
+        except ValueError:
+            print("[PsychologistAI] Структурированный ответ не является JSON")
+            return None
+        if not isinstance(data, dict) or not isinstance(data.get('reply'), str) or not data['reply'].strip():
+            print("[PsychologistAI] В структурированном ответе нет текста reply")
+            return None
+        
+        turn = {'reply': data['reply'].strip()}
+        for field in TURN_LIST_FIELDS:
+            values = data.get(field, [])
+            if not isinstance(values, list):
+                return None
+            turn[field] = [str(v).strip() for v in values if str(v).strip()]
+        return turn
+    
+    @staticmethod
+    def _algorithm_step(state: Dict) -> tuple:
+        """Шаг алгоритма, на который отвечает ход: этап, идея и поле системы убеждений"""
+        return state.get('stage'), state.get('current_concept'), state.get('current_field')
+    
+    def _get_prefetched(self, field: str, text: str) -> Optional[List[str]]:
+        """Сущности, уже извлеченные из этого текста структурированным вызовом"""
+        turn = getattr(self._prefetched, 'turn', None)
+        if turn is None or turn['message'] != text:
+            return None
+        return list(turn[field])
+    
+    def process_message(self, message: str, history: List[Dict], session_id: int, username: str = "user",
+                        on_delta: Optional[Callable[[str], None]] = None) -> Dict:
+        """Обрабатывает сообщение пользователя и возвращает ответ AI.
+        
+        on_delta - необязательный обработчик фрагментов ответа GPT (потоковый режим).
+        """
         
         message_lower = message.lower().strip()
         
@@ -179,19 +413,48 @@ class PsychologistAI:
         # Получаем текущее состояние сессии
         state = self.get_session_state(session_id, history)
         
+        # Окно истории для GPT (текущее сообщение идет в промпт отдельно, последним).
+        # Реплики, вышедшие из окна, в фоне дописываются в резюме сессии
+        prompt_history = history
+        if history and history[-1].get('role') == 'user' and history[-1].get('content') == message:
+            prompt_history = history[:-1]
+        summary, window, _ = self.history_window.build(session_id, prompt_history)
+        window_start_id = window[0].get('id') if window else None
+        if self.openai_client and self.history_window.window_moved(session_id, window_start_id):
+            _summary_executor.submit(self.history_window.update_summary, session_id, window_start_id,
+                                     self._summarize_history)
+        
+        # Структурированный режим: сущности и ответ одним вызовом. Обработчики
+        # этапов работают на извлеченных сущностях (без своих вызовов GPT), а
+        # ответ подходит, только если они остались на том шаге алгоритма, для
+        # которого он сгенерирован. При ошибке вызова - обычный путь
+        structured = None
+        if self.openai_client and self.structured_turn:
+            structured = self.analyze_turn(message, state, window, summary)
+            if structured:
+                self._prefetched.turn = dict(structured, message=message)
+        step_before = self._algorithm_step(state)
+        
         # Определяем этап работы и получаем базовый ответ по алгоритму
-        if state['stage'] == 'initial':
-            base_response = self.handle_initial_stage(message, state, history)
-        elif state['stage'] == 'emotions':
-            base_response = self.handle_emotions_stage(message, state, history)
-        elif state['stage'] == 'situations':
-            base_response = self.handle_situations_stage(message, state, history)
-        elif state['stage'] == 'concept_hierarchy':
-            base_response = self.handle_concept_hierarchy_stage(message, state, history)
-        else:
-            base_response = {'text': 'Я готов помочь вам разобраться в ваших переживаниях. Расскажите, что вас беспокоит?'}
+        try:
+            if state['stage'] == 'initial':
+                base_response = self.handle_initial_stage(message, state, history)
+            elif state['stage'] == 'emotions':
+                base_response = self.handle_emotions_stage(message, state, history)
+            elif state['stage'] == 'situations':
+                base_response = self.handle_situations_stage(message, state, history)
+            elif state['stage'] == 'concept_hierarchy':
+                base_response = self.handle_concept_hierarchy_stage(message, state, history)
+            else:
+                base_response = {'text': 'Я готов помочь вам разобраться в ваших переживаниях. Расскажите, что вас беспокоит?'}
+        finally:
+            self._prefetched.turn = None
+        
+        # Обработчики этапов меняют состояние - записываем его сразу
+        self.save_session_state(session_id, state)
         
-        # КРИТИЧЕСКИ ВАЖНО: Если есть concept_data в base_response, сохраняем в файл НЕМЕДЛЕННО
+        # КРИТИЧЕСКИ ВАЖНО: Если есть concept_data в base_response, сохраняем снимок сразу
+        # (даже если GPT дальше не ответит); повторное сохранение за ход склеится с этим
         if 'concept_data' in base_response:
             self.save_concept_data_to_file(session_id, base_response['concept_data'], username)
         
@@ -220,13 +483,26 @@ class PsychologistAI:
             if state['stage'] == 'situations':
                 context += " | КРИТИЧЕСКИ ВАЖНО: После того как пользователь описал СИТУАЦИЮ, НЕ спрашивай 'почему вы себя так чувствуете' - это некорректно! Вместо этого спрашивай: 'Какая идея, мысль или убеждение вызывает у вас эту эмоцию в этой ситуации?' или 'Какая мысль стоит за этой эмоцией?' Вопрос должен быть об ИДЕЕ/МЫСЛИ, а не о причине эмоции."
             
-            # Генерируем ответ через GPT с полным контекстом
-            gpt_response = self.generate_gpt_response(
-                message, 
-                state, 
-                history, 
-                context
-            )
+            if structured and self._algorithm_step(state) == step_before:
+                # Ответ уже получен вместе с сущностями и относится к текущему шагу
+                gpt_response = structured['reply']
+                if on_delta:
+                    on_delta(gpt_response)
+            else:
+                if structured:
+                    # Обработчик перешел к другому шагу: ответ структурированного вызова
+                    # отвечал на прежний - генерируем один ответ по вопросу обработчика
+                    print(f"[PsychologistAI] Шаг сменился ({step_before[0]} -> {state['stage']}), "
+                          f"ответ генерируется по вопросу обработчика")
+                # Генерируем ответ через GPT с полным контекстом
+                gpt_response = self.generate_gpt_response(
+                    message, 
+                    state, 
+                    window, 
+                    context,
+                    on_delta=on_delta,
+                    summary=summary
+                )
             
             # Если GPT вернул ответ, используем его
             if gpt_response:
@@ -260,9 +536,10 @@ class PsychologistAI:
         return base_response
     
     def get_session_state(self, session_id: int, history: List[Dict]) -> Dict:
-        """Получает или создает состояние сессии"""
-        if session_id not in self.state_machine:
-            self.state_machine[session_id] = {
+        """Получает или создает состояние сессии (загружается из хранилища при первом обращении)"""
+        state = self.state_machine.get(session_id)
+        if state is None:
+            state = {
                 'stage': 'initial',
                 'emotions': [],
                 'situations': [],
@@ -271,7 +548,19 @@ class PsychologistAI:
                 'current_field': None,
                 'conversation_path': []
             }
-        return self.state_machine[session_id]
+            self.state_machine.set(session_id, state)
+        return state
+    
+    def save_session_state(self, session_id: int, state: Optional[Dict] = None):
+        """Записывает состояние сессии в хранилище (после смены этапа или правки)"""
+        if state is None:
+            state = self.state_machine.get(session_id)
+        if state is not None:
+            self.state_machine.set(session_id, state)
+    
+    def delete_session_state(self, session_id: int):
+        self.state_machine.delete(session_id)
+        self.history_window.delete(session_id)
     
     def handle_initial_stage(self, message: str, state: Dict, history: List[Dict]) -> Dict:
         """Обработка начального этапа - проверяем, описал ли пользователь эмоцию сразу"""
@@ -959,7 +1248,12 @@ class PsychologistAI:
     
     def extract_emotions(self, text: str) -> List[str]:
         """Извлекает эмоции из текста с помощью GPT или эвристики"""
-        if self.openai_client:
+        # Пустой результат структурированного вызова - сразу к эвристике, без GPT
+        prefetched = self._get_prefetched('emotions', text)
+        if prefetched:
+            return prefetched
+        
+        if self.openai_client and prefetched is None:
             try:
                 prompt = f"""Проанализируй следующий текст и извлеки все ЭМОЦИИ, которые упоминает человек.
 
@@ -981,15 +1275,15 @@ class PsychologistAI:
 
 Эмоции:"""
                 
-                response = self.openai_client.chat.completions.create(
-                    model=self.model,
+                content = self._chat_completion(
                     messages=[{"role": "system", "content": "Ты помощник для извлечения эмоций из текста. Возвращай только список эмоций через запятую."},
                              {"role": "user", "content": prompt}],
                     temperature=0.3,
-                    max_tokens=100
+                    max_tokens=100,
+                    cache=True
                 )
                 
-                result = response.choices[0].message.content.strip()
+                result = content.strip()
                 if result:
                     emotions = [e.strip() for e in result.split(',') if e.strip()]
                     return emotions
@@ -1038,6 +1332,10 @@ class PsychologistAI:
     
     def extract_ideas_from_text(self, text: str) -> List[str]:
         """Извлекает ИДЕИ (убеждения) из текста с помощью GPT"""
+        prefetched = self._get_prefetched('ideas', text)
+        if prefetched is not None:
+            return [idea[:50] + '...' if len(idea) > 60 else idea for idea in prefetched[:5]]
+        
         if not self.openai_client:
             return []
         
@@ -1083,36 +1381,57 @@ class PsychologistAI:
 
 Идеи:"""
             
-            response = self.openai_client.chat.completions.create(
-                model=self.model,
+            content = self._chat_completion(
                 messages=[{"role": "system", "content": "Ты помощник для извлечения идей/убеждений из текста. Возвращай только список идей через запятую, кратко и по сути."},
                          {"role": "user", "content": prompt}],
                 temperature=0.3,
-                max_tokens=300
+                max_tokens=300,
+                cache=True
             )
             
-            result = response.choices[0].message.content.strip()
+            result = content.strip()
             if result:
                 ideas = [i.strip() for i in result.split(',') if i.strip()]
-                # Если идея слишком длинная, пытаемся её сократить
-                shortened_ideas = []
-                for idea in ideas[:5]:
-                    if len(idea) > 60:  # Если идея длиннее 60 символов
-                        shortened = self._shorten_idea(idea)
-                        if shortened:
-                            shortened_ideas.append(shortened)
-                        else:
-                            # Если не удалось сократить, берем первые 50 символов
-                            shortened_ideas.append(idea[:50] + '...' if len(idea) > 50 else idea)
-                    else:
-                        shortened_ideas.append(idea)
-                return shortened_ideas
+                # Слишком длинные идеи (длиннее 60 символов) сокращаем параллельно
+                return self._shorten_ideas(ideas[:5])
         except Exception as e:
             print(f"[PsychologistAI] Ошибка при извлечении идей через GPT: {e}")
         
         return []
     
-    def _shorten_idea(self, idea: str) -> Optional[str]:
+    def _shorten_ideas(self, ideas: List[str]) -> List[str]:
+        """Сокращает идеи длиннее 60 символов одновременно - один круг запросов вместо N"""
+        long_indexes = [i for i, idea in enumerate(ideas) if len(idea) > 60]
+        if not long_indexes:
+            return list(ideas)
+        
+        futures = {}
+        for i in long_indexes:
+            if not _shorten_slots.acquire(blocking=False):
+                # Пул занят (в том числе зависшими вызовами) - не ставим в очередь
+                break
+            futures[i] = _shorten_executor.submit(self._shorten_idea_in_slot, ideas[i], SHORTEN_TIMEOUT)
+        # Общий срок - таймаут одного вызова с запасом: вызовы идут параллельно
+        wait(futures.values(), timeout=SHORTEN_TIMEOUT + 1)
+        
+        shortened_ideas = list(ideas)
+        for i in long_indexes:
+            future = futures.get(i)
+            shortened = future.result() if future is not None and future.done() else None
+            if not shortened:
+                # Если не удалось сократить, берем первые 50 символов
+                idea = ideas[i]
+                shortened = idea[:50] + '...' if len(idea) > 50 else idea
+            shortened_ideas[i] = shortened
+        return shortened_ideas
+    
+    def _shorten_idea_in_slot(self, idea: str, timeout: float) -> Optional[str]:
+        try:
+            return self._shorten_idea(idea, timeout)
+        finally:
+            _shorten_slots.release()
+    
+    def _shorten_idea(self, idea: str, timeout: float = SHORTEN_TIMEOUT) -> Optional[str]:
         """Сокращает длинную идею до сути (до 50 символов)"""
         if not self.openai_client or len(idea) <= 50:
             return idea[:50] + '...' if len(idea) > 50 else idea
@@ -1124,15 +1443,16 @@ class PsychologistAI:
 
 Сокращенная идея (до 50 символов, только суть):"""
             
-            response = self.openai_client.chat.completions.create(
-                model=self.model,
+            content = self._chat_completion(
                 messages=[{"role": "system", "content": "Ты помощник для сокращения идей до сути. Возвращай только сокращенную идею, до 50 символов."},
                          {"role": "user", "content": prompt}],
                 temperature=0.3,
-                max_tokens=50
+                max_tokens=50,
+                timeout=timeout,
+                cache=True
             )
             
-            result = response.choices[0].message.content.strip()
+            result = content.strip()
             if result and len(result) <= 60:  # Допускаем небольшое превышение
                 return result
         except Exception as e:
@@ -1143,7 +1463,12 @@ class PsychologistAI:
     
     def extract_situations(self, text: str) -> List[str]:
         """Извлекает ситуации из текста (НЕ идеи, НЕ эмоции!) с помощью GPT или эвристики"""
-        if self.openai_client:
+        # Пустой результат структурированного вызова - сразу к эвристике, без GPT
+        prefetched = self._get_prefetched('situations', text)
+        if prefetched:
+            return prefetched[:5]
+        
+        if self.openai_client and prefetched is None:
             try:
                 prompt = f"""Проанализируй следующий текст и извлеки все СИТУАЦИИ (события), которые упоминает человек.
 
@@ -1167,15 +1492,15 @@ class PsychologistAI:
 
 Ситуации:"""
                 
-                response = self.openai_client.chat.completions.create(
-                    model=self.model,
+                content = self._chat_completion(
                     messages=[{"role": "system", "content": "Ты помощник для извлечения ситуаций из текста. Возвращай только список ситуаций через запятую, без эмоций."},
                              {"role": "user", "content": prompt}],
                     temperature=0.3,
-                    max_tokens=200
+                    max_tokens=200,
+                    cache=True
                 )
                 
-                result = response.choices[0].message.content.strip()
+                result = content.strip()
                 if result:
                     situations = [s.strip() for s in result.split(',') if s.strip()]
                     return situations[:5]  # Берем до 5 ситуаций
@@ -1198,7 +1523,12 @@ class PsychologistAI:
     
     def extract_concept_parts(self, text: str) -> List[str]:
         """Извлекает части идеи из ответа на вопрос Почему с помощью GPT или эвристики"""
-        if self.openai_client:
+        # Пустой результат структурированного вызова - сразу к эвристике, без GPT
+        prefetched = self._get_prefetched('concept_parts', text)
+        if prefetched:
+            return prefetched[:5]
+        
+        if self.openai_client and prefetched is None:
             try:
                 prompt = f"""Проанализируй следующий ответ человека на вопрос "Почему?" или "Из чего состоит эта идея?".
 Извлеки все части, компоненты или причины, которые упоминает человек.
@@ -1210,15 +1540,15 @@ class PsychologistAI:
 
 Части идеи:"""
                 
-                response = self.openai_client.chat.completions.create(
-                    model=self.model,
+                content = self._chat_completion(
                     messages=[{"role": "system", "content": "Ты помощник для извлечения частей идеи из текста. Возвращай только список частей через запятую."},
                              {"role": "user", "content": prompt}],
                     temperature=0.3,
-                    max_tokens=200
+                    max_tokens=200,
+                    cache=True
                 )
                 
-                result = response.choices[0].message.content.strip()
+                result = content.strip()
                 if result:
                     parts = [p.strip() for p in result.split(',') if p.strip()]
                     return parts[:5]  # Берем до 5 частей
@@ -1232,7 +1562,12 @@ class PsychologistAI:
     
     def extract_consequences(self, text: str, type: str) -> List[str]:
         """Извлекает последствия из текста с помощью GPT или эвристики"""
-        if self.openai_client:
+        # Пустой результат структурированного вызова - сразу к эвристике, без GPT
+        prefetched = self._get_prefetched(f'consequences_{type}', text)
+        if prefetched:
+            return prefetched
+        
+        if self.openai_client and prefetched is None:
             try:
                 consequence_type = "эмоциональные" if type == 'emotional' else "физические"
                 prompt = f"""Проанализируй следующий текст и извлеки все {consequence_type} последствия, которые упоминает человек.
@@ -1244,15 +1579,15 @@ class PsychologistAI:
 
 {consequence_type.capitalize()} последствия:"""
                 
-                response = self.openai_client.chat.completions.create(
-                    model=self.model,
+                content = self._chat_completion(
                     messages=[{"role": "system", "content": "Ты помощник для извлечения последствий из текста. Возвращай только список последствий через запятую."},
                              {"role": "user", "content": prompt}],
                     temperature=0.3,
-                    max_tokens=200
+                    max_tokens=200,
+                    cache=True
                 )
                 
-                result = response.choices[0].message.content.strip()
+                result = content.strip()
                 if result:
                     consequences = [c.strip() for c in result.split(',') if c.strip()]
                     return consequences
@@ -1264,102 +1599,14 @@ class PsychologistAI:
         consequences = [s.strip() for s in sentences if len(s.strip()) > 5]
         return consequences
     
-    def generate_document(self, concept_hierarchy: Dict, username: str) -> str:
-        """Генерирует документ в виде иерархии таблиц из системы убеждений"""
-        document = f"# Карта концепций: {username}\n\n"
-        document += f"*Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}*\n\n"
-        document += "---\n\n"
-        
-        def escape_markdown_table(text: str) -> str:
-            """Экранирует специальные символы для таблиц Markdown"""
-            if not text:
-                return ""
-            # Заменяем переносы строк на <br> для таблиц
-            return str(text).replace('|', '\\|').replace('\n', '<br>')
-        
-        def format_concept_as_table(concept_name: str, level: int = 0) -> str:
-            """Форматирует идею в виде таблицы"""
-            if concept_name not in concept_hierarchy:
-                return ""
-            
-            data = concept_hierarchy[concept_name]
-            
-            # Формируем таблицу для идеи
-            table = "| Поле | Значение |\n"
-            table += "|------|----------|\n"
-            
-            # Наименование идеи
-            table += f"| **Наименование идеи** | {escape_markdown_table(data['name'])} |\n"
-            
-            # Состав идеи
-            composition_text = ""
-            if data['composition']:
-                composition_text = "<br>".join([f"{i+1}. {part}" for i, part in enumerate(data['composition'])])
-            else:
-                composition_text = "—"
-            table += f"| **Состав идеи** | {escape_markdown_table(composition_text)} |\n"
-            
-            # Основатель идеи
-            founder_text = data['founder'] if data['founder'] else "—"
-            table += f"| **Основатель идеи** | {escape_markdown_table(founder_text)} |\n"
-            
-            # Цель появления идеи
-            purpose_text = data['purpose'] if data['purpose'] else "—"
-            table += f"| **Цель появления идеи** | {escape_markdown_table(purpose_text)} |\n"
-            
-            # Эмоциональные последствия
-            emotional_text = ""
-            if data['consequences']['emotional']:
-                emotional_text = "<br>".join([f"• {cons}" for cons in data['consequences']['emotional']])
-            else:
-                emotional_text = "—"
-            table += f"| **Эмоциональные последствия** | {escape_markdown_table(emotional_text)} |\n"
-            
-            # Физические последствия
-            physical_text = ""
-            if data['consequences']['physical']:
-                physical_text = "<br>".join([f"• {cons}" for cons in data['consequences']['physical']])
-            else:
-                physical_text = "—"
-            table += f"| **Физические последствия** | {escape_markdown_table(physical_text)} |\n"
-            
-            # Выводы
-            conclusions_text = data['conclusions'] if data['conclusions'] else "—"
-            table += f"| **Выводы** | {escape_markdown_table(conclusions_text)} |\n"
-            
-            # Комментарии
-            comments_text = ""
-            if data['comments']:
-                comments_text = "<br>".join([f"• {comment}" for comment in data['comments']])
-            else:
-                comments_text = "—"
-            table += f"| **Комментарии** | {escape_markdown_table(comments_text)} |\n"
-            
-            table += "\n"
-            
-            # Рекурсивно обрабатываем под-концепции (они идут после текущей таблицы)
-            sub_tables = ""
-            for sub_concept in data['sub_concepts']:
-                sub_tables += format_concept_as_table(sub_concept, level + 1)
-            
-            return table + sub_tables
-        
-        # Находим корневые концепции (те, которые не являются частью других)
-        root_concepts = []
-        all_sub_concepts = set()
-        for concept_data in concept_hierarchy.values():
-            all_sub_concepts.update(concept_data.get('sub_concepts', []))
-        
-        for concept_name in concept_hierarchy.keys():
-            if concept_name not in all_sub_concepts:
-                root_concepts.append(concept_name)
-        
-        # Форматируем все корневые концепции как таблицы
-        for root in root_concepts:
-            document += format_concept_as_table(root, 0)
-            document += "\n---\n\n"
-        
-        return document
+    def generate_document(self, concept_hierarchy: Dict, username: str, graph: ConceptGraph = None,
+                          hashes: Dict = None) -> str:
+        """Генерирует документ в виде иерархии таблиц из системы убеждений.
+
+        graph - граф идей сессии (concept_graphs), hashes - хэши идей (concept_hashes),
+        если они уже есть у вызывающего. Таблицы неизменившихся идей берутся из кэша.
+        """
+        return concept_documents.render(concept_hierarchy, username, graph, hashes)
     
     def generate_positive_belief_plan(self, concept_hierarchy: Dict, negative_concept: str) -> str:
         """Генерирует план по формированию позитивной установки на основе негативной"""
@@ -1454,17 +1701,17 @@ class PsychologistAI:
 
 Позитивная установка:"""
             
-            response = self.openai_client.chat.completions.create(
-                model=self.model,
+            content = self._chat_completion(
                 messages=[
                     {"role": "system", "content": "Ты помощник для преобразования негативных установок в позитивные. Возвращай только позитивную установку."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.5,
-                max_tokens=50
+                max_tokens=50,
+                cache=True
             )
             
-            return response.choices[0].message.content.strip().strip('"').strip("'")
+            return content.strip().strip('"').strip("'")
         except Exception as e:
             print(f"[PsychologistAI] Ошибка при генерации позитивной установки: {e}")
             return f"Я достойный и ценный человек"
@@ -1511,17 +1758,17 @@ class PsychologistAI:
 
 Верни ТОЛЬКО JSON, без дополнительных объяснений."""
             
-            response = self.openai_client.chat.completions.create(
-                model=self.model,
+            content = self._chat_completion(
                 messages=[
                     {"role": "system", "content": "Ты помощник для анализа корневых установок. Возвращай только валидный JSON."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.5,
-                max_tokens=200
+                max_tokens=200,
+                cache=True
             )
             
-            result_text = response.choices[0].message.content.strip()
+            result_text = content.strip()
             import re
             json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
             if json_match:
@@ -1534,6 +1781,9 @@ class PsychologistAI:
     
     def generate_emotion_to_situation_transition(self, emotions_text: str, user_message: str, history: List[Dict]) -> Optional[str]:
         """Генерирует переход от эмоций к ситуациям через GPT с вариациями формулировок"""
+        # В структурированном режиме текст хода уже получен - лишний вызов не нужен
+        if getattr(self._prefetched, 'turn', None) is not None:
+            return None
         if not self.openai_client:
             return None
         
@@ -1588,6 +1838,9 @@ class PsychologistAI:
     
     def generate_positive_emotion_response(self, emotions_text: str, user_message: str, history: List[Dict]) -> Optional[str]:
         """Генерирует ответ на позитивные эмоции через GPT с вариациями"""
+        # В структурированном режиме текст хода уже получен - лишний вызов не нужен
+        if getattr(self._prefetched, 'turn', None) is not None:
+            return None
         if not self.openai_client:
             return None
         
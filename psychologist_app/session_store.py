@@ -0,0 +1,240 @@
+"""Хранилище состояния сессий PsychologistAI (этап, эмоции, система убеждений).
+
+Бэкенд выбирается переменной SESSION_STORE:
+- memory - только память процесса (LRU с TTL), как раньше, но с вытеснением;
+           подходит лишь для одного воркера;
+- db     - таблица session_states в основной БД (SQLite/PostgreSQL);
+- redis  - Redis по REDIS_URL; без пакета redis или без URL используется
+           локальная замена с тем же API (LocalRedis).
+
+Для db и redis перед бэкендом стоит LRU в памяти процесса, записи идут
+насквозь. Каждое сохранение получает в бэкенде новую версию, и чтение
+сверяет версию из памяти с бэкендом: если сессию изменил другой воркер,
+состояние загружается заново, иначе берется из памяти без разбора JSON.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from db_pool import db_connection
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'db')
+# Сколько состояний держать в памяти процесса и как долго (секунды)
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '3600'))
+# Срок жизни состояния в Redis (0 - без ограничения)
+SESSION_REDIS_TTL = int(os.environ.get('SESSION_REDIS_TTL', str(30 * 24 * 3600)))
+
+
+class MemorySessionStore:
+    """LRU-кэш состояний в памяти процесса с TTL"""
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # session_id -> (state, expires_at)
+        self._items = OrderedDict()
+
+    def get(self, session_id):
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is None:
+                return None
+            state, expires_at = item
+            if self.ttl and expires_at < time.monotonic():
+                del self._items[session_id]
+                return None
+            self._items.move_to_end(session_id)
+            return state
+
+    def set(self, session_id, state):
+        with self._lock:
+            self._items[session_id] = (state, time.monotonic() + self.ttl)
+            self._items.move_to_end(session_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._items.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+def _new_version() -> str:
+    return uuid.uuid4().hex
+
+
+class DatabaseSessionStore:
+    """Состояния в таблице session_states (JSON в колонке state_json, версия - в version)"""
+
+    def get(self, session_id):
+        loaded = self.load(session_id)
+        return loaded[1] if loaded else None
+
+    def load(self, session_id, known_version=None):
+        """(версия, состояние) или None, если состояния нет; состояние None - версия равна known_version.
+
+        Одним запросом: JSON читается, только если версия изменилась.
+        """
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.execute('''SELECT version, CASE WHEN version = ? THEN NULL ELSE state_json END
+                         FROM session_states WHERE session_id = ?''', (known_version, session_id))
+            row = c.fetchone()
+        if row is None:
+            return None
+        version, state_json = row
+        return version, (json.loads(state_json) if state_json is not None else None)
+
+    def set(self, session_id, state):
+        """Записывает состояние; возвращает его новую версию"""
+        state_json = json.dumps(state, ensure_ascii=False)
+        version = _new_version()
+        with db_connection() as conn:
+            conn.cursor().execute('''INSERT OR REPLACE INTO session_states
+                                     (session_id, state_json, version, updated_at)
+                                     VALUES (?, ?, ?, CURRENT_TIMESTAMP)''', (session_id, state_json, version))
+        return version
+
+    def delete(self, session_id):
+        with db_connection() as conn:
+            conn.cursor().execute('DELETE FROM session_states WHERE session_id = ?', (session_id,))
+
+
+class LocalRedis:
+    """Локальная замена Redis-клиента (get/set с ex/delete) для разработки"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        with self._lock:
+            self._data[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+
+class RedisSessionStore:
+    """Состояния в Redis (или в совместимом клиенте) под ключами session_state:<id>,
+    версии - под session_state_version:<id>"""
+
+    def __init__(self, client, ttl=SESSION_REDIS_TTL, prefix='session_state:',
+                 version_prefix='session_state_version:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.version_prefix = version_prefix
+
+    def get(self, session_id):
+        value = self.client.get(f'{self.prefix}{session_id}')
+        return json.loads(value) if value else None
+
+    def load(self, session_id, known_version=None):
+        """(версия, состояние) или None; состояние None - версия равна known_version"""
+        version = self.client.get(f'{self.version_prefix}{session_id}')
+        version = version.decode('utf-8') if isinstance(version, bytes) else version
+        if version is not None and version == known_version:
+            return version, None
+        # Версия читается до состояния: если между чтениями состояние обновят,
+        # следующее чтение увидит новую версию и загрузит его еще раз
+        state = self.get(session_id)
+        return (version, state) if state is not None else None
+
+    def set(self, session_id, state):
+        """Записывает состояние, затем его новую версию; возвращает версию"""
+        version = _new_version()
+        self.client.set(f'{self.prefix}{session_id}', json.dumps(state, ensure_ascii=False),
+                        ex=self.ttl or None)
+        self.client.set(f'{self.version_prefix}{session_id}', version, ex=self.ttl or None)
+        return version
+
+    def delete(self, session_id):
+        self.client.delete(f'{self.prefix}{session_id}', f'{self.version_prefix}{session_id}')
+
+
+class TieredSessionStore:
+    """Память процесса перед постоянным бэкендом: запись насквозь, чтение со сверкой версии"""
+
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        # session_id -> (состояние, версия в бэкенде; None - не записано в бэкенд)
+        self.cache = cache or MemorySessionStore()
+
+    def get(self, session_id):
+        cached = self.cache.get(session_id)
+        if cached is not None and cached[1] is None:
+            # Последнее сохранение не дошло до бэкенда - актуальна копия в памяти
+            return cached[0]
+        try:
+            loaded = self.backend.load(session_id, cached[1] if cached else None)
+        except Exception as e:
+            print(f"[SessionStore] Ошибка загрузки состояния сессии {session_id}: {e}")
+            return cached[0] if cached else None
+        if loaded is None:
+            # Сессию удалили (возможно, в другом воркере)
+            self.cache.delete(session_id)
+            return None
+        version, state = loaded
+        if state is None:
+            return cached[0]
+        self.cache.set(session_id, (state, version))
+        return state
+
+    def set(self, session_id, state):
+        try:
+            version = self.backend.set(session_id, state)
+        except Exception as e:
+            # Состояние остается в памяти; в бэкенд попадет при следующем сохранении
+            print(f"[SessionStore] Ошибка сохранения состояния сессии {session_id}: {e}")
+            version = None
+        self.cache.set(session_id, (state, version))
+
+    def delete(self, session_id):
+        self.cache.delete(session_id)
+        self.backend.delete(session_id)
+
+
+def _redis_client():
+    redis_url = os.environ.get('REDIS_URL')
+    if redis_url:
+        try:
+            import redis
+            return redis.Redis.from_url(redis_url)
+        except ImportError:
+            print("[SessionStore] Пакет redis не установлен, используется LocalRedis")
+    return LocalRedis()
+
+
+def create_session_store(kind=SESSION_STORE):
+    """Создает хранилище состояний по названию бэкенда (memory, db, redis)"""
+    if kind == 'memory':
+        return MemorySessionStore()
+    if kind == 'redis':
+        return TieredSessionStore(RedisSessionStore(_redis_client()))
+    if kind == 'db':
+        return TieredSessionStore(DatabaseSessionStore())
+    raise ValueError(f"Неизвестный SESSION_STORE: {kind}")
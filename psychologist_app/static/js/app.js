@@ -11,6 +11,8 @@ function initSocket() {
     });
     
     socket.on('response', function(data) {
+        // Итоговый ответ заменяет собранный из фрагментов черновик
+        discardStreamingMessage();
         // Показываем стикер "Затрудняюсь ответить" только если это не навигационные кнопки
         const showDifficulty = !data.show_navigation && currentSessionId;
         addMessage('assistant', data.message, true, showDifficulty, data.concept_data);
@@ -21,12 +23,48 @@ function initSocket() {
         updateSessionTitle(data.session_id, data.title);
     });
     
+    socket.on('response_chunk', function(data) {
+        if (data.session_id !== currentSessionId) {
+            return;
+        }
+        appendStreamingChunk(data.delta);
+    });
+    
     socket.on('error', function(data) {
+        discardStreamingMessage();
         alert('Ошибка: ' + data.message);
         hideTypingIndicator();
     });
 }
 
+// Сборка ответа из потоковых фрагментов (response_chunk)
+let streamingMessage = null;
+
+function appendStreamingChunk(delta) {
+    // Черновик мог исчезнуть из DOM при переключении сессии
+    if (!streamingMessage || !streamingMessage.element.isConnected) {
+        hideTypingIndicator();
+        const messagesContainer = document.getElementById('messagesContainer');
+        const messageDiv = document.createElement('div');
+        messageDiv.className = 'message assistant streaming';
+        const contentDiv = document.createElement('div');
+        contentDiv.className = 'message-content';
+        messageDiv.appendChild(contentDiv);
+        messagesContainer.appendChild(messageDiv);
+        streamingMessage = { element: messageDiv, contentDiv: contentDiv, text: '' };
+    }
+    streamingMessage.text += delta;
+    streamingMessage.contentDiv.textContent = streamingMessage.text;
+    scrollToBottom();
+}
+
+function discardStreamingMessage() {
+    if (streamingMessage) {
+        streamingMessage.element.remove();
+        streamingMessage = null;
+    }
+}
+
 // Обновление названия сессии
 function updateSessionTitle(sessionId, newTitle) {
     const session = sessions.find(s => s.id === sessionId);
@@ -722,7 +760,8 @@ document.addEventListener('DOMContentLoaded', async function() {
         
         socket.emit('message', {
             session_id: currentSessionId,
-            message: message
+            message: message,
+            stream: true
         });
     });
     
@@ -0,0 +1,69 @@
+"""Фоновая обработка ходов диалога с сохранением порядка внутри сессии.
+
+Обработка сообщения (вызовы GPT) выполняется в ограниченном пуле потоков,
+а не в обработчике Socket.IO. Задачи одной сессии выполняются строго по
+очереди, задачи разных сессий - параллельно.
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Сколько ходов обрабатывается параллельно
+TURN_WORKERS = int(os.environ.get('TURN_WORKERS', '8'))
+
+
+class SessionTaskQueue:
+    """Пул потоков с FIFO-очередью на каждый ключ (сессию)"""
+
+    def __init__(self, max_workers=TURN_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='turn')
+        self._lock = threading.Lock()
+        # Ключ -> очередь задач; ключ присутствует, пока по нему идет обработка
+        self._queues = {}
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0}
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Ставит задачу в очередь сессии; возвращает позицию в очереди (0 - сразу в работу)"""
+        with self._lock:
+            self._stats['submitted'] += 1
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((fn, args, kwargs))
+                return len(queue) - 1
+            self._queues[key] = deque([(fn, args, kwargs)])
+        self._executor.submit(self._drain, key)
+        return 0
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                fn, args, kwargs = queue[0]
+            try:
+                fn(*args, **kwargs)
+                outcome = 'completed'
+            except Exception as e:
+                outcome = 'failed'
+                print(f"[TurnQueue] Ошибка обработки задачи сессии {key}: {e}")
+                import traceback
+                traceback.print_exc()
+            with self._lock:
+                queue.popleft()
+                self._stats[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, max_workers=self.max_workers, active_sessions=len(self._queues),
+                        pending=sum(len(q) for q in self._queues.values()))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+# Общая очередь процесса
+turn_queue = SessionTaskQueue()
@@ -0,0 +1,35 @@
+"""Общие фикстуры: временная база SQLite вместо общего пула процесса"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_pool
+from db_migrations import apply_migrations
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    """Пул на пустой временной базе; get_db()/db_connection() берут соединения из него"""
+    pool = db_pool.ConnectionPool(db_pool._sqlite_connector(str(tmp_path / 'test.db')), dialect='sqlite')
+    monkeypatch.setattr(db_pool, '_pool', pool)
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture
+def migrate(pool):
+    """migrate(target=None) - применяет миграции до версии target включительно"""
+    def migrate(target=None):
+        with pool.connection() as conn:
+            return apply_migrations(conn, target)
+    return migrate
+
+
+@pytest.fixture
+def db(pool, migrate):
+    """Пул на базе с актуальной схемой"""
+    migrate()
+    return pool
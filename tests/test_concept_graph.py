@@ -0,0 +1,70 @@
+from concept_graph import ConceptGraph
+from concept_store import ConceptStore
+
+
+def concept(*sub_concepts, **fields):
+    return dict(fields, sub_concepts=list(sub_concepts))
+
+
+def snapshot(graph, names):
+    return {
+        'roots': graph.roots(),
+        'ordered': graph.ordered(),
+        'children': {name: graph.children(name) for name in names},
+        'depth': {name: graph.depth(name) for name in names},
+        'cycles': graph.has_cycles(),
+    }
+
+
+def add_session(c):
+    c.execute("INSERT INTO sessions (user_id) VALUES (1)")
+    return c.lastrowid
+
+
+def full(concept_hierarchy):
+    graph = ConceptGraph()
+    graph.sync(concept_hierarchy)
+    return graph
+
+
+def test_incremental_sync_matches_full_sync(db):
+    steps = [
+        {'А': concept('Б'), 'Б': concept(), 'В': concept()},
+        # Новая идея и новая связь
+        {'А': concept('Б', 'Г'), 'Б': concept(), 'В': concept(), 'Г': concept()},
+        # Другой порядок идей без изменения полей
+        {'В': concept(), 'А': concept('Б', 'Г'), 'Г': concept(), 'Б': concept()},
+        # Удаление идеи, на которую ссылаются
+        {'В': concept(), 'А': concept('Б', 'Г'), 'Б': concept()},
+        # Цикл и изменение только значения поля
+        {'В': concept('А'), 'А': concept('Б', 'Г'), 'Б': concept('В', purpose='цель')},
+        # Цикл разорван
+        {'В': concept(), 'А': concept('Б'), 'Б': concept('В', purpose='цель')},
+    ]
+    store, graph = ConceptStore(), ConceptGraph()
+    names = {name for step in steps for name in step}
+    with db.connection() as conn:
+        c = conn.cursor()
+        session_id = add_session(c)
+        for step in steps:
+            changes = store.save(c, session_id, step)
+            graph.sync(step, changed=changes['concepts'])
+            assert snapshot(graph, names) == snapshot(full(step), names)
+
+
+def test_incremental_sync_visits_only_changed_concepts(db):
+    hierarchy = {f'идея {n}': concept() for n in range(50)}
+    store = ConceptStore()
+    with db.connection() as conn:
+        c = conn.cursor()
+        session_id = add_session(c)
+        graph = ConceptGraph()
+        graph.sync(hierarchy, changed=store.save(c, session_id, hierarchy)['concepts'])
+
+        hierarchy['идея 3'] = concept('идея 4')
+        changes = store.save(c, session_id, hierarchy)
+    assert changes['concepts'] == {'идея 3': 3}
+    assert graph.sync(hierarchy, changed=changes['concepts']) > 0
+    assert graph.roots()[:4] == ['идея 0', 'идея 1', 'идея 2', 'идея 3']
+    assert 'идея 4' not in graph.roots()
+    assert graph.depth('идея 4') == 1
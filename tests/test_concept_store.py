@@ -0,0 +1,42 @@
+from concept_store import ConceptStore
+
+
+def session(db):
+    with db.connection() as conn:
+        c = conn.cursor()
+        c.execute('INSERT INTO sessions (user_id) VALUES (1)')
+        return c.lastrowid
+
+
+def save(db, store, session_id, concept_data):
+    with db.connection() as conn:
+        return store.save(conn.cursor(), session_id, concept_data)
+
+
+def load(db, session_id):
+    with db.connection() as conn:
+        return ConceptStore().load(conn.cursor(), session_id)
+
+
+def test_save_diffs_against_db_after_another_worker_saved(db):
+    session_id = session(db)
+    first, second = ConceptStore(), ConceptStore()
+    save(db, first, session_id, {'А': {'purpose': 'цель'}})
+    save(db, second, session_id, {'А': {'purpose': 'цель', 'founder': 'отец'}, 'Б': {'purpose': 'другая'}})
+
+    # Копия first устарела: поля, добавленные second, должны удалиться
+    changes = save(db, first, session_id, {'А': {'purpose': 'цель'}})
+
+    assert changes['deleted'] == 2
+    assert changes['concepts'] is None
+    assert load(db, session_id) == {'А': {'purpose': 'цель'}}
+
+
+def test_save_uses_cached_copy_while_version_matches(db):
+    session_id = session(db)
+    store = ConceptStore()
+    save(db, store, session_id, {'А': {'purpose': 'цель'}, 'Б': {'purpose': 'другая'}})
+
+    changes = save(db, store, session_id, {'А': {'purpose': 'новая цель'}, 'Б': {'purpose': 'другая'}})
+
+    assert changes == {'updated': 1, 'deleted': 0, 'concepts': {'А': 0}}
@@ -0,0 +1,59 @@
+from history_cache import HistoryCache, SessionHistory, turn_history
+
+
+def message(message_id, role):
+    return {'id': message_id, 'role': role, 'content': f'{role} {message_id}'}
+
+
+def test_turn_history_drops_later_user_messages():
+    # Пользователь отправил 3 и 4 до того, как был обработан ход на 3
+    history = [message(1, 'user'), message(2, 'assistant'), message(3, 'user'), message(4, 'user')]
+    assert [m['id'] for m in turn_history(history, 3)] == [1, 2, 3]
+
+
+def test_turn_history_keeps_replies_to_earlier_turns_before_current_message():
+    # Ответ на 1 сохранен после того, как пользователь отправил 2
+    history = [message(1, 'user'), message(2, 'user'), message(3, 'assistant'), message(4, 'user')]
+    assert [m['id'] for m in turn_history(history, 2)] == [1, 3, 2]
+
+
+def insert(c, message_id, role):
+    c.execute('INSERT INTO messages (id, session_id, role, content) VALUES (?, 1, ?, ?)',
+              (message_id, role, f'{role} {message_id}'))
+
+
+def test_history_keeps_message_appended_out_of_order(db):
+    cache = HistoryCache(window=10)
+    with db.connection() as conn:
+        c = conn.cursor()
+        insert(c, 1, 'user')
+        cache.get(c, 1)
+        insert(c, 2, 'user')
+        insert(c, 3, 'assistant')
+        # Поток ответа дописал кэш раньше, чем поток сообщения пользователя
+        cache.append(1, 3, 'assistant', 'assistant 3')
+        cache.append(1, 2, 'user', 'user 2')
+
+        assert [m['id'] for m in cache.get(c, 1)] == [1, 2, 3]
+        assert cache.message_count(1) == 3
+
+
+def test_catch_up_finds_lower_id_committed_later(db):
+    cache = HistoryCache(window=10)
+    with db.connection() as conn:
+        c = conn.cursor()
+        insert(c, 1, 'user')
+        insert(c, 3, 'user')
+        cache.get(c, 1)
+        # Меньший id последовательности зафиксирован другим воркером позже
+        insert(c, 2, 'assistant')
+
+        assert [m['id'] for m in cache.get(c, 1)] == [1, 2, 3]
+        assert cache.message_count(1) == 3
+
+
+def test_append_older_than_full_window_is_ignored():
+    history = SessionHistory(2, [message(5, 'user'), message(6, 'assistant')], 2)
+    history.append(message(4, 'user'))
+    history.append(message(7, 'user'))
+    assert [m['id'] for m in history.messages] == [6, 7]
@@ -0,0 +1,71 @@
+import pytest
+
+from history_window import HistoryWindow, fit_window, message_tokens
+
+
+def add_messages(pool, session_id, count):
+    with pool.connection() as conn:
+        c = conn.cursor()
+        for n in range(count):
+            role = 'user' if n % 2 == 0 else 'assistant'
+            c.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                      (session_id, role, f'реплика {n}'))
+        c.execute('SELECT id, role, content FROM messages WHERE session_id = ? ORDER BY id', (session_id,))
+        return [{'id': row[0], 'role': row[1], 'content': row[2]} for row in c.fetchall()]
+
+
+class RecordingSummarizer:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, previous_summary, messages):
+        self.batches.append([m['id'] for m in messages])
+        return f"{previous_summary}+{len(messages)}"
+
+
+def test_fit_window_keeps_newest_messages_within_budget():
+    history = [{'id': n, 'role': 'user', 'content': 'x' * 30} for n in range(10)]
+    older, window = fit_window(history, budget=3 * message_tokens(history[0]) + 1)
+    assert [m['id'] for m in window] == [7, 8, 9]
+    assert [m['id'] for m in older] == list(range(7))
+
+
+def test_long_session_of_short_messages_loses_no_turns(db):
+    messages = add_messages(db, 1, 120)
+    # Хвост истории в памяти - 50 последних сообщений, все умещаются в бюджет
+    tail = messages[-50:]
+    window = HistoryWindow(budget=2000, min_batch=2, max_batch=30)
+    summary, prompt_window, older = window.build(1, tail)
+    assert older == [] and prompt_window == tail
+
+    summarize = RecordingSummarizer()
+    assert window.update_summary(1, prompt_window[0]['id'], summarize)
+
+    summarized = [message_id for batch in summarize.batches for message_id in batch]
+    assert summarized == [m['id'] for m in messages[:70]]
+    assert [len(batch) for batch in summarize.batches] == [30, 30, 10]
+    record = window.store.get(1)
+    assert record['summarized_until'] == messages[69]['id']
+    assert record['summary'] == '+30+30+10'
+
+
+def test_summary_continues_from_boundary_as_window_slides(db):
+    messages = add_messages(db, 1, 60)
+    add_messages(db, 2, 10)
+    window = HistoryWindow(budget=2000, min_batch=2, max_batch=50)
+    summarize = RecordingSummarizer()
+
+    assert window.update_summary(1, messages[20]['id'], summarize)
+    assert window.update_summary(1, messages[21]['id'], summarize) is False  # одна новая реплика < min_batch
+    assert window.update_summary(1, messages[25]['id'], summarize)
+    assert window.update_summary(1, messages[25]['id'], summarize) is False
+
+    assert summarize.batches == [[m['id'] for m in messages[:20]], [m['id'] for m in messages[20:25]]]
+
+
+def test_window_moved_only_when_window_start_changes(db):
+    window = HistoryWindow()
+    assert window.window_moved(1, 10)
+    assert not window.window_moved(1, 10)
+    assert window.window_moved(1, 12)
+    assert not window.window_moved(1, None)
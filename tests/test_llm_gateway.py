@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+from llm_gateway import CircuitBreaker, CircuitOpenError, LLMGateway
+
+
+class APIConnectionError(Exception):
+    """Как openai.APIConnectionError: обрыв соединения"""
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+class StreamingClient:
+    """Клиент, поток которого обрывается после первого фрагмента"""
+
+    def __init__(self, fail_after=1):
+        self.fail_after = fail_after
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, timeout=None, stream=False, **kwargs):
+        def stream_chunks():
+            for n in range(self.fail_after):
+                yield chunk(f'часть {n} ')
+            raise APIConnectionError('connection reset mid-stream')
+        return stream_chunks()
+
+
+def read_stream(gateway):
+    return [c.choices[0].delta.content for c in gateway.chat.completions.create(model='m', messages=[], stream=True)]
+
+
+def test_mid_stream_failures_open_the_breaker():
+    gateway = LLMGateway(StreamingClient(), breaker=CircuitBreaker(threshold=2, cooldown=60))
+
+    for _ in range(2):
+        with pytest.raises(APIConnectionError):
+            read_stream(gateway)
+
+    assert gateway.breaker.state == 'open'
+    assert not gateway
+    assert gateway.stats()['stream_failures'] == 2
+    with pytest.raises(CircuitOpenError):
+        gateway.chat.completions.create(model='m', messages=[], stream=True)
+
+
+def test_completed_stream_keeps_breaker_closed():
+    class CompleteClient(StreamingClient):
+        def _create(self, timeout=None, stream=False, **kwargs):
+            return iter([chunk('привет'), chunk(' мир')])
+
+    gateway = LLMGateway(CompleteClient(), breaker=CircuitBreaker(threshold=1))
+    assert read_stream(gateway) == ['привет', ' мир']
+    assert gateway.breaker.state == 'closed'
+
+
+def test_streaming_reply_failure_is_reported_through_psychologist_ai(db):
+    from psychologist_ai import PsychologistAI
+
+    ai = PsychologistAI()
+    ai.openai_client = LLMGateway(StreamingClient(), breaker=CircuitBreaker(threshold=1, cooldown=60))
+    deltas = []
+
+    reply = ai.generate_gpt_response('привет', {'stage': 'emotions'}, [], on_delta=deltas.append)
+
+    assert reply is None
+    assert deltas == ['часть 0 ']
+    assert ai.openai_client.breaker.state == 'open'
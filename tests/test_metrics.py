@@ -0,0 +1,53 @@
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def sources(monkeypatch):
+    monkeypatch.setattr(metrics, '_sources', [])
+
+
+def test_collect_metrics_isolates_failing_source():
+    metrics.register_metrics('ok', lambda: {'depth': 3})
+    metrics.register_metrics('broken', lambda: 1 / 0)
+
+    collected = metrics.collect_metrics()
+
+    assert collected['ok'] == {'depth': 3}
+    assert 'division by zero' in collected['broken']['error']
+    assert 'pid' in collected
+
+
+def test_prompt_cache_stats_report_hit_ratio():
+    from psychologist_ai import PromptCacheStats
+
+    stats = PromptCacheStats()
+    metrics.register_metrics('prompt_cache', stats.stats)
+    stats.record('emotions', prompt_tokens=2000, cached_tokens=1024)
+    stats.record('emotions', prompt_tokens=2000, cached_tokens=0)
+
+    emotions = metrics.collect_metrics()['prompt_cache']['emotions']
+    assert emotions['hit_ratio'] == 0.5
+    assert emotions['cached_token_ratio'] == 0.256
+
+
+def test_persistence_queue_depth_is_reported():
+    import threading
+
+    from persistence_queue import PersistenceQueue, queue_stats
+
+    release = threading.Event()
+    queue = PersistenceQueue('metrics-test', debounce=0.0)
+    metrics.register_metrics('persistence_queues', queue_stats)
+    queue.submit(1, release.wait)
+    queue.submit(2, lambda: None)
+    queue.submit(3, lambda: None)
+
+    reported = [q for q in metrics.collect_metrics()['persistence_queues'] if q['name'] == 'metrics-test']
+    release.set()
+    queue.flush()
+
+    assert len(reported) == 1
+    assert reported[0]['depth'] >= 1
+    assert reported[0]['submitted'] == 3
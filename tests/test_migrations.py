@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+
+def test_concept_hierarchies_dedupe_keeps_newest_and_archives_rest(pool, migrate):
+    migrate(target=0)
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.executemany('INSERT INTO concept_hierarchies (session_id, concept_data, created_at) VALUES (?, ?, ?)', [
+            (1, 'newest', '2024-05-02 10:00:00'),
+            # Больший id, но более старая запись
+            (1, 'older', '2024-05-01 10:00:00'),
+            (1, 'oldest', '2024-04-30 10:00:00'),
+            (2, 'only', '2024-05-01 10:00:00'),
+        ])
+
+    migrate()
+
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT session_id, concept_data FROM concept_hierarchies ORDER BY session_id')
+        assert c.fetchall() == [(1, 'newest'), (2, 'only')]
+        c.execute('SELECT concept_data FROM concept_hierarchies_duplicates ORDER BY concept_data')
+        assert c.fetchall() == [('older',), ('oldest',)]
+        with pytest.raises(sqlite3.IntegrityError):
+            c.execute("INSERT INTO concept_hierarchies (session_id, concept_data) VALUES (1, 'again')")
+
+
+def test_concept_hierarchies_dedupe_breaks_timestamp_ties_by_id(pool, migrate):
+    migrate(target=0)
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.executemany('INSERT INTO concept_hierarchies (session_id, concept_data, created_at) VALUES (?, ?, ?)', [
+            (1, 'first', '2024-05-01 10:00:00'),
+            (1, 'second', '2024-05-01 10:00:00'),
+        ])
+
+    migrate()
+
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT concept_data FROM concept_hierarchies')
+        assert c.fetchall() == [('second',)]
+
+
+def test_migrations_are_idempotent(db, migrate):
+    assert migrate() == []
+
+
+def test_money_minor_units_sums_duplicate_balances(pool, migrate):
+    migrate(target=6)
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.executemany('INSERT INTO balances (user_id, amount) VALUES (?, ?)', [
+            (1, 10.10),
+            (1, 0.20),
+            (2, 5.00),
+            (1, 0.07),
+        ])
+
+    migrate()
+
+    with pool.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id, user_id, amount_minor, amount FROM balances ORDER BY user_id')
+        assert c.fetchall() == [(1, 1, 1037, 10.37), (3, 2, 500, 5.0)]
+        c.execute('SELECT amount FROM balances_duplicates ORDER BY id')
+        assert c.fetchall() == [(0.2,), (0.07,)]
+        with pytest.raises(sqlite3.IntegrityError):
+            c.execute('INSERT INTO balances (user_id, amount) VALUES (1, 0)')
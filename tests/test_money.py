@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+from mlm_system import create_referral_structure, from_minor, get_user_balance, process_payment, to_minor
+
+
+def add_users(pool, count):
+    """Цепочка пользователей: каждый следующий приглашен предыдущим; возвращает id"""
+    ids = []
+    with pool.connection() as conn:
+        c = conn.cursor()
+        for n in range(count):
+            c.execute('INSERT INTO users (username, password_hash, referral_code) VALUES (?, ?, ?)',
+                      (f'user{n}', 'x', f'CODE{n}'))
+            ids.append(c.lastrowid)
+            create_referral_structure(c.lastrowid, f'CODE{n - 1}' if n else None, c)
+    return ids
+
+
+def test_to_minor_rounds_half_up_to_kopeck():
+    assert to_minor('0.005') == 1
+    assert to_minor(0.015) == 2
+    assert to_minor(1.005) == 101
+    assert to_minor('2.675') == 268
+    assert to_minor(100) == 10000
+    assert from_minor(101) == Decimal('1.01')
+
+
+def test_commissions_round_down_to_kopeck(db):
+    top, middle, payer = add_users(db, 3)
+
+    commissions = process_payment(payer, 0.99, payment_id='p1')
+
+    # 15% и 7% от 99 копеек: 14.85 -> 14, 6.93 -> 6
+    assert [(c['referrer_id'], c['level'], c['amount']) for c in commissions] == [
+        (middle, 1, 0.14), (top, 2, 0.06)]
+    assert get_user_balance(middle) == 0.14
+    assert get_user_balance(top) == 0.06
+
+
+def test_process_payment_replay_is_idempotent(db):
+    referrer, payer = add_users(db, 2)
+
+    first = process_payment(payer, 1000, payment_id='p1')
+    replay = process_payment(payer, 1000, payment_id='p1')
+
+    assert replay == first
+    assert get_user_balance(referrer) == 150.0
+    with db.connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = ?', (referrer,))
+        assert c.fetchone()[0] == 1
@@ -0,0 +1,66 @@
+import pytest
+
+from mlm_system import create_referral_structure, get_user_balance
+from payment_ledger import PaymentConflictError, apply_pending, payment_status, record_payment, replay
+
+
+@pytest.fixture
+def users(db):
+    """(реферер, плательщик)"""
+    with db.connection() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO users (username, password_hash, referral_code) VALUES ('referrer', 'x', 'REF')")
+        referrer = c.lastrowid
+        c.execute("INSERT INTO users (username, password_hash, referral_code) VALUES ('payer', 'x', 'PAY')")
+        payer = c.lastrowid
+        create_referral_structure(payer, 'REF', c)
+    return referrer, payer
+
+
+def record(pool, *args, **kwargs):
+    # С курсором запись не будит фоновый обработчик: пачки проводит тест
+    with pool.connection() as conn:
+        return record_payment(*args, c=conn.cursor(), **kwargs)
+
+
+def test_ledger_applies_payment_exactly_once(db, users):
+    referrer, payer = users
+    record(db, payer, 1000, 'p1')
+    record(db, payer, 1000, 'p1')
+
+    assert apply_pending() == {'applied': 1, 'duplicate': 0, 'failed': 0}
+    assert apply_pending() == {'applied': 0, 'duplicate': 0, 'failed': 0}
+    assert replay() == {'applied': 0, 'duplicate': 1, 'failed': 0}
+
+    assert get_user_balance(referrer) == 150.0
+    status = payment_status(payer, 'p1')
+    assert status['status'] == 'applied'
+    assert [t['amount'] for t in status['transactions']] == [150.0]
+
+
+def test_payment_id_is_scoped_per_user(db, users):
+    referrer, payer = users
+    record(db, payer, 1000, 'p1')
+    record(db, referrer, 500, 'p1')
+
+    assert apply_pending()['applied'] == 2
+    assert payment_status(payer, 'p1')['amount'] == 1000.0
+    assert payment_status(referrer, 'p1')['amount'] == 500.0
+    assert payment_status(payer, 'p2') is None
+
+
+def test_payment_id_replay_with_other_amount_conflicts(db, users):
+    _, payer = users
+    record(db, payer, 1000, 'p1')
+
+    with pytest.raises(PaymentConflictError):
+        record(db, payer, 999.99, 'p1')
+    assert payment_status(payer, 'p1')['amount'] == 1000.0
+
+
+@pytest.mark.parametrize('amount', ['abc', None, -5, 0, 0.001, 'nan'])
+def test_invalid_amount_is_rejected(db, users, amount):
+    _, payer = users
+    with pytest.raises(ValueError):
+        record(db, payer, amount, 'p1')
+    assert payment_status(payer, 'p1') is None
@@ -0,0 +1,57 @@
+import pytest
+
+from session_store import DatabaseSessionStore, LocalRedis, RedisSessionStore, TieredSessionStore
+
+
+@pytest.fixture(params=['db', 'redis'])
+def backend_factory(request, db):
+    """Бэкенд, общий для нескольких воркеров (у каждого воркера - свой экземпляр)"""
+    if request.param == 'db':
+        return DatabaseSessionStore
+    client = LocalRedis()
+    return lambda: RedisSessionStore(client)
+
+
+def test_worker_sees_state_saved_by_another_worker(backend_factory):
+    worker_a = TieredSessionStore(backend_factory())
+    worker_b = TieredSessionStore(backend_factory())
+
+    worker_a.set(1, {'stage': 'initial'})
+    assert worker_b.get(1) == {'stage': 'initial'}
+
+    worker_a.set(1, {'stage': 'emotions'})
+    assert worker_b.get(1) == {'stage': 'emotions'}
+
+    worker_b.set(1, {'stage': 'situations'})
+    assert worker_a.get(1) == {'stage': 'situations'}
+
+
+def test_unchanged_state_is_served_from_memory(backend_factory):
+    worker = TieredSessionStore(backend_factory())
+    state = {'stage': 'emotions', 'emotions': ['грусть']}
+    worker.set(1, state)
+    # Тот же объект: версия совпала, JSON не разбирался
+    assert worker.get(1) is state
+
+
+def test_delete_in_one_worker_is_seen_by_another(backend_factory):
+    worker_a = TieredSessionStore(backend_factory())
+    worker_b = TieredSessionStore(backend_factory())
+    worker_a.set(1, {'stage': 'initial'})
+    assert worker_b.get(1) is not None
+
+    worker_a.delete(1)
+    assert worker_b.get(1) is None
+
+
+def test_state_not_written_to_backend_stays_in_memory():
+    class FailingBackend:
+        def set(self, session_id, state):
+            raise ConnectionError('backend down')
+
+        def load(self, session_id, known_version=None):
+            raise AssertionError('unsaved state must not be reloaded')
+
+    worker = TieredSessionStore(FailingBackend())
+    worker.set(1, {'stage': 'emotions'})
+    assert worker.get(1) == {'stage': 'emotions'}
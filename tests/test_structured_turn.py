@@ -0,0 +1,118 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from psychologist_ai import PsychologistAI, TURN_LIST_FIELDS
+
+
+class ScriptedClient:
+    """Клиент с интерфейсом OpenAI: ответ выбирает responder(kwargs), вызовы сохраняются"""
+
+    def __init__(self, responder):
+        self.calls = []
+        self._responder = responder
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        message = SimpleNamespace(content=self._responder(kwargs))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def turn_json(reply, **fields):
+    return json.dumps(dict({field: [] for field in TURN_LIST_FIELDS}, reply=reply, **fields),
+                      ensure_ascii=False)
+
+
+@pytest.fixture
+def ai(db):
+    ai = PsychologistAI()
+    ai.structured_turn = True
+    return ai
+
+
+def test_validate_turn_normalizes_lists():
+    turn = PsychologistAI._validate_turn(turn_json(' Что вы чувствуете? ', emotions=[' грусть ', '', 'страх']))
+    assert turn['reply'] == 'Что вы чувствуете?'
+    assert turn['emotions'] == ['грусть', 'страх']
+    assert turn['ideas'] == []
+
+
+@pytest.mark.parametrize('raw', [
+    None,
+    'не json',
+    '[]',
+    json.dumps({'reply': '   '}),
+    turn_json('Ответ', emotions='грусть'),
+])
+def test_validate_turn_rejects_unusable_output(raw):
+    assert PsychologistAI._validate_turn(raw) is None
+
+
+def test_structured_reply_is_used_when_step_is_unchanged(ai):
+    client = ScriptedClient(lambda kwargs: turn_json('Какую эмоцию вы сейчас испытываете?'))
+    ai.openai_client = client
+    ai.state_machine.set(1, dict(ai.get_session_state(1, []), stage='emotions'))
+
+    result = ai.process_message('привет', [], 1)
+
+    assert result['text'] == 'Какую эмоцию вы сейчас испытываете?'
+    assert len(client.calls) == 1
+    assert 'response_format' in client.calls[0]
+
+
+def test_step_change_regenerates_reply_once_from_handler_question(ai):
+    def responder(kwargs):
+        if 'response_format' in kwargs:
+            return turn_json('Как давно вы это чувствуете?', emotions=['грусть'])
+        return 'Что сейчас происходит, что вызывает у вас грусть?'
+    client = ScriptedClient(responder)
+    ai.openai_client = client
+
+    result = ai.process_message('мне грустно', [], 1)
+
+    assert ai.get_session_state(1, [])['stage'] == 'situations'
+    assert ai.get_session_state(1, [])['emotions'] == ['грусть']
+    assert result['text'] == 'Что сейчас происходит, что вызывает у вас грусть?'
+    # Структурированный вызов и один ответ: ни экстрактора, ни генератора перехода
+    assert len(client.calls) == 2
+    context = client.calls[1]['messages'][-2]['content']
+    assert 'Пример вопроса' in context
+    assert 'Какая ситуация вызывает у вас это чувство' in context
+
+
+def test_invalid_structured_output_falls_back_to_regular_turn(ai):
+    def responder(kwargs):
+        if 'response_format' in kwargs:
+            return 'не json'
+        return 'Расскажите подробнее.'
+    client = ScriptedClient(responder)
+    ai.openai_client = client
+    ai.state_machine.set(1, dict(ai.get_session_state(1, []), stage='emotions'))
+
+    result = ai.process_message('привет', [], 1)
+
+    assert result['text'] == 'Расскажите подробнее.'
+    assert [('response_format' in call) for call in client.calls] == [True, False]
+
+
+def test_shorten_ideas_truncates_when_pool_is_saturated(ai, monkeypatch):
+    import threading
+
+    import psychologist_ai
+
+    client = ScriptedClient(lambda kwargs: 'суть')
+    ai.openai_client = client
+    monkeypatch.setattr(psychologist_ai, '_shorten_slots', threading.BoundedSemaphore(1))
+    idea = 'очень длинная идея ' * 5
+
+    # Единственное место занято зависшим вызовом
+    psychologist_ai._shorten_slots.acquire()
+    assert ai._shorten_ideas([idea]) == [idea[:50] + '...']
+    assert client.calls == []
+
+    psychologist_ai._shorten_slots.release()
+    assert ai._shorten_ideas([idea]) == ['суть']
+    # Место освобождается после вызова
+    assert psychologist_ai._shorten_slots.acquire(blocking=False)